@@ -1,16 +1,27 @@
 import sys, argparse
-from PyQt5 import QtWidgets
 import os
-from diffted import main
 
 def entry_point():
     parser = argparse.ArgumentParser()
-    parser.add_argument("infile",nargs="?")
+    parser.add_argument("infile",nargs="*",help="data or config file, more than one with --report")
     parser.add_argument("-s","--stylesheet",help="css stylesheet")
     parser.add_argument("-g","--gitmod",help="git modifier to diff with")
     parser.add_argument("-p","--profile",action="store_true",help="Profile startup")
+    parser.add_argument("--report",choices=("json","csv","html"),help="Write the changes to each file in this format, without a GUI")
+    parser.add_argument("--against",help="Report changes from this file rather than from git")
+    parser.add_argument("--rev",help="Report changes from this git revision, default the current branch")
+    parser.add_argument("-c","--config",help="yaml config for data files given with --report")
+    parser.add_argument("-o","--output",help="Report output file, default stdout")
+    parser.add_argument("-j","--jobs",type=int,help="Processes to report on several files with, default one per core")
     args, extras = parser.parse_known_args()
 
+    if args.report is not None:
+        # imports nothing from Qt
+        from diffted.core.report import report
+        sys.exit(report(args))
+
+    from PyQt5 import QtWidgets
+    from diffted import main
     if args.profile:
         import cProfile, pstats, io
         pr = cProfile.Profile()
@@ -21,8 +32,8 @@ def entry_point():
             app.setStyleSheet("".join(fh.readlines()))
     mainWin = main.Main(app)
     #import pdb; pdb.set_trace()
-    if args.infile is not None:
-        mainWin.openfilename(args.infile)
+    if len(args.infile):
+        mainWin.openfilename(args.infile[0])
     if args.gitmod is not None:
         mainWin.toolbars['Git'].version.setText(args.gitmod)
         mainWin.toolbars['Git'].diffAction.trigger()
@@ -39,4 +50,3 @@ def entry_point():
         print(s.getvalue())
 
     sys.exit(res)
-
@@ -0,0 +1,4 @@
+# The parts of diffted that need no GUI: table stores and csv reading, the
+# row differs, rule evaluation, git and github access, and the headless
+# report. Nothing here imports Qt, and github and yaml support are only
+# imported when they are used, so scripts can use these modules directly.
@@ -0,0 +1,311 @@
+
+from bisect import bisect_left
+from collections import Counter
+from difflib import SequenceMatcher
+from itertools import chain, compress
+from operator import itemgetter, ne
+
+# Row level differencing. Every engine returns SequenceMatcher style opcodes
+# (tag, i1, i2, j1, j2) turning the rows a into the rows b.
+
+class DiffRow(list):
+    def __hash__(self):
+        return hash(u"\uFDD0".join(self))
+
+def rowIds(a, b):
+    # map equal rows to equal small ints, so the engines compare ints
+    ids = {}
+    return [ids.setdefault(r, len(ids)) for r in a], [ids.setdefault(r, len(ids)) for r in b]
+
+def longestIncreasing(seq):
+    # indices into seq of a longest strictly increasing subsequence
+    tails = []
+    tailIndex = []
+    prev = [-1] * len(seq)
+    for i, v in enumerate(seq):
+        k = bisect_left(tails, v)
+        if k == len(tails):
+            tails.append(v)
+            tailIndex.append(i)
+        else:
+            tails[k] = v
+            tailIndex[k] = i
+        prev[i] = tailIndex[k-1] if k > 0 else -1
+    res = []
+    i = tailIndex[-1] if len(tailIndex) else -1
+    while i >= 0:
+        res.append(i)
+        i = prev[i]
+    res.reverse()
+    return res
+
+def opcodesFromBlocks(blocks, n, m):
+    res = []
+    i = j = 0
+    for ai, bj, size in blocks + [(n, m, 0)]:
+        if i < ai and j < bj:
+            res.append(('replace', i, ai, j, bj))
+        elif i < ai:
+            res.append(('delete', i, ai, j, bj))
+        elif j < bj:
+            res.append(('insert', i, ai, j, bj))
+        if size:
+            if len(res) and res[-1][0] == 'equal' and res[-1][2] == ai and res[-1][4] == bj:
+                res[-1] = ('equal', res[-1][1], ai + size, res[-1][3], bj + size)
+            else:
+                res.append(('equal', ai, ai + size, bj, bj + size))
+        i, j = ai + size, bj + size
+    return res
+
+# Myers keeps a trace entry per edit step, so its memory grows with the
+# square of the number of edits; past this many it gives up
+MAXEDITS = 1000
+
+def myersBlocks(a, b, alo, ahi, blo, bhi, maxd=MAXEDITS):
+    # Greedy O(ND) diff of a[alo:ahi] against b[blo:bhi]. Returns the matching
+    # blocks, or None if more than maxd edits would be needed.
+    n = ahi - alo
+    m = bhi - blo
+    if maxd is None or maxd > n + m:
+        maxd = n + m
+    v = {1: 0}
+    trace = []
+    found = False
+    for d in range(maxd + 1):
+        vd = {}
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k-1] < v[k+1]):
+                x = v[k+1]
+            else:
+                x = v[k-1] + 1
+            y = x - k
+            while x < n and y < m and a[alo+x] == b[blo+y]:
+                x += 1
+                y += 1
+            vd[k] = x
+            if x >= n and y >= m:
+                found = True
+                break
+        trace.append(vd)
+        v = vd
+        if found:
+            break
+    if not found:
+        return None
+    blocks = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d-1]
+        k = x - y
+        if k == -d or (k != d and prev[k-1] < prev[k+1]):
+            prevk = k + 1
+            midx = prev[prevk]
+        else:
+            prevk = k - 1
+            midx = prev[prevk] + 1
+        midy = midx - k
+        if x > midx:
+            blocks.append((alo + midx, blo + midy, x - midx))
+        x = prev[prevk]
+        y = x - prevk
+    if x > 0:
+        blocks.append((alo, blo, x))
+    blocks.reverse()
+    return blocks
+
+def patienceBlocks(a, b, maxd=MAXEDITS):
+    # Anchors on rows that occur exactly once on each side and recurses into
+    # the gaps between them. Gaps with no unique rows are diffed with Myers.
+    blocks = []
+    stack = [(0, len(a), 0, len(b))]
+    while len(stack):
+        alo, ahi, blo, bhi = stack.pop()
+        start = alo
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            blocks.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a[ahi-1] == b[bhi-1]:
+            ahi -= 1
+            bhi -= 1
+        if end > ahi:
+            blocks.append((ahi, bhi, end - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+        acounts = Counter(a[alo:ahi])
+        bcounts = Counter(b[blo:bhi])
+        bpos = {b[j]: j for j in range(blo, bhi) if bcounts[b[j]] == 1}
+        pairs = [(i, bpos[a[i]]) for i in range(alo, ahi) if acounts[a[i]] == 1 and a[i] in bpos]
+        if not len(pairs):
+            blocks.extend(myersBlocks(a, b, alo, ahi, blo, bhi, maxd) or [])
+            continue
+        ai, bj = alo, blo
+        for p in longestIncreasing([x[1] for x in pairs]):
+            i, j = pairs[p]
+            blocks.append((i, j, 1))
+            stack.append((ai, i, bj, j))
+            ai, bj = i + 1, j + 1
+        stack.append((ai, ahi, bj, bhi))
+    blocks.sort()
+    return blocks
+
+def keyedOpcodes(a, b, akeys, bkeys):
+    # Pairs rows with equal keys, keeping the longest run of pairs that are in
+    # the same order on both sides. Unpaired rows are deleted or inserted.
+    bindex = {}
+    for j, k in enumerate(bkeys):
+        bindex.setdefault(k, j)
+    pairs = []
+    for i, k in enumerate(akeys):
+        j = bindex.pop(k, None)
+        if j is not None:
+            pairs.append((i, j))
+    res = []
+    ai = bj = 0
+    for p in longestIncreasing([x[1] for x in pairs]) + [None]:
+        i, j = pairs[p] if p is not None else (len(a), len(b))
+        if ai < i:
+            res.append(('delete', ai, i, bj, bj))
+        if bj < j:
+            res.append(('insert', i, i, bj, j))
+        if p is None:
+            break
+        if a[i] != b[j]:
+            res.append(('replace', i, i + 1, j, j + 1))
+        elif len(res) and res[-1][0] == 'equal':
+            res[-1] = ('equal', res[-1][1], i + 1, res[-1][3], j + 1)
+        else:
+            res.append(('equal', i, i + 1, j, j + 1))
+        ai, bj = i + 1, j + 1
+    return res
+
+engines = ('sequence', 'myers', 'patience', 'key')
+
+def diffRows(a, b, engine='sequence', akeys=None, bkeys=None):
+    # a and b are lists of hashable rows. The key engine also needs the key of
+    # each row in akeys and bkeys.
+    if engine == 'sequence':
+        return SequenceMatcher(a=a, b=b).get_opcodes()
+    ha, hb = rowIds(a, b)
+    if engine == 'key':
+        return keyedOpcodes(ha, hb, akeys, bkeys)
+    elif engine == 'myers':
+        blocks = myersBlocks(ha, hb, 0, len(ha), 0, len(hb))
+        if blocks is None:
+            # too many edits to trace, so anchor on unique rows instead
+            blocks = patienceBlocks(ha, hb)
+    elif engine == 'patience':
+        blocks = patienceBlocks(ha, hb)
+    else:
+        raise ValueError("Unknown diff engine {}".format(engine))
+    return opcodesFromBlocks(blocks, len(ha), len(hb))
+
+def colDiff(orig, new):
+    res = [None] * len(new)
+    m = SequenceMatcher(a=orig, b=new)
+    for t, astart, aend, bstart, bend in m.get_opcodes():
+        for i in range(bstart, bend):
+            res[i] = t
+    return res
+
+def cellDiffs(arows, brows):
+    # The changed cells, as (column, tag), of each row of brows against the
+    # row aligned with it in arows. When all rows are the same width, whole
+    # columns of the block are compared position by position.
+    res = [[] for x in brows]
+    if not len(brows):
+        return res
+    width = len(brows[0])
+    if all(len(r) == width for r in chain(arows, brows)):
+        rows = range(len(brows))
+        for j, (acol, bcol) in enumerate(zip(zip(*arows), zip(*brows))):
+            for i in compress(rows, map(ne, acol, bcol)):
+                res[i].append((j, 'replace'))
+    else:
+        for i, (ra, rb) in enumerate(zip(arows, brows)):
+            res[i] = [(j, t) for j, t in enumerate(colDiff(ra, rb)) if t is not None and t != 'equal']
+    return res
+
+def keyIndices(fieldnames, keys):
+    if keys is None:
+        return None
+    if isinstance(keys, str):
+        keys = [keys]
+    try:
+        return [fieldnames.index(k) for k in keys]
+    except ValueError:
+        return None
+
+def rowKeys(rows, indices):
+    if not len(indices):
+        return [()] * len(rows)
+    return list(zip(*[map(itemgetter(i), rows) for i in indices]))
+
+def remapRows(fieldnames, rows, names):
+    # rows with the columns fieldnames rearranged to the columns names
+    if list(fieldnames) == list(names):
+        return rows
+    pos = [fieldnames.index(n) if n in fieldnames else -1 for n in names]
+    return [DiffRow(r[p] if p >= 0 else "" for p in pos) for r in rows]
+
+def alignedKeys(base, rows, tag):
+    # Keys for rows without key columns: the index of the base row each row
+    # is aligned with, or (tag, index) for rows with no counterpart
+    res = [(tag, j) for j in range(len(rows))]
+    for t, i1, i2, j1, j2 in diffRows(base, rows, 'patience'):
+        if t == 'equal' or t == 'replace':
+            res[j1:j1 + min(i2 - i1, j2 - j1)] = range(i1, i1 + min(i2 - i1, j2 - j1))
+    return res
+
+def mergeRows(base, ours, theirs, bkeys, okeys, tkeys):
+    # Three way merge of rows with the same columns, pairing rows by key.
+    # Returns (cells, deleted, inserts): cells is (ours row, column, tag, value)
+    # for each cell to change, where tag is 'replace' to take value from
+    # theirs or 'conflict'; deleted lists ours rows that theirs deleted; and
+    # inserts is (ours row to insert before, row, tag) for rows from theirs.
+    bindex = dict(zip(bkeys, range(len(bkeys))))
+    tindex = dict(zip(tkeys, range(len(tkeys))))
+    oindex = dict(zip(okeys, range(len(okeys))))
+    cells = []
+    deleted = []
+    for i, (k, o) in enumerate(zip(okeys, ours)):
+        bi = bindex.get(k, None)
+        ti = tindex.get(k, None)
+        if ti is None:
+            if bi is not None:
+                # theirs deleted the row: fine unless ours changed it
+                if o == base[bi]:
+                    deleted.append(i)
+                else:
+                    cells.extend((i, j, 'conflict', None) for j in range(len(o)))
+            continue
+        t = theirs[ti]
+        if o == t:
+            continue
+        b = base[bi] if bi is not None else None
+        for j, (ov, tv) in enumerate(zip(o, t)):
+            if ov == tv:
+                continue
+            bv = b[j] if b is not None else None
+            if ov == bv:
+                cells.append((i, j, 'replace', tv))
+            elif tv != bv:
+                cells.append((i, j, 'conflict', tv))
+    inserts = []
+    pos = 0
+    for k, t in zip(tkeys, theirs):
+        oi = oindex.get(k, None)
+        if oi is not None:
+            # theirs new rows go after the last row both have
+            pos = oi + 1
+            continue
+        bi = bindex.get(k, None)
+        if bi is None:
+            inserts.append((pos, t, 'insert'))
+        elif t != base[bi]:
+            # ours deleted a row theirs changed
+            inserts.append((pos, t, 'conflict'))
+    inserts.sort(key=lambda x: x[0])
+    return cells, deleted, inserts
@@ -0,0 +1,314 @@
+
+import base64, gzip, hashlib, http.client, json, os, time
+from threading import Condition, Lock, Thread
+from urllib.parse import quote, urlsplit
+from diffted.core.store import LRUCache
+from diffted.core.snapshots import readPickle, writePickle
+
+# A small GitHub REST client over http.client. Connections are kept open and
+# reused per host, GETs are made conditional on the ETag of a cached copy,
+# and files too big for the contents API are fetched through the blob API.
+# DIFFTED_GITHUB_API points it at another server, such as a local mock.
+
+apiUrl = os.environ.get("DIFFTED_GITHUB_API", "https://api.github.com")
+
+# the blob id of each file as last read or pushed, by (user, repo, branch, path)
+loadedShas = {}
+
+class HttpError(IOError):
+    def __init__(self, status, reason, url):
+        super(HttpError, self).__init__("{} {} for {}".format(status, reason, url))
+        self.status = status
+
+
+class ConnectionPool(object):
+    # Idle keep-alive connections by (scheme, host)
+    def __init__(self, timeout=30):
+        self.idle = {}
+        self.lock = Lock()
+        self.timeout = timeout
+
+    def get(self, scheme, netloc):
+        with self.lock:
+            conns = self.idle.get((scheme, netloc), None)
+            if conns:
+                return conns.pop()
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.timeout)
+
+    def put(self, scheme, netloc, conn):
+        with self.lock:
+            self.idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for c in conns:
+                    c.close()
+            self.idle = {}
+
+pool = ConnectionPool()
+
+
+class ETagCache(object):
+    # (etag, body) of responses by url, in memory and optionally on disk
+    def __init__(self, cachedir=None, size=64):
+        self.entries = LRUCache(size)
+        self.cachedir = cachedir
+        self.lock = Lock()
+
+    def _path(self, url):
+        return os.path.join(self.cachedir, "github", hashlib.sha1(url.encode('utf-8')).hexdigest() + ".pickle")
+
+    def get(self, url):
+        with self.lock:
+            res = self.entries.get(url)
+        if res is None and self.cachedir is not None:
+            res = readPickle(self._path(url))
+            if res is not None:
+                with self.lock:
+                    self.entries.put(url, res)
+        return res
+
+    def put(self, url, etag, body):
+        with self.lock:
+            self.entries.put(url, (etag, body))
+        if self.cachedir is not None:
+            writePickle(self._path(url), (etag, body))
+
+caches = {}
+
+def etagCache(cachedir=None):
+    res = caches.get(cachedir, None)
+    if res is None:
+        res = caches[cachedir] = ETagCache(cachedir)
+    return res
+
+
+class GithubClient(object):
+    retries = 2
+
+    def __init__(self, username=None, password=None, baseUrl=None, cachedir=None):
+        self.baseUrl = (baseUrl or apiUrl).rstrip("/")
+        parts = urlsplit(self.baseUrl)
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path
+        self.cache = etagCache(cachedir)
+        self.headers = {'Accept': "application/vnd.github+json", 'User-Agent': "diffted",
+                        'Accept-Encoding': "gzip"}
+        if password:
+            auth = base64.b64encode("{}:{}".format(username, password).encode('utf-8')).decode('ascii')
+            self.headers['Authorization'] = "Basic " + auth
+        elif username:
+            # a lone username is taken to be an API token
+            self.headers['Authorization'] = "token " + username
+
+    def request(self, method, path, body=None, headers=None, cached=False):
+        # (status, response headers, body bytes). GETs with cached set are
+        # answered from the cache when the server says nothing has changed.
+        url = self.prefix + path
+        hdrs = dict(self.headers)
+        hdrs.update(headers or {})
+        old = None
+        if cached and method == 'GET':
+            old = self.cache.get(url + hdrs['Accept'])
+            if old is not None:
+                hdrs['If-None-Match'] = old[0]
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+            hdrs['Content-Type'] = "application/json"
+        for attempt in range(self.retries + 1):
+            conn = pool.get(self.scheme, self.netloc)
+            reused = conn.sock is not None
+            try:
+                conn.request(method, url, body=body, headers=hdrs)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # a kept alive connection the server has since closed; only
+                # GETs are retried on a fresh one
+                if attempt == self.retries or not (reused or method == 'GET'):
+                    raise
+                continue
+            if resp.will_close:
+                conn.close()
+            else:
+                pool.put(self.scheme, self.netloc, conn)
+            break
+        if resp.getheader('Content-Encoding', '') == 'gzip':
+            data = gzip.decompress(data)
+        if resp.status == 304 and old is not None:
+            return (200, resp.getheaders(), old[1])
+        if resp.status >= 400:
+            raise HttpError(resp.status, resp.reason, url)
+        etag = resp.getheader('ETag', None)
+        if cached and method == 'GET' and etag is not None:
+            self.cache.put(url + hdrs['Accept'], etag, data)
+        return (resp.status, resp.getheaders(), data)
+
+    def json(self, method, path, body=None, cached=False):
+        status, headers, data = self.request(method, path, body, cached=cached)
+        return json.loads(data.decode('utf-8')) if len(data) else None
+
+    def repoPath(self, user, repo):
+        return "/repos/{}/{}".format(quote(user, safe=''), quote(repo, safe=''))
+
+    def getFile(self, user, repo, ref, path):
+        # the contents of path at ref as bytes
+        info = self.json('GET', "{}/contents/{}?ref={}".format(self.repoPath(user, repo), quote(path),
+                                                               quote(ref, safe='')), cached=True)
+        loadedShas[(user, repo, ref, path)] = info['sha']
+        if info.get('encoding', None) == 'base64' and info.get('content', ''):
+            return base64.b64decode(info['content'])
+        # files over the contents API's size limit come from the blob API
+        return self.getBlob(user, repo, info['sha'])
+
+    def getBlob(self, user, repo, sha):
+        path = "{}/git/blobs/{}".format(self.repoPath(user, repo), sha)
+        accept = "application/vnd.github.raw"
+        # a blob never changes, so a cached copy needs no asking
+        old = self.cache.get(self.prefix + path + accept)
+        if old is not None:
+            return old[1]
+        status, headers, data = self.request('GET', path, headers={'Accept': accept}, cached=True)
+        return data
+
+
+class CommitConflict(IOError):
+    pass
+
+class CommitQueue(object):
+    # Saves to GitHub are queued and pushed from a background thread. Saves
+    # to the same branch within window seconds of each other go in one
+    # commit, and a later save of a file replaces an earlier one still
+    # waiting. A file that changed on GitHub since it was read is not
+    # overwritten; the push is reported as a conflict instead.
+    window = 2.0
+    attempts = 4
+
+    def __init__(self, status=None):
+        self.status = status        # called with a message, from the worker thread
+        self.pending = {}           # (user, repo, branch) -> {path: (content, expected, message, client)}
+        self.cond = Condition()
+        self.lastAdd = 0
+        self.busy = False
+        self.thread = None
+
+    def add(self, client, user, repo, branch, path, content, message=None):
+        # content is bytes or text; the file must still be as last read
+        # through loadedShas for the push to go ahead
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        expected = loadedShas.get((user, repo, branch, path), None)
+        with self.cond:
+            self.pending.setdefault((user, repo, branch), {})[path] = (content, expected, message, client)
+            self.lastAdd = time.monotonic()
+            # the worker clears self.thread, under the lock, as it finishes
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="CommitQueue", daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _report(self, msg):
+        if self.status is not None:
+            self.status(msg)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if not len(self.pending):
+                        self.thread = None
+                        self.cond.notify_all()
+                        return
+                    wait = self.lastAdd + self.window - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+                batches = self.pending
+                self.pending = {}
+                self.busy = True
+            try:
+                for (user, repo, branch), files in batches.items():
+                    self._push(user, repo, branch, files)
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def _push(self, user, repo, branch, files):
+        names = ", ".join(sorted(files))
+        for attempt in range(self.attempts):
+            try:
+                sha = self.commit(user, repo, branch, files)
+            except CommitConflict as e:
+                self._report("Not pushed, {}".format(e))
+                return
+            except (HttpError, OSError) as e:
+                # a branch that moved under us is a 422, so go round again on
+                # top of its new head; server and network errors are retried too
+                status = getattr(e, 'status', 500)
+                if attempt == self.attempts - 1 or (status < 500 and status != 422):
+                    self._report("Failed to push {}: {}".format(names, e))
+                    return
+                time.sleep(2 ** attempt * 0.5)
+                continue
+            except Exception as e:
+                # an answer from the server not as expected
+                self._report("Failed to push {}: {}".format(names, e))
+                return
+            self._report("Pushed {} to {} as {}".format(names, branch, sha[:10]))
+            return
+
+    def commit(self, user, repo, branch, files):
+        # one commit of all files on top of the branch, fast forwarding the
+        # branch to it. Returns the new commit's id.
+        client = next(iter(files.values()))[3]
+        base = client.repoPath(user, repo) + "/git"
+        head = client.json('GET', "{}/ref/heads/{}".format(base, quote(branch)))['object']['sha']
+        for path, (content, expected, message, c) in files.items():
+            if expected is None:
+                continue
+            try:
+                info = client.json('GET', "{}/contents/{}?ref={}".format(client.repoPath(user, repo), quote(path), head),
+                                   cached=True)
+                current = info['sha']
+            except HttpError as e:
+                if e.status != 404:
+                    raise
+                current = None
+            if current != expected:
+                raise CommitConflict("{} has changed on {} since it was read".format(path, branch))
+        tree = client.json('GET', "{}/commits/{}".format(base, head))['tree']['sha']
+        entries = [{'path': path, 'mode': "100644", 'type': "blob", 'content': v[0].decode('utf-8')}
+                        for path, v in sorted(files.items())]
+        newTree = client.json('POST', base + "/trees", {'base_tree': tree, 'tree': entries})['sha']
+        messages = []
+        for v in files.values():
+            if v[2] and v[2] not in messages:
+                messages.append(v[2])
+        commit = client.json('POST', base + "/commits", {'message': "\n\n".join(messages) or "Committed from diffted",
+                                                         'tree': newTree, 'parents': [head]})['sha']
+        # not forced, so a branch that moved since we read head is refused
+        client.json('PATCH', "{}/refs/heads/{}".format(base, quote(branch)), {'sha': commit, 'force': False})
+        for path, v in files.items():
+            loadedShas[(user, repo, branch, path)] = hashlib.sha1(b"blob %d\0" % len(v[0]) + v[0]).hexdigest()
+        return commit
+
+    def flush(self, timeout=None):
+        # push anything waiting now, and wait for it to be done
+        with self.cond:
+            self.lastAdd = 0
+            self.cond.notify_all()
+            end = None if timeout is None else time.monotonic() + timeout
+            while len(self.pending) or self.busy:
+                left = None if end is None else end - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self.cond.wait(left)
+        return True
+
+commitQueue = CommitQueue()
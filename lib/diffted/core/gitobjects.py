@@ -0,0 +1,548 @@
+
+import mmap, os, re, struct, zlib
+from collections import deque
+from binascii import hexlify, unhexlify
+from diffted.core.store import LRUCache
+
+# Reads refs, reflogs and objects straight from a repository's .git
+# directory, so that looking up a file at a revision needs no git process.
+# Anything this does not understand comes back as None, and callers can
+# then ask git itself.
+
+typeNames = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+def readFile(fname):
+    try:
+        with open(fname, 'rb') as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+def findGitDir(path):
+    # (git dir, work tree) for the repository holding path, or None
+    path = os.path.abspath(path)
+    while True:
+        dotgit = os.path.join(path, ".git")
+        if os.path.isdir(dotgit):
+            return (dotgit, path)
+        if os.path.isfile(dotgit):
+            # worktrees and submodules have a file pointing at the git dir
+            s = readFile(dotgit) or b""
+            m = re.match(rb"gitdir:\s*(.*?)\s*$", s)
+            if m is None:
+                return None
+            return (os.path.join(path, os.fsdecode(m.group(1))), path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def applyDelta(base, delta):
+    def varint(pos):
+        res = shift = 0
+        while True:
+            c = delta[pos]
+            pos += 1
+            res |= (c & 0x7f) << shift
+            shift += 7
+            if not c & 0x80:
+                return res, pos
+    srcSize, pos = varint(0)
+    dstSize, pos = varint(pos)
+    if srcSize != len(base):
+        return None
+    res = bytearray()
+    end = len(delta)
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy a range of the base
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            res += base[offset:offset + (size or 0x10000)]
+        elif op:
+            res += delta[pos:pos + op]
+            pos += op
+        else:
+            return None
+    if len(res) != dstSize:
+        return None
+    return bytes(res)
+
+
+class Pack(object):
+    # A packfile and its index, both memory mapped
+    def __init__(self, idxName, packName):
+        self.idxFh = open(idxName, 'rb')
+        self.packFh = open(packName, 'rb')
+        self.idx = mmap.mmap(self.idxFh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.pack = mmap.mmap(self.packFh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.idx[:4] == b"\377tOc":
+            self.version = struct.unpack(">I", self.idx[4:8])[0]
+            fanout = 8
+        else:
+            self.version = 1
+            fanout = 0
+        self.fanout = struct.unpack(">256I", self.idx[fanout:fanout + 1024])
+        self.num = self.fanout[255]
+        if self.version == 2:
+            self.shas = fanout + 1024
+            self.offsets = self.shas + 24 * self.num
+            self.largeOffsets = self.offsets + 4 * self.num
+        elif self.version != 1:
+            raise ValueError("unknown pack index version {}".format(self.version))
+
+    def _sha(self, i):
+        if self.version == 2:
+            return self.idx[self.shas + 20 * i:self.shas + 20 * i + 20]
+        p = 1024 + 24 * i + 4
+        return self.idx[p:p + 20]
+
+    def _offset(self, i):
+        if self.version == 1:
+            return struct.unpack(">I", self.idx[1024 + 24 * i:1028 + 24 * i])[0]
+        res = struct.unpack(">I", self.idx[self.offsets + 4 * i:self.offsets + 4 * i + 4])[0]
+        if res & 0x80000000:
+            p = self.largeOffsets + 8 * (res & 0x7fffffff)
+            res = struct.unpack(">Q", self.idx[p:p + 8])[0]
+        return res
+
+    def find(self, sha):
+        # the offset in the pack of the binary object id sha, or None
+        first = sha[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            s = self._sha(mid)
+            if s < sha:
+                lo = mid + 1
+            elif s > sha:
+                hi = mid
+            else:
+                return self._offset(mid)
+        return None
+
+    def header(self, offset):
+        # (type, size, offset of the data)
+        c = self.pack[offset]
+        offset += 1
+        kind = (c >> 4) & 7
+        size = c & 0x0f
+        shift = 4
+        while c & 0x80:
+            c = self.pack[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return (kind, size, offset)
+
+    def inflate(self, offset, size):
+        d = zlib.decompressobj()
+        res = []
+        chunk = max(size + 64, 4096)
+        while not d.eof and offset < len(self.pack):
+            res.append(d.decompress(self.pack[offset:offset + chunk]))
+            offset += chunk
+        return b"".join(res)
+
+    def close(self):
+        self.idx.close()
+        self.pack.close()
+        self.idxFh.close()
+        self.packFh.close()
+
+
+class Repository(object):
+    # Read only access to a repository's refs and objects. Use open(), which
+    # returns None for repositories this cannot read.
+    def __init__(self, gitdir, worktree):
+        self.gitdir = gitdir
+        self.worktree = worktree
+        common = readFile(os.path.join(gitdir, "commondir"))
+        self.commondir = os.path.normpath(os.path.join(gitdir, os.fsdecode(common.strip()))) \
+                            if common else gitdir
+        self.objdirs = [os.path.join(self.commondir, "objects")]
+        alternates = readFile(os.path.join(self.objdirs[0], "info", "alternates")) or b""
+        for l in alternates.splitlines():
+            l = os.fsdecode(l.strip())
+            if l and not l.startswith("#"):
+                self.objdirs.append(os.path.join(self.objdirs[0], l))
+        self.packs = None
+        self.cache = LRUCache(64)
+
+    @classmethod
+    def open(cls, path):
+        found = findGitDir(path)
+        if found is None or not os.path.isdir(found[0]):
+            return None
+        res = cls(*found)
+        config = readFile(os.path.join(res.commondir, "config")) or b""
+        # sha256 object ids, reftable and the like are left to git
+        if re.search(rb"^\s*\[extensions\]", config, re.M | re.I):
+            return None
+        return res
+
+    def prefix(self, path):
+        # the path of the directory path within the work tree, as git writes it
+        rel = os.path.relpath(os.path.realpath(path), os.path.realpath(self.worktree))
+        if rel == ".":
+            return ""
+        return rel.replace(os.sep, "/") + "/"
+
+    def _loadPacks(self):
+        self.packs = []
+        for d in self.objdirs:
+            packdir = os.path.join(d, "pack")
+            try:
+                names = sorted(os.listdir(packdir))
+            except OSError:
+                continue
+            for n in names:
+                if n.endswith(".idx") and os.path.exists(os.path.join(packdir, n[:-4] + ".pack")):
+                    try:
+                        self.packs.append(Pack(os.path.join(packdir, n), os.path.join(packdir, n[:-4] + ".pack")))
+                    except (OSError, ValueError):
+                        pass
+
+    def close(self):
+        for p in self.packs or []:
+            p.close()
+        self.packs = None
+        self.cache.clear()
+
+    # refs
+
+    def _refFile(self, name):
+        # per worktree refs such as HEAD live in the git dir, the rest are shared
+        for d in (self.gitdir, self.commondir):
+            s = readFile(os.path.join(d, name))
+            if s is not None:
+                return s.strip().decode('utf-8')
+        return None
+
+    def packedRefs(self):
+        res = {}
+        s = readFile(os.path.join(self.commondir, "packed-refs")) or b""
+        for l in s.decode('utf-8').splitlines():
+            if not l or l[0] in "#^":
+                continue
+            sha, name = l.split(" ", 1)
+            res[name] = sha
+        return res
+
+    def readRef(self, name, depth=5):
+        # the object id a ref points at, following symbolic refs, or None
+        s = self._refFile(name)
+        if s is None:
+            s = self.packedRefs().get(name, None)
+        if s is None or depth <= 0:
+            return None
+        if s.startswith("ref:"):
+            return self.readRef(s[4:].strip(), depth - 1)
+        return s if re.match(r"^[0-9a-f]{40}$", s) else None
+
+    def symbolicRef(self, name):
+        s = self._refFile(name)
+        if s is not None and s.startswith("ref:"):
+            return s[4:].strip()
+        return None
+
+    def refNames(self, prefix):
+        res = set(n for n in self.packedRefs() if n.startswith(prefix))
+        base = os.path.join(self.commondir, prefix)
+        for root, dirs, files in os.walk(base):
+            for f in files:
+                res.add(prefix + os.path.relpath(os.path.join(root, f), base).replace(os.sep, "/"))
+        return sorted(res)
+
+    def branches(self):
+        # (branch names as git branch -a lists them, the current branch)
+        head = self.symbolicRef("HEAD")
+        curr = head[11:] if head is not None and head.startswith("refs/heads/") else "HEAD"
+        res = [n[11:] for n in self.refNames("refs/heads/")]
+        if curr == "HEAD":
+            res.insert(0, curr)
+        for n in self.refNames("refs/remotes/"):
+            target = self.symbolicRef(n)
+            if target is not None:
+                res.append("{} -> {}".format(n[5:], target[13:]))
+            else:
+                res.append(n[5:])
+        return (res, curr)
+
+    def fullRef(self, name):
+        # the ref a short name means, in git's order of preference
+        for pattern in ("{}", "refs/{}", "refs/tags/{}", "refs/heads/{}", "refs/remotes/{}", "refs/remotes/{}/HEAD"):
+            ref = pattern.format(name)
+            if self.readRef(ref) is not None:
+                return ref
+        return None
+
+    def reflog(self, ref, n):
+        # the nth previous value of ref, from its reflog
+        s = readFile(os.path.join(self.gitdir, "logs", ref)) or readFile(os.path.join(self.commondir, "logs", ref))
+        if s is None:
+            return None
+        lines = s.splitlines()
+        if n < len(lines):
+            return lines[-1 - n].split(b" ", 2)[1].decode('ascii')
+        if n == len(lines) and len(lines):
+            return lines[0].split(b" ", 1)[0].decode('ascii')
+        return None
+
+    revRe = re.compile(r"^(.*?)(?:@\{(\d+)\})?((?:[~^]\d*)*)$")
+
+    def resolve(self, rev):
+        # the commit id rev names, or None. Handles names, full object ids,
+        # name@{n} and trailing ~n and ^n; git is left the rest.
+        m = self.revRe.match(rev)
+        if m is None:
+            return None
+        name, num, path = m.groups()
+        if name == "":
+            name = "HEAD"
+        if re.match(r"^[0-9a-f]{40}$", name) and num is None:
+            sha = name
+        else:
+            ref = self.fullRef(name)
+            if ref is None:
+                return None
+            if num is None or num == "0":
+                sha = self.readRef(ref)
+            else:
+                sha = self.reflog(ref, int(num))
+        sha = self.peel(sha)
+        for op, count in re.findall(r"([~^])(\d*)", path):
+            if sha is None:
+                return None
+            count = int(count) if count else 1
+            if op == "~":
+                for i in range(count):
+                    sha = self.parent(sha, 1)
+                    if sha is None:
+                        break
+            elif count:
+                sha = self.parent(sha, count)
+        return sha
+
+    # objects
+
+    def _loose(self, sha):
+        for d in self.objdirs:
+            s = readFile(os.path.join(d, sha[:2], sha[2:]))
+            if s is not None:
+                try:
+                    s = zlib.decompress(s)
+                except zlib.error:
+                    return None
+                head, data = s.split(b"\0", 1)
+                return (head.split(b" ", 1)[0].decode('ascii'), data)
+        return None
+
+    def _packed(self, pack, offset):
+        res = self.cache.get((id(pack), offset))
+        if res is not None:
+            return res
+        kind, size, pos = pack.header(offset)
+        if kind == OFS_DELTA:
+            c = pack.pack[pos]
+            pos += 1
+            back = c & 0x7f
+            while c & 0x80:
+                c = pack.pack[pos]
+                pos += 1
+                back = ((back + 1) << 7) | (c & 0x7f)
+            base = self._packed(pack, offset - back)
+        elif kind == REF_DELTA:
+            base = self.object(hexlify(pack.pack[pos:pos + 20]).decode('ascii'))
+            pos += 20
+        else:
+            res = (typeNames.get(kind), pack.inflate(pos, size))
+            if res[0] != 'blob':
+                self.cache.put((id(pack), offset), res)
+            return res
+        if base is None:
+            return None
+        data = applyDelta(base[1], pack.inflate(pos, size))
+        if data is None:
+            return None
+        res = (base[0], data)
+        # keep delta bases, since neighbouring objects share them
+        self.cache.put((id(pack), offset), res)
+        return res
+
+    def object(self, sha):
+        # (type, data) for the hex object id sha, or None
+        if sha is None:
+            return None
+        if self.packs is None:
+            self._loadPacks()
+        binsha = unhexlify(sha)
+        for p in self.packs:
+            offset = p.find(binsha)
+            if offset is not None:
+                return self._packed(p, offset)
+        res = self._loose(sha)
+        if res is None:
+            # a repack may have made new packs since we looked
+            self.close()
+            self._loadPacks()
+            for p in self.packs:
+                offset = p.find(binsha)
+                if offset is not None:
+                    return self._packed(p, offset)
+        return res
+
+    def peel(self, sha):
+        # follow annotated tags to what they tag
+        for i in range(10):
+            obj = self.object(sha)
+            if obj is None or obj[0] != 'tag':
+                return sha
+            sha = obj[1].split(b"\n", 1)[0].split(b" ")[1].decode('ascii')
+        return None
+
+    def _commitField(self, sha, field):
+        obj = self.object(sha)
+        if obj is None or obj[0] != 'commit':
+            return []
+        res = []
+        for l in obj[1].split(b"\n\n", 1)[0].split(b"\n"):
+            if l.startswith(field + b" "):
+                res.append(l[len(field) + 1:].decode('ascii'))
+        return res
+
+    def parent(self, sha, n=1):
+        parents = self._commitField(sha, b"parent")
+        return parents[n - 1] if 0 < n <= len(parents) else None
+
+    def treeEntry(self, tree, name):
+        # the object id of name in tree, or None
+        obj = self.object(tree)
+        if obj is None or obj[0] != 'tree':
+            return None
+        data = obj[1]
+        key = name.encode('utf-8')
+        pos = 0
+        end = len(data)
+        # entries are "mode name\0" and a 20 byte id
+        while pos < end:
+            nul = data.find(b"\0", pos)
+            if nul < 0:
+                return None
+            if data[data.find(b" ", pos) + 1:nul] == key:
+                return hexlify(data[nul + 1:nul + 21]).decode('ascii')
+            pos = nul + 21
+        return None
+
+    def pathId(self, tree, path):
+        # the object id of path within tree, or None
+        sha = tree
+        for part in path.split("/"):
+            if part:
+                sha = self.treeEntry(sha, part)
+                if sha is None:
+                    return None
+        return sha
+
+    def blobId(self, rev, path):
+        # the object id of the blob at path, relative to the top of the work
+        # tree, at rev
+        commit = self.resolve(rev)
+        trees = self._commitField(commit, b"tree") if commit is not None else []
+        if not len(trees):
+            return None
+        return self.pathId(trees[0], path)
+
+    def commitInfo(self, sha):
+        # (tree, parents, author, time, summary) of a commit, or None
+        obj = self.object(sha)
+        if obj is None or obj[0] != 'commit':
+            return None
+        head, _, message = obj[1].partition(b"\n\n")
+        tree = None
+        parents = []
+        author = ""
+        when = 0
+        for l in head.split(b"\n"):
+            k, _, v = l.partition(b" ")
+            if k == b"tree":
+                tree = v.decode('ascii')
+            elif k == b"parent":
+                parents.append(v.decode('ascii'))
+            elif k == b"author":
+                v = v.decode('utf-8', 'replace')
+                author = v[:v.rfind(" <")]
+                try:
+                    when = int(v.rsplit(" ", 2)[1])
+                except (IndexError, ValueError):
+                    pass
+        summary = message.split(b"\n", 1)[0].decode('utf-8', 'replace')
+        return (tree, parents, author, when, summary)
+
+    def walk(self, rev, path, stop=None):
+        # (commit, blob id of path, author, time, summary) for each commit
+        # back from rev along first parents, newest first, ending before stop.
+        # None if stop is given but never reached.
+        res = []
+        sha = self.resolve(rev)
+        while sha is not None and sha != stop:
+            info = self.commitInfo(sha)
+            if info is None:
+                break
+            res.append((sha, self.pathId(info[0], path)) + info[2:])
+            sha = info[1][0] if len(info[1]) else None
+        if stop is not None and sha != stop:
+            return None
+        return res
+
+    def blob(self, sha):
+        obj = self.object(sha)
+        if obj is None or obj[0] != 'blob':
+            return None
+        return obj[1]
+
+    def fileAt(self, rev, path):
+        return self.blob(self.blobId(rev, path))
+
+    def mergeBase(self, a, b):
+        # the nearest common ancestor of two revisions, or None
+        a = self.resolve(a)
+        b = self.resolve(b)
+        if a is None or b is None:
+            return None
+        ancestors = set()
+        todo = [a]
+        while len(todo):
+            sha = todo.pop()
+            if sha in ancestors:
+                continue
+            ancestors.add(sha)
+            info = self.commitInfo(sha)
+            if info is not None:
+                todo.extend(info[1])
+        seen = set()
+        queue = deque([b])
+        while len(queue):
+            sha = queue.popleft()
+            if sha in ancestors:
+                return sha
+            if sha in seen:
+                continue
+            seen.add(sha)
+            info = self.commitInfo(sha)
+            if info is not None:
+                queue.extend(info[1])
+        return None
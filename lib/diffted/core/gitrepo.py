@@ -0,0 +1,234 @@
+
+import subprocess
+from subprocess import CalledProcessError, DEVNULL, PIPE
+from threading import Lock
+from diffted.core.store import LRUCache
+from diffted.core import gitobjects
+import atexit, os, re
+
+# Access to the git history of data files, kept free of Qt so that it can be
+# used without a GUI
+
+def _popenArgs(kw):
+    if hasattr(subprocess, 'STARTUPINFO'):
+        si = subprocess.STARTUPINFO()
+        si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        kw['startupinfo'] = si
+        kw['env'] = os.environ
+    return kw
+
+def check_output(cmd, **kw):
+    # cmd is an argument list, never passed through a shell
+    kw['stdin'] = PIPE
+    kw['stderr'] = DEVNULL
+    return subprocess.check_output(cmd, **_popenArgs(kw))
+
+def reldir(fname):
+    dirname = os.path.dirname(fname) or '.'
+    return os.path.relpath(dirname, os.getcwd())
+
+def gitTestFile(fname):
+    path = reldir(fname)
+    if re.match(r"^http[s]?://", fname):
+        return False
+    try:
+        res = check_output(["git", "-C", path, "ls-files", "--error-unmatch", "--", os.path.basename(fname)])
+    except FileNotFoundError:
+        res = False
+    except CalledProcessError:
+        res = False
+    else:
+        res = True
+    return res
+
+
+class CatFile(object):
+    # A long running git cat-file --batch-check and --batch pair for one
+    # repository. Revisions are resolved to object ids over the first, and
+    # blobs are read over the second and kept by object id.
+    def __init__(self, path, cacheSize=16):
+        self.path = path
+        self.procs = {}
+        self.blobs = LRUCache(cacheSize)
+        self.lock = Lock()
+
+    def _proc(self, mode):
+        proc = self.procs.get(mode, None)
+        if proc is None or proc.poll() is not None:
+            proc = subprocess.Popen(["git", "-C", self.path, "cat-file", mode],
+                                    **_popenArgs({'stdin': PIPE, 'stdout': PIPE, 'stderr': DEVNULL}))
+            self.procs[mode] = proc
+        return proc
+
+    def _request(self, mode, name):
+        # (object id, type, size, proc) for name, or None if git has no such object
+        if "\n" in name:
+            return None
+        for attempt in range(2):
+            proc = self._proc(mode)
+            try:
+                proc.stdin.write(name.encode('utf-8') + b"\n")
+                proc.stdin.flush()
+                line = proc.stdout.readline().decode('utf-8')
+            except OSError:
+                line = ""
+            if len(line):
+                break
+            # git went away, start it again and ask once more
+            proc.kill()
+            proc.wait()
+            self.procs.pop(mode, None)
+        # "name missing" may hold spaces from the name, a found object never does
+        header = line.split()
+        if len(header) != 3 or line.rstrip().endswith((" missing", " ambiguous")):
+            return None
+        return (header[0], header[1], int(header[2]), proc)
+
+    def resolve(self, name):
+        # (object id, type, size) of name, or None
+        with self.lock:
+            res = self._request("--batch-check", name)
+        return res[:3] if res is not None else None
+
+    def read(self, name):
+        # The contents of name as bytes, or None
+        with self.lock:
+            info = self._request("--batch-check", name)
+            if info is None:
+                return None
+            res = self.blobs.get(info[0])
+            if res is None:
+                # ask by object id so that what we read is what we resolved
+                data = self._request("--batch", info[0])
+                if data is None:
+                    return None
+                res = data[3].stdout.read(data[2])
+                data[3].stdout.read(1)
+                self.blobs.put(info[0], res)
+        return res
+
+    def close(self):
+        with self.lock:
+            for proc in self.procs.values():
+                try:
+                    proc.stdin.close()
+                    proc.wait(timeout=1)
+                except (OSError, subprocess.TimeoutExpired):
+                    proc.kill()
+            self.procs = {}
+            self.blobs.clear()
+
+catFiles = {}
+
+def catFile(path):
+    # the shared CatFile for the repository holding path
+    top = os.path.realpath(path)
+    res = catFiles.get(top, None)
+    if res is None:
+        res = catFiles[top] = CatFile(top)
+    return res
+
+@atexit.register
+def closeCatFiles():
+    for c in catFiles.values():
+        c.close()
+    catFiles.clear()
+
+
+class GitSupport():
+    # Reads the repository's files directly when it can, and otherwise over
+    # a git cat-file process
+    def __init__(self, fname, direct=True):
+        self.path = reldir(fname)
+        self.fname = os.path.basename(fname)
+        self.repo = gitobjects.Repository.open(self.path) if direct else None
+        self._cat = None
+        if self.repo is not None:
+            self.top = self.repo.worktree
+            self.relname = self.repo.prefix(self.path) + self.fname
+            self.branches, self.currbranch = self.repo.branches()
+            return
+        self.top, prefix = check_output(["git", "-C", self.path, "rev-parse", "--show-toplevel",
+                                         "--show-prefix"]).decode('utf-8').split("\n")[:2]
+        self.relname = prefix + self.fname
+        res = check_output(["git", "-C", self.path, "branch", "-a"]).decode('utf-8')
+        self.branches = []
+        for x in res.splitlines():
+            b = x[2:].strip()
+            if x[0] == "*":
+                self.currbranch = b
+            self.branches.append(b)
+
+    @property
+    def cat(self):
+        if self._cat is None:
+            self._cat = catFile(self.top)
+        return self._cat
+
+    def revision(self, branch, modifier):
+        if modifier is None or modifier == "":
+            return branch
+        return branch + "@{" + modifier + "}"
+
+    def blobat(self, branch, modifier):
+        # the object id of the file's blob at a revision, or None
+        rev = self.revision(branch, modifier)
+        res = None
+        if self.repo is not None:
+            res = self.repo.blobId(rev, self.relname)
+        if res is None:
+            info = self.cat.resolve("{}:{}".format(rev, self.relname))
+            if info is not None and info[1] == 'blob':
+                res = info[0]
+        return res
+
+    def blobText(self, sha):
+        res = None
+        if self.repo is not None:
+            res = self.repo.blob(sha)
+        if res is None:
+            res = self.cat.read(sha)
+        return res.decode('utf-8') if res is not None else None
+
+    def walk(self, branch, modifier=None, stop=None):
+        # (commit, blob id, author, time, summary) for each commit back from
+        # a revision along first parents, newest first, ending before stop.
+        # None if stop is given but never reached.
+        rev = self.revision(branch, modifier)
+        if self.repo is not None and self.repo.resolve(rev) is not None:
+            return self.repo.walk(rev, self.relname, stop)
+        try:
+            out = check_output(["git", "-C", self.top, "log", "--first-parent",
+                                "--format=%H%x00%an%x00%at%x00%s", rev, "--"])
+        except CalledProcessError:
+            return []
+        res = []
+        for l in out.decode('utf-8', 'replace').splitlines():
+            sha, author, when, summary = l.split("\0", 3)
+            if sha == stop:
+                return res
+            info = self.cat.resolve("{}:{}".format(sha, self.relname))
+            res.append((sha, info[0] if info is not None else None, author, int(when), summary))
+        return res if stop is None else None
+
+    def mergeBase(self, ours, theirs):
+        # the commit to take as the base of a merge of two revisions, or None
+        if self.repo is not None:
+            res = self.repo.mergeBase(ours, theirs)
+            if res is not None:
+                return res
+        try:
+            return check_output(["git", "-C", self.top, "merge-base", ours, theirs]).decode('ascii').strip()
+        except CalledProcessError:
+            return None
+
+    def writeBlob(self, sha, fh):
+        # streams a blob into the open binary file fh, by way of git itself,
+        # so that it is never held in memory
+        fh.flush()
+        subprocess.check_call(["git", "-C", self.top, "cat-file", "blob", sha],
+                              **_popenArgs({'stdin': DEVNULL, 'stdout': fh, 'stderr': DEVNULL}))
+
+    def getfileat(self, branch, modifier):
+        sha = self.blobat(branch, modifier)
+        return self.blobText(sha) if sha is not None else None
@@ -0,0 +1,141 @@
+
+import hashlib, os, time
+from diffted.core.diff import diffRows, keyIndices, rowKeys
+from diffted.core.snapshots import readPickle, writePickle
+
+# Which commit last changed each cell of a data file. Each revision of the
+# file is diffed with the one before it, pairing rows by key when the config
+# has keys, and a cell keeps its commit until a later revision changes it.
+# The result for the newest commit processed is kept, so that later updates
+# only look at the commits made since.
+
+class CellHistory(object):
+    version = 1
+
+    def __init__(self, path, keys=None):
+        self.path = path
+        self.keys = keys
+        self.commits = []       # (commit, author, time, summary), oldest first
+        self.head = None        # the newest commit walked
+        self.blob = None        # the file's blob at head
+        self.fieldnames = []
+        self.stamps = []        # per row of blob, per column, an index into commits
+        self.index = None
+
+    @classmethod
+    def cacheName(cls, cachedir, path, keys):
+        h = hashlib.sha1(repr((path, keys)).encode('utf-8')).hexdigest()
+        return os.path.join(cachedir, "history", h + ".pickle")
+
+    @classmethod
+    def load(cls, cachedir, path, keys=None):
+        res = cls(path, keys)
+        if cachedir is not None:
+            state = readPickle(cls.cacheName(cachedir, path, keys))
+            if state is not None and state.get('version', None) == cls.version:
+                for k in ('commits', 'head', 'blob', 'fieldnames', 'stamps'):
+                    setattr(res, k, state[k])
+        return res
+
+    def save(self, cachedir):
+        if cachedir is None:
+            return False
+        return writePickle(self.cacheName(cachedir, self.path, self.keys),
+                           {'version': self.version, 'commits': self.commits, 'head': self.head,
+                            'blob': self.blob, 'fieldnames': self.fieldnames, 'stamps': self.stamps})
+
+    def update(self, walk, snapshot, cancelled=None):
+        # walk(stop) gives the commits since stop as GitSupport.walk does, or
+        # None if stop is not among them, and
+        # snapshot(blob) the parsed (fieldnames, rows) of a blob, or None.
+        # Returns False if cancelled.
+        entries = walk(self.head)
+        if entries is None:
+            # head is no longer in the history, which was rewritten under us
+            self.__init__(self.path, self.keys)
+            entries = walk(None) or []
+        prev = snapshot(self.blob) if self.blob is not None else None
+        for sha, blob, author, when, summary in reversed(entries):
+            if cancelled is not None and cancelled():
+                # what is done so far is good up to head
+                return False
+            if blob != self.blob:
+                cur = snapshot(blob) if blob is not None else None
+                self.commits.append((sha, author, when, summary))
+                self._step(prev, cur, len(self.commits) - 1)
+                prev = cur
+                self.blob = blob
+            self.head = sha
+        self._buildIndex(prev)
+        return True
+
+    def _step(self, prev, cur, ci):
+        if cur is None:
+            self.fieldnames = []
+            self.stamps = []
+            return
+        bfields, brows = cur
+        fresh = (ci,) * len(bfields)
+        if prev is None or not len(prev[1]):
+            self.fieldnames = list(bfields)
+            self.stamps = [fresh] * len(brows)
+            return
+        afields, arows = prev
+        apos = {n: i for i, n in enumerate(afields)}
+        colmap = [apos.get(n, -1) for n in bfields]
+        sameCols = afields == bfields
+        stamps = self.stamps
+        aidx = keyIndices(afields, self.keys)
+        bidx = keyIndices(bfields, self.keys)
+        if aidx is not None and bidx is not None:
+            opcodes = diffRows(arows, brows, 'key', rowKeys(arows, aidx), rowKeys(brows, bidx))
+        else:
+            opcodes = diffRows(arows, brows, 'patience')
+
+        def pair(i, j):
+            old = stamps[i]
+            a = arows[i]
+            b = brows[j]
+            return tuple(old[k] if k >= 0 and a[k] == v else ci for v, k in zip(b, colmap))
+
+        res = [fresh] * len(brows)
+        for t, astart, aend, bstart, bend in opcodes:
+            if t == 'equal':
+                if sameCols:
+                    res[bstart:bend] = stamps[astart:aend]
+                else:
+                    res[bstart:bend] = map(pair, range(astart, aend), range(bstart, bend))
+            elif t == 'replace':
+                num = min(aend - astart, bend - bstart)
+                res[bstart:bstart+num] = map(pair, range(astart, astart+num), range(bstart, bstart+num))
+        self.fieldnames = list(bfields)
+        self.stamps = res
+
+    def _buildIndex(self, snapshot):
+        # the stamps of each row by its key, or by its whole contents without keys
+        self.index = {}
+        if snapshot is None:
+            return
+        fieldnames, rows = snapshot
+        indices = keyIndices(fieldnames, self.keys)
+        keys = rowKeys(rows, indices) if indices is not None else map(tuple, rows)
+        self.index = dict(zip(keys, self.stamps))
+        self.columns = {n: i for i, n in enumerate(fieldnames)}
+
+    def cellCommit(self, row, fieldnames, col):
+        # (commit, author, time, summary) of the commit that last changed a
+        # cell of a table with the given fieldnames, or None
+        if not self.index or col >= len(fieldnames):
+            return None
+        indices = keyIndices(fieldnames, self.keys)
+        stamps = self.index.get(tuple(row[i] for i in indices) if indices is not None else tuple(row), None)
+        pos = self.columns.get(fieldnames[col], None)
+        if stamps is None or pos is None:
+            return None
+        return self.commits[stamps[pos]]
+
+    def tooltip(self, row, fieldnames, col):
+        c = self.cellCommit(row, fieldnames, col)
+        if c is None:
+            return None
+        return "{} {} {}\n{}".format(c[0][:10], c[1], time.strftime("%Y-%m-%d", time.localtime(c[2])), c[3])
@@ -0,0 +1,359 @@
+
+import csv, html, json, os, shutil, sys, tempfile
+from array import array
+from itertools import chain
+from operator import itemgetter
+from diffted.core.store import MmapStore
+from diffted.core.diff import diffRows, cellDiffs, keyIndices
+from diffted.core.rules import RuleSet
+
+# Cell level changes between two versions of a data file, without the GUI.
+# Both versions are memory mapped and only a hash of each row (and its key,
+# with keys) is held, so files larger than memory can be compared; rows are
+# parsed only where they differ. Changes are written out as they are found.
+
+fields = ('file', 'change', 'row', 'oldrow', 'key', 'column', 'old', 'new', 'rules')
+blockSize = 512
+
+
+def commonLength(a, b, backwards=False):
+    # how many leading (or trailing) items a and b share, found by comparing
+    # ever larger slices
+    most = min(len(a), len(b))
+    def same(n):
+        if backwards:
+            return a[len(a)-n:] == b[len(b)-n:]
+        return a[:n] == b[:n]
+    lo, hi = 0, 1
+    while hi <= most and same(hi):
+        lo, hi = hi, hi * 2
+    hi = min(hi, most + 1)
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if same(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+class Table(object):
+    # A data file, as an MmapStore unless it is empty
+    def __init__(self, fname):
+        self.fh = open(fname, 'rb')
+        self.store = None
+        self.fieldnames = []
+        if os.fstat(self.fh.fileno()).st_size:
+            self.store = MmapStore(self.fh)
+            self.fieldnames = self.store.fieldnames
+
+    def __len__(self):
+        return len(self.store) if self.store is not None else 0
+
+    def row(self, i):
+        return self.store.row(i)
+
+    def text(self, i):
+        # the record as it is in the file
+        offsets = self.store.offsets
+        return self.store.mmap[offsets[i]:offsets[i+1]].decode('utf-8').rstrip("\r\n")
+
+    def hashes(self, fieldnames=None):
+        # a hash per row, of the row's bytes, or of its cells rearranged to
+        # fieldnames if given. Both sides of a diff must be hashed alike.
+        if self.store is None:
+            return array('q')
+        if fieldnames is None:
+            # rows only differing in their line ending pair off as replaced
+            # rows with no changed cells, and are left out
+            offsets = self.store.offsets
+            return array('q', map(hash, map(self.store.mmap.__getitem__, map(slice, offsets[:-1], offsets[1:]))))
+        getter = self.remapper(fieldnames)
+        return array('q', (hash(getter(r)) for r in self.store.rows()))
+
+    def remapper(self, fieldnames):
+        # a function giving a row's cells as a tuple in the order of fieldnames
+        pos = {n: i for i, n in enumerate(self.fieldnames)}
+        cols = [pos.get(n, -1) for n in fieldnames]
+        return lambda r: tuple(r[c] if c >= 0 else "" for c in cols)
+
+    def keys(self, indices, first, last):
+        if not len(indices):
+            return [()] * (last - first)
+        getter = itemgetter(*indices)
+        return [getter(self.store.row(i)) for i in range(first, last)]
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+        else:
+            self.fh.close()
+
+
+class Reporter(object):
+    # The changes turning old into new, as dicts of fields
+    def __init__(self, fname, old, new, config):
+        self.fname = fname
+        self.old = old
+        self.new = new
+        self.fieldnames = new.fieldnames
+        # when the columns differ, rows are compared over the columns both
+        # have, and added or dropped columns are reported on their own
+        self.sameColumns = list(old.fieldnames) == list(new.fieldnames)
+        self.columns = [n for n in new.fieldnames if n in old.fieldnames]
+        self.positions = [new.fieldnames.index(n) for n in self.columns]
+        self.keys = config.get('keys', None)
+        self.engine = config.get('diffEngine', 'sequence' if self.keys is None else 'key')
+        self.rules = RuleSet(config.get('rules', None), columnwise=False)
+        self.ruleNames = [r.config.get('name', r.source) or str(i) for i, r in enumerate(self.rules.rules)]
+        self.oldRow = old.remapper(self.columns)
+        self.newRow = new.remapper(self.columns)
+        self.oldIndices = keyIndices(old.fieldnames, self.keys)
+        self.newIndices = keyIndices(new.fieldnames, self.keys)
+
+    def opcodes(self):
+        columns = None if self.sameColumns else self.columns
+        a = self.old.hashes(columns)
+        b = self.new.hashes(columns)
+        # only what lies between the rows both start and end with is diffed
+        head = commonLength(a, b)
+        tail = commonLength(a[head:], b[head:], backwards=True)
+        aend = len(a) - tail
+        bend = len(b) - tail
+        engine = self.engine
+        akeys = bkeys = None
+        if engine == 'key':
+            if self.oldIndices is None or self.newIndices is None:
+                engine = 'patience'
+            else:
+                akeys = self.old.keys(self.oldIndices, head, aend)
+                bkeys = self.new.keys(self.newIndices, head, bend)
+        return [(t, i1 + head, i2 + head, j1 + head, j2 + head)
+                    for t, i1, i2, j1, j2 in diffRows(a[head:aend], b[head:bend], engine, akeys, bkeys)]
+
+    def _key(self, row, indices):
+        if indices is None:
+            return ""
+        return ", ".join(row[i] for i in indices)
+
+    def _rowDict(self, j):
+        if j < 0 or j >= len(self.new):
+            return None
+        return dict(zip(self.fieldnames, self.new.row(j)))
+
+    def _matches(self, j):
+        # the rule names matching each cell of new row j
+        if not len(self.rules):
+            return None
+        res = self.rules.evalRow(self._rowDict(j), self._rowDict(j-1), self._rowDict(j+1), self.fieldnames)
+        return [[self.ruleNames[i] for i in m] for m in res]
+
+    def _entry(self, change, j, i, key, column="", old="", new="", rules=None):
+        return {'file': self.fname, 'change': change, 'row': j + 1 if j is not None else "",
+                'oldrow': i + 1 if i is not None else "", 'key': key, 'column': column,
+                'old': old, 'new': new, 'rules': rules or []}
+
+    def _deleted(self, i):
+        return self._entry('delete', None, i, self._key(self.old.row(i), self.oldIndices), old=self.old.text(i))
+
+    def _inserted(self, j):
+        matches = self._matches(j)
+        rules = sorted(set(chain.from_iterable(matches))) if matches is not None else None
+        return self._entry('insert', j, None, self._key(self.new.row(j), self.newIndices),
+                           new=self.new.text(j), rules=rules)
+
+    def changes(self):
+        for n in self.fieldnames:
+            if n not in self.columns:
+                yield self._entry('insertcolumn', None, None, "", column=n)
+        for n in self.old.fieldnames:
+            if n not in self.fieldnames:
+                yield self._entry('deletecolumn', None, None, "", column=n)
+        for t, i1, i2, j1, j2 in self.opcodes():
+            if t == 'equal':
+                continue
+            num = min(i2 - i1, j2 - j1) if t == 'replace' else 0
+            # paired rows are compared a block at a time
+            for start in range(0, num, blockSize):
+                end = min(start + blockSize, num)
+                arows = [self.oldRow(self.old.row(i)) for i in range(i1 + start, i1 + end)]
+                nrows = [self.new.row(j) for j in range(j1 + start, j1 + end)]
+                brows = list(map(self.newRow, nrows))
+                for k, cells in enumerate(cellDiffs(arows, brows)):
+                    if not len(cells):
+                        # the same cells, written differently
+                        continue
+                    i = i1 + start + k
+                    j = j1 + start + k
+                    matches = self._matches(j)
+                    key = self._key(nrows[k], self.newIndices)
+                    for c, tag in cells:
+                        yield self._entry('replace', j, i, key, self.columns[c], arows[k][c], brows[k][c],
+                                          matches[self.positions[c]] if matches is not None else None)
+            for i in range(i1 + num, i2):
+                yield self._deleted(i)
+            for j in range(j1 + num, j2):
+                yield self._inserted(j)
+
+
+class JsonWriter(object):
+    # one JSON object per line
+    def __init__(self, fh):
+        self.fh = fh
+
+    def begin(self):
+        pass
+
+    def write(self, entry):
+        self.fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def end(self):
+        pass
+
+
+class CsvWriter(JsonWriter):
+    def __init__(self, fh):
+        self.fh = fh
+        self.writer = csv.writer(fh, lineterminator="\n")
+
+    def begin(self):
+        self.writer.writerow(fields)
+
+    def write(self, entry):
+        self.writer.writerow([entry[f] if f != 'rules' else " ".join(entry[f]) for f in fields])
+
+
+class HtmlWriter(JsonWriter):
+    styles = {'replace': "#FFC0C0", 'insert': "#C0C0FF", 'delete': "#E0E0E0",
+              'insertcolumn': "#C0C0FF", 'deletecolumn': "#E0E0E0"}
+
+    def begin(self):
+        self.fh.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>diffted report</title>\n<style>\n"
+                      "table { border-collapse: collapse; } td, th { border: 1px solid #A0A0A0; padding: 2px 4px; }\n")
+        for k, v in self.styles.items():
+            self.fh.write("tr.{} td.cell {{ background-color: {}; }}\n".format(k, v))
+        self.fh.write("</style></head><body>\n<table>\n<tr>{}</tr>\n".format(
+                        "".join("<th>{}</th>".format(f) for f in fields)))
+
+    def write(self, entry):
+        cells = []
+        for f in fields:
+            v = entry[f] if f != 'rules' else " ".join(entry[f])
+            cls = ' class="cell"' if f in ('old', 'new') else ""
+            cells.append("<td{}>{}</td>".format(cls, html.escape(str(v))))
+        self.fh.write('<tr class="{}">{}</tr>\n'.format(entry['change'], "".join(cells)))
+
+    def end(self):
+        self.fh.write("</table>\n</body></html>\n")
+
+writers = {'json': JsonWriter, 'csv': CsvWriter, 'html': HtmlWriter}
+
+
+def loadConfig(fname, configName=None):
+    # (data file, config) for an input that is either a data file or a
+    # yaml config naming one
+    if fname.lower().endswith(".yaml"):
+        configName = fname
+        fname = None
+    if configName is None:
+        return fname, {}
+    import yaml
+    with open(configName, encoding="utf-8") as fh:
+        config = yaml.safe_load(fh) or {}
+    if fname is None:
+        fname = os.path.join(os.path.dirname(configName), config['datafile'])
+    return fname, config
+
+def oldVersion(fname, against=None, rev=None, gitmod=None):
+    # (Table, temporary file to remove or None) for the version to compare with
+    if against is not None:
+        return Table(against), None
+    from diffted.core.gitrepo import GitSupport
+    gs = GitSupport(fname)
+    branch = rev or gs.currbranch
+    sha = gs.blobat(branch, gitmod)
+    if sha is None:
+        raise IOError("{} is not in {}".format(fname, gs.revision(branch, gitmod)))
+    fd, tmpname = tempfile.mkstemp(prefix="diffted", suffix=".csv")
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            gs.writeBlob(sha, fh)
+        return Table(tmpname), tmpname
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+def reportFile(job, writer):
+    # writes the changes for one input, returning how many there were
+    name, configName, against, rev, gitmod = job
+    fname, config = loadConfig(name, configName)
+    old, tmpname = oldVersion(fname, against, rev, gitmod)
+    new = None
+    count = 0
+    try:
+        new = Table(fname)
+        for entry in Reporter(name, old, new, config).changes():
+            writer.write(entry)
+            count += 1
+    finally:
+        old.close()
+        if new is not None:
+            new.close()
+        if tmpname is not None:
+            os.remove(tmpname)
+    return count
+
+def runJob(args):
+    # for a worker process: the changes for one input written to a
+    # temporary file, as (temporary file, count, error)
+    job, fmt = args
+    fd, tmpname = tempfile.mkstemp(prefix="diffted", suffix="." + fmt)
+    with os.fdopen(fd, 'w', encoding="utf-8", newline="") as fh:
+        try:
+            count = reportFile(job, writers[fmt](fh))
+        except Exception as e:
+            return (tmpname, 0, "{}: {}".format(job[0], e))
+    return (tmpname, count, None)
+
+def report(args):
+    # Runs the report for the parsed command line. Returns the exit status:
+    # 0 for no changes, 1 for changes and 2 for errors.
+    if not len(args.infile):
+        sys.stderr.write("diffted: --report needs a file to report on\n")
+        return 2
+    if args.against is not None and len(args.infile) > 1:
+        sys.stderr.write("diffted: --against takes a single file to report on\n")
+        return 2
+    jobs = [(f, args.config, args.against, args.rev, args.gitmod) for f in args.infile]
+    out = open(args.output, 'w', encoding="utf-8", newline="") if args.output else sys.stdout
+    writer = writers[args.report](out)
+    writer.begin()
+    total = 0
+    errors = 0
+    numProcs = min(args.jobs or os.cpu_count() or 1, len(jobs))
+    if numProcs > 1:
+        # files are diffed in parallel, each to its own temporary file, and
+        # the results copied out in the order given
+        from multiprocessing import Pool
+        with Pool(numProcs) as pool:
+            for tmpname, count, error in pool.imap(runJob, [(j, args.report) for j in jobs]):
+                with open(tmpname, encoding="utf-8", newline="") as fh:
+                    shutil.copyfileobj(fh, out)
+                os.remove(tmpname)
+                total += count
+                if error is not None:
+                    sys.stderr.write("diffted: {}\n".format(error))
+                    errors += 1
+    else:
+        for job in jobs:
+            try:
+                total += reportFile(job, writer)
+            except Exception as e:
+                sys.stderr.write("diffted: {}: {}\n".format(job[0], e))
+                errors += 1
+    writer.end()
+    if out is not sys.stdout:
+        out.close()
+    else:
+        out.flush()
+    return 2 if errors else (1 if total else 0)
@@ -0,0 +1,326 @@
+
+import ast, re
+from functools import lru_cache
+from itertools import compress, repeat
+from operator import eq, ne, lt, le, gt, ge
+
+class CachedRe(object):
+    # Stands in for re in rule expressions so that patterns built at run time
+    # are still only compiled once.
+    def __init__(self):
+        self.compile = lru_cache(maxsize=1024)(re.compile)
+
+    def __getattr__(self, name):
+        return getattr(re, name)
+
+    def search(self, pattern, string, flags=0):
+        return self.compile(pattern, flags).search(string)
+
+    def match(self, pattern, string, flags=0):
+        return self.compile(pattern, flags).match(string)
+
+    def fullmatch(self, pattern, string, flags=0):
+        return self.compile(pattern, flags).fullmatch(string)
+
+    def findall(self, pattern, string, flags=0):
+        return self.compile(pattern, flags).findall(string)
+
+    def finditer(self, pattern, string, flags=0):
+        return self.compile(pattern, flags).finditer(string)
+
+    def split(self, pattern, string, maxsplit=0, flags=0):
+        return self.compile(pattern, flags).split(string, maxsplit)
+
+    def sub(self, pattern, repl, string, count=0, flags=0):
+        return self.compile(pattern, flags).sub(repl, string, count)
+
+    def subn(self, pattern, repl, string, count=0, flags=0):
+        return self.compile(pattern, flags).subn(repl, string, count)
+
+
+class RegexHoister(ast.NodeTransformer):
+    # Rewrites re.fn("constant", ...) into a call on a pattern compiled now
+    numargs = {'search': 2, 'match': 2, 'fullmatch': 2, 'findall': 2, 'finditer': 2,
+               'split': 2, 'sub': 3, 'subn': 3}
+
+    def __init__(self, evaluator):
+        self.evaluator = evaluator
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        f = node.func
+        if isinstance(f, ast.Attribute) and isinstance(f.value, ast.Name) and f.value.id == 're' \
+                and len(node.args) == self.numargs.get(f.attr, -1) and not len(node.keywords) \
+                and isinstance(node.args[0], ast.Constant) and isinstance(node.args[0].value, str):
+            name = self.evaluator.addPattern(node.args[0].value)
+            node.func = ast.copy_location(ast.Attribute(value=ast.Name(id=name, ctx=ast.Load()),
+                                                        attr=f.attr, ctx=ast.Load()), f)
+            node.args = node.args[1:]
+        return node
+
+
+class Evaluator(object):
+    def __init__(self):
+        self.locals = {}
+        self.fns = {
+            '__builtins__': None,
+            're' : CachedRe(),
+        }
+        self.patterns = {}
+        for x in ('True', 'False', 'None', 'int', 'float', 'str', 'abs', 'bool',
+                  'dict', 'enumerate', 'filter', 'hex', 'len', 'list', 'map',
+                  'max', 'min', 'ord', 'range', 'set', 'sorted', 'sum', 'tuple', 'zip'):
+            self.fns[x] = __builtins__[x]
+
+    def is_safe(self, exp):
+        # no dunders in names or attribute names
+        for n in ast.walk(ast.parse(exp)):
+            if "__" in getattr(n, 'id', "") or "__" in getattr(n, 'attr', ""):
+                return False
+        return True
+
+    def addPattern(self, pattern):
+        name = self.patterns.get(pattern, None)
+        if name is None:
+            name = "_re{}".format(len(self.patterns))
+            self.patterns[pattern] = name
+            self.fns[name] = re.compile(pattern)
+        return name
+
+    def compile(self, exp):
+        # a code object for exp, or None if it is not safe to run
+        if not self.is_safe(exp):
+            return None
+        tree = ast.fix_missing_locations(RegexHoister(self).visit(ast.parse(exp, mode='eval')))
+        return compile(tree, "<rule>", "eval")
+
+    def eval(self, exp, **kw):
+        if exp is None:
+            return True
+        return eval(exp, self.fns, {**self.locals, **kw})
+
+evaluator = Evaluator()
+
+
+def ruleReads(exp):
+    # Which columns of r, lastRow and nextRow exp reads, as a dict from the
+    # name to a set of column names, or None if it may read any column.
+    res = {}
+    names = ('r', 'lastRow', 'nextRow')
+    keyed = set()
+    tree = ast.parse(exp, mode='eval')
+    for n in ast.walk(tree):
+        if isinstance(n, ast.Subscript) and isinstance(n.value, ast.Name) and n.value.id in names:
+            s = n.slice
+            if isinstance(s, getattr(ast, 'Index', ())):
+                s = s.value
+            if isinstance(s, ast.Constant) and isinstance(s.value, str):
+                keyed.add(id(n.value))
+                if res.get(n.value.id, ()) is not None:
+                    res.setdefault(n.value.id, set()).add(s.value)
+        elif isinstance(n, ast.Compare) and isinstance(n.left, ast.Name) \
+                and all(isinstance(o, (ast.Is, ast.IsNot)) for o in n.ops):
+            # lastRow is None only asks whether there is a row
+            keyed.add(id(n.left))
+    for n in ast.walk(tree):
+        if isinstance(n, ast.Name) and n.id in names and id(n) not in keyed:
+            res[n.id] = None
+    return res
+
+
+def notIn(a, b):
+    return a not in b
+
+def isIn(a, b):
+    return a in b
+
+class ColumnRewriter(ast.NodeTransformer):
+    # Turns r['name'] into a plain argument, so an expression that only reads
+    # its own row can be mapped down whole columns.
+    def __init__(self):
+        self.args = []
+
+    def visit_Subscript(self, node):
+        if isinstance(node.value, ast.Name) and node.value.id == 'r':
+            s = node.slice
+            if isinstance(s, getattr(ast, 'Index', ())):
+                s = s.value
+            if s.value not in self.args:
+                self.args.append(s.value)
+            name = "_c{}".format(self.args.index(s.value))
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return self.generic_visit(node)
+
+def isColumn(node):
+    # whether node is r['name']
+    if not isinstance(node, ast.Subscript) or not isinstance(node.value, ast.Name) or node.value.id != 'r':
+        return False
+    s = node.slice
+    if isinstance(s, getattr(ast, 'Index', ())):
+        s = s.value
+    return isinstance(s, ast.Constant) and isinstance(s.value, str)
+
+compareOps = {ast.Eq: eq, ast.NotEq: ne, ast.Lt: lt, ast.LtE: le, ast.Gt: gt, ast.GtE: ge,
+              ast.In: isIn, ast.NotIn: notIn}
+
+def columnFunction(exp, evaluator, env):
+    # For a rule reading only named columns of r, returns (names, fn) where
+    # fn(*columns) yields whether the rule matches each row, else None.
+    reads = ruleReads(exp)
+    if set(reads) != {'r'} or reads['r'] is None:
+        return None
+    tree = ast.parse(exp, mode='eval')
+    if any(isinstance(n, ast.Name) and n.id in ('lastRow', 'nextRow') for n in ast.walk(tree)):
+        return None
+    body = tree.body
+    # a column compared with a constant, the commonest rule, needs no lambda.
+    # Only a plain r['name'] though, not r['name'][0] or the like.
+    if isinstance(body, ast.Compare) and len(body.ops) == 1 and type(body.ops[0]) in compareOps \
+            and isColumn(body.left) and isinstance(body.comparators[0], ast.Constant):
+        op = compareOps[type(body.ops[0])]
+        val = body.comparators[0].value
+        return (list(reads['r']), lambda c: map(op, c, repeat(val)))
+    if not evaluator.is_safe(exp):
+        return None
+    tree = RegexHoister(evaluator).visit(tree)
+    rewriter = ColumnRewriter()
+    tree.body = rewriter.visit(tree.body)
+    args = ast.arguments(posonlyargs=[], args=[ast.arg(arg="_c{}".format(i)) for i in range(len(rewriter.args))],
+                         vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None, defaults=[])
+    tree.body = ast.Lambda(args=args, body=tree.body)
+    code = compile(ast.fix_missing_locations(tree), "<rule>", "eval")
+    fn = eval(code, {**evaluator.fns, **env})
+    return (rewriter.args, lambda *cols: map(bool, map(fn, *cols)))
+
+
+class MatchTable(dict):
+    # The matching rules for each combination of rule results
+    def __init__(self, indices):
+        self.indices = indices
+
+    def __missing__(self, bits):
+        res = self[bits] = tuple(compress(self.indices, bits))
+        return res
+
+
+class Rule(object):
+    def __init__(self, config, code):
+        self.config = config
+        self.col = config.get('col', None)
+        self.source = config.get('eval', None)
+        self.code = code
+        self.reads = ruleReads(self.source) if self.source is not None else {}
+        self.columns = None
+
+
+class RuleSet(object):
+    # The rules from a config, each compiled once. evalRow runs the row level
+    # rules once for a row and the column rules once for their column.
+    def __init__(self, config=None, evaluator=evaluator, columnwise=True):
+        self.evaluator = evaluator
+        self.rules = []
+        self.rowRules = []
+        self.colRules = {}
+        for r in config or []:
+            e = r.get('eval', None)
+            code = None
+            if e is not None:
+                code = evaluator.compile(e)
+                if code is None:
+                    continue
+            rule = Rule(r, code)
+            entry = (len(self.rules), code)
+            self.rules.append(rule)
+            if rule.col is None:
+                self.rowRules.append(entry)
+            else:
+                self.colRules.setdefault(rule.col, []).append(entry)
+        self.env = dict(evaluator.locals)
+        if columnwise:
+            for rule in self.rules:
+                if rule.source is not None:
+                    rule.columns = columnFunction(rule.source, evaluator, self.env)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def dependents(self, col):
+        # After a change to col in a row, the (row offset, columns) needing
+        # their rules rerun, where columns of None means the whole row.
+        res = {}
+        for rule in self.rules:
+            for name, offset in (('r', 0), ('lastRow', 1), ('nextRow', -1)):
+                cols = rule.reads.get(name, ())
+                if cols is not None and col not in cols:
+                    continue
+                curr = res.get(offset, set())
+                if rule.col is None or curr is None:
+                    res[offset] = None
+                else:
+                    curr.add(rule.col)
+                    res[offset] = curr
+        return list(res.items())
+
+    def evalRow(self, r, lastRow, nextRow, fieldnames):
+        # the indices of the rules matching each cell of the row, for the
+        # columns in fieldnames
+        fns = self.evaluator.fns
+        env = self.env
+        env['r'] = r
+        env['lastRow'] = lastRow
+        env['nextRow'] = nextRow
+        rowMatches = tuple(i for i, code in self.rowRules if code is None or eval(code, fns, env))
+        res = []
+        for c in fieldnames:
+            colRules = self.colRules.get(c, None)
+            if colRules is None:
+                res.append(rowMatches)
+            else:
+                res.append(rowMatches + tuple(i for i, code in colRules
+                                                if code is None or eval(code, fns, env)))
+        return res
+
+    def evalColumns(self, columns, fieldnames, lastRow=None, nextRow=None):
+        # evalRow for a block of rows given as equal length columns, with the
+        # rows either side of the block. Rules that only read their own row
+        # are mapped down whole columns; the rest are run a row at a time.
+        num = len(columns[0]) if len(columns) else 0
+        colmap = dict(zip(fieldnames, columns))
+        masks = [None] * len(self.rules)
+        scalar = []
+        for i, rule in enumerate(self.rules):
+            if rule.code is None:
+                masks[i] = repeat(True, num)
+            elif rule.columns is not None and all(c in colmap for c in rule.columns[0]):
+                masks[i] = rule.columns[1](*[colmap[c] for c in rule.columns[0]])
+            else:
+                scalar.append(i)
+                masks[i] = []
+        if len(scalar):
+            fns = self.evaluator.fns
+            env = self.env
+            codes = [(self.rules[i].code, masks[i].append) for i in scalar]
+            rows = [dict(zip(fieldnames, r)) for r in zip(*columns)]
+            for k, r in enumerate(rows):
+                env['r'] = r
+                env['lastRow'] = rows[k-1] if k > 0 else lastRow
+                env['nextRow'] = rows[k+1] if k + 1 < num else nextRow
+                for code, add in codes:
+                    add(bool(eval(code, fns, env)))
+        masks = [list(m) for m in masks]
+        rowIndices = [i for i, code in self.rowRules]
+        res = []
+        shared = {}
+        for c in fieldnames:
+            indices = rowIndices + [i for i, code in self.colRules.get(c, [])]
+            key = tuple(indices)
+            matches = shared.get(key, None)
+            if matches is None:
+                if not len(indices):
+                    matches = [()] * num
+                else:
+                    matches = list(map(MatchTable(indices).__getitem__,
+                                       zip(*[masks[i] for i in indices])))
+                shared[key] = matches
+            res.append(matches)
+        return res
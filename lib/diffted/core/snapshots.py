@@ -0,0 +1,76 @@
+
+import csv, io, os, pickle, tempfile
+from diffted.core.diff import DiffRow
+from diffted.core.store import LRUCache
+
+# Parsed revisions of a data file, keyed by the git object id of its blob.
+# A blob never changes, so an entry never goes stale; entries are kept in
+# memory and, given a cache directory, on disk between runs.
+
+def writePickle(fname, obj):
+    # written to a temporary file and renamed, so readers never see half a file
+    try:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname), suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fh:
+            pickle.dump(obj, fh, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpname, fname)
+    except OSError:
+        return False
+    return True
+
+def readPickle(fname):
+    try:
+        with open(fname, 'rb') as fh:
+            return pickle.load(fh)
+    except (OSError, EOFError, ValueError, TypeError, AttributeError, pickle.UnpicklingError):
+        return None
+
+def parseCsv(fh):
+    # (fieldnames, rows) with every row padded or cut to the header's width
+    rdr = csv.reader(fh)
+    fieldnames = next(rdr, [])
+    num = len(fieldnames)
+    return fieldnames, [DiffRow(r[:num] + [""] * (num - len(r))) for r in rdr if len(r)]
+
+
+class SnapshotCache(object):
+    def __init__(self, size=8, cachedir=None):
+        self.entries = LRUCache(size)
+        self.cachedir = cachedir
+
+    def _path(self, sha):
+        return os.path.join(self.cachedir, sha[:2], sha[2:] + ".pickle")
+
+    def get(self, sha):
+        res = self.entries.get(sha)
+        if res is not None or self.cachedir is None:
+            return res
+        data = readPickle(self._path(sha))
+        if data is None:
+            return None
+        res = (data[0], list(map(DiffRow, data[1])))
+        self.entries.put(sha, res)
+        return res
+
+    def put(self, sha, snapshot):
+        self.entries.put(sha, snapshot)
+        if self.cachedir is None:
+            return
+        fname = self._path(sha)
+        if not os.path.exists(fname):
+            writePickle(fname, (snapshot[0], [list(r) for r in snapshot[1]]))
+
+    def load(self, sha, fetch):
+        # the snapshot for sha, calling fetch(sha) for its text if need be
+        res = self.get(sha)
+        if res is None:
+            text = fetch(sha)
+            if text is None:
+                return None
+            res = parseCsv(io.StringIO(text))
+            self.put(sha, res)
+        return res
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,85 @@
+
+import locale, re, warnings
+
+try:
+    import icu
+except ImportError:
+    icu = None
+
+# Sort keys for the values of a column. A column's kind is one of text,
+# numeric, natural or collate, or auto to use numeric when the column holds
+# numbers and text otherwise.
+
+kinds = ('auto', 'text', 'numeric', 'natural', 'collate')
+
+def numericKey(v):
+    # numbers first, by value, then anything else as text
+    try:
+        f = float(v)
+    except ValueError:
+        return (1, 0.0, v)
+    if f != f:
+        return (1, 0.0, v)
+    return (0, f, v)
+
+def autoNumericKey(v):
+    # numericKey for a column picked as numeric because it held only numbers
+    # and blanks. Text raises ValueError, so that the column's kind is
+    # picked again as it would be for a fresh sort.
+    res = numericKey(v)
+    if res[0] and v != "":
+        raise ValueError(v)
+    return res
+
+naturalRe = re.compile(r"(\d+)")
+
+def naturalKey(v):
+    # "a10" sorts after "a9": runs of digits compare as numbers
+    return tuple(int(p) if i % 2 else p for i, p in enumerate(naturalRe.split(v)))
+
+def setCollation(localeName):
+    # sets the C library's collation locale, which strxfrm uses. Returns
+    # False if no such locale is installed.
+    for name in (localeName, localeName + ".UTF-8", localeName.replace("-", "_") + ".UTF-8"):
+        try:
+            locale.setlocale(locale.LC_COLLATE, name)
+        except locale.Error:
+            continue
+        return True
+    return False
+
+def collationKey(localeName=None):
+    # ICU collation keys when PyICU is installed, else the C library's, for
+    # which the collation locale is set for the whole process
+    if icu is not None:
+        loc = icu.Locale(localeName) if localeName else icu.Locale.getDefault()
+        return icu.Collator.createInstance(loc).getSortKey
+    if localeName and not setCollation(localeName):
+        warnings.warn("collation locale {} is not installed, using the default".format(localeName))
+    return locale.strxfrm
+
+def isNumeric(values):
+    for v in values:
+        if v != "" and numericKey(v)[0]:
+            return False
+    return True
+
+def columnKeys(values, kind='auto', localeName=None):
+    # (key function, list of keys) for the values of a column
+    if kind in ('auto', 'numeric'):
+        try:
+            return (float, list(map(float, values)))
+        except ValueError:
+            pass
+        if kind == 'numeric':
+            return (numericKey, list(map(numericKey, values)))
+        if isNumeric(values):
+            return (autoNumericKey, list(map(numericKey, values)))
+        kind = 'text'
+    if kind == 'natural':
+        fn = naturalKey
+    elif kind == 'collate':
+        fn = collationKey(localeName)
+    else:
+        return (str, list(values))
+    return (fn, list(map(fn, values)))
@@ -0,0 +1,587 @@
+
+import csv, codecs, io, mmap, os, tempfile, weakref
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from itertools import accumulate, chain, compress, islice, repeat
+from operator import add, and_, ne
+
+def spliceRows(seq, groups):
+    # A copy of seq with each (pos, items) of groups inserted before pos, in one pass
+    res = seq[:0]
+    last = 0
+    for pos, items in groups:
+        res += seq[last:pos]
+        res += items
+        last = pos
+    res += seq[last:]
+    return res
+
+
+class PackedColumn(object):
+    # A column of strings packed into blocks, each the block's values run
+    # together in one string with an array of where each value ends. A cell
+    # costs its text and four bytes, not a str object; values are sliced
+    # out as asked for. Blocks are replaced, never changed, so a copy of
+    # the block list is a snapshot.
+    blockSize = 4096
+
+    def __init__(self, values=()):
+        self.blocks = []        # [(text, ends)]
+        self.starts = [0]       # first row of each block, then the length
+        self.extend(values)
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def _find(self, row):
+        b = bisect_right(self.starts, row) - 1
+        return b, row - self.starts[b]
+
+    def _values(self, b):
+        text, ends = self.blocks[b]
+        return list(map(text.__getitem__, map(slice, chain((0,), ends), ends)))
+
+    def _index(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return row
+
+    def _range(self, key):
+        first, last, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError("PackedColumn slices take no step")
+        return first, max(first, last)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self.values(*self._range(key))
+        b, i = self._find(self._index(key))
+        text, ends = self.blocks[b]
+        return text[ends[i-1] if i else 0:ends[i]]
+
+    def __setitem__(self, key, val):
+        if isinstance(key, slice):
+            self._replace(*self._range(key), list(val))
+        else:
+            row = self._index(key)
+            self._replace(row, row + 1, [val])
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            self._replace(*self._range(key), [])
+        else:
+            row = self._index(key)
+            self._replace(row, row + 1, [])
+
+    def __iter__(self):
+        for text, ends in self.blocks:
+            yield from map(text.__getitem__, map(slice, chain((0,), ends), ends))
+
+    def values(self, first, last):
+        # the values of rows first to last, not including last
+        last = min(last, len(self))
+        if first >= last:
+            return []
+        b, i = self._find(first)
+        res = []
+        while len(res) < last - first:
+            res.extend(self._values(b)[i:i + last - first - len(res)])
+            b += 1
+            i = 0
+        return res
+
+    def extend(self, values):
+        values = iter(values)
+        if len(self.blocks) and len(self.blocks[-1][1]) < self.blockSize:
+            # the last block is filled up first
+            last = self._values(len(self.blocks) - 1)
+            last.extend(islice(values, self.blockSize - len(last)))
+            self.blocks[-1] = packValues(last)
+        while True:
+            part = list(islice(values, self.blockSize))
+            if not len(part):
+                break
+            self.blocks.append(packValues(part))
+        self._restart()
+
+    def _replace(self, first, last, values):
+        # puts values in place of rows first to last, repacking only the
+        # blocks they fall in
+        if first == len(self):
+            self.extend(values)
+            return
+        b1, i = self._find(first)
+        b2 = self._find(last - 1)[0] + 1 if last > first else b1 + 1
+        vals = list(chain.from_iterable(map(self._values, range(b1, b2))))
+        j = last - self.starts[b1]
+        vals[i:j] = values
+        self.blocks[b1:b2] = [packValues(vals[k:k + self.blockSize]) for k in range(0, len(vals), self.blockSize)]
+        self._restart()
+
+    def _restart(self):
+        self.starts = list(accumulate((len(e) for t, e in self.blocks), initial=0))
+
+    def spliced(self, groups):
+        # a copy with each (pos, values) of groups inserted before pos
+        def parts():
+            last = 0
+            for pos, values in groups:
+                yield self.values(last, pos)
+                yield values
+                last = pos
+            yield self.values(last, len(self))
+        return PackedColumn(chain.from_iterable(parts()))
+
+    def snapshot(self):
+        res = PackedColumn()
+        res.blocks = list(self.blocks)
+        res.starts = list(self.starts)
+        return res
+
+def packValues(values):
+    return ("".join(values), array('I', accumulate(map(len, values))))
+
+
+class ColumnStore(object):
+    # Table data held as a PackedColumn per column, so memory follows the
+    # text of the file, not the number of cells
+    def __init__(self, fieldnames=None):
+        self.fieldnames = list(fieldnames or [])
+        self.columns = [PackedColumn() for x in self.fieldnames]
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def get(self, row, col):
+        return self.columns[col][row]
+
+    def set(self, row, col, val):
+        self.columns[col][row] = val
+
+    def row(self, row):
+        return [c[row] for c in self.columns]
+
+    def column(self, col):
+        return list(self.columns[col])
+
+    def columnReader(self, col):
+        # a function giving column col as it is now, for another thread
+        values = self.columns[col].snapshot()
+        return lambda cancelled=None: list(values)
+
+    def columnRange(self, first, last):
+        return [c.values(first, last) for c in self.columns]
+
+    def append(self, rows):
+        for j, c in enumerate(self.columns):
+            c.extend([r[j] if j < len(r) else "" for r in rows])
+
+    def doneLoading(self):
+        pass
+
+    def insertRows(self, row, rows):
+        for j, c in enumerate(self.columns):
+            c[row:row] = [r[j] if j < len(r) else "" for r in rows]
+
+    def removeRows(self, row, count):
+        for c in self.columns:
+            del c[row:row+count]
+
+    def insertRowGroups(self, groups):
+        for j, c in enumerate(self.columns):
+            self.columns[j] = c.spliced([(pos, [r[j] if j < len(r) else "" for r in rows])
+                                            for pos, rows in groups])
+
+    def keepRows(self, mask):
+        self.columns = [PackedColumn(compress(c, mask)) for c in self.columns]
+
+    def insertColumns(self, col, count, names=None):
+        if names is None:
+            names = [""] * count
+        num = len(self)
+        self.fieldnames[col:col] = names
+        self.columns[col:col] = [PackedColumn(repeat("", num)) for i in range(count)]
+
+    def removeColumns(self, col, count):
+        del self.fieldnames[col:col+count]
+        del self.columns[col:col+count]
+
+    def rows(self):
+        return zip(*self.columns)
+
+    def writeCsv(self, f, writer, skip=()):
+        # Every row goes through the csv writer: a ColumnStore keeps no link
+        # to the bytes it was read from. Files big enough for that to matter
+        # are loaded into an MmapStore, which copies untouched records.
+        # skip is the sorted row numbers to leave out.
+        writer.writerow(self.fieldnames)
+        if not len(skip):
+            writer.writerows(self.rows())
+            return
+        skip = set(skip)
+        writer.writerows(r for i, r in enumerate(self.rows()) if i not in skip)
+
+    def close(self):
+        pass
+
+
+class LRUCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            return default
+        return self.entries[key]
+
+    def put(self, key, val):
+        self.entries[key] = val
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+def fileSize(fh):
+    try:
+        return os.fstat(fh.fileno()).st_size
+    except (AttributeError, OSError):
+        return None
+
+def readCsvRows(fh):
+    rdr = csv.reader(fh)
+    fieldnames = next(rdr, [])
+    return fieldnames, (r for r in rdr if len(r))
+
+def readProgress(fh):
+    # returns a function giving how far through fh reading has got, as a percentage
+    try:
+        size = os.fstat(fh.fileno()).st_size
+        raw = fh.buffer
+    except (AttributeError, OSError):
+        return None
+    return lambda: min(raw.tell() * 100 // size, 100) if size else 100
+
+offsetChunk = 1 << 22
+
+def countQuotes(buf, start, end):
+    # mmap has no count()
+    res = 0
+    q = buf.find(b'"', start, end)
+    while q >= 0:
+        res += 1
+        q = buf.find(b'"', q + 1, end)
+    return res
+
+def recordOffsets(buf, start=0):
+    # Offsets of the start of each non blank csv record, plus the end of the
+    # buffer. A newline only ends a record if it follows an even number of quotes.
+    # Stretches of the buffer without quotes are split on newlines in one go.
+    res = array('Q')
+    end = len(buf)
+    pos = start
+    while pos < end:
+        chunkEnd = buf.find(b'\n', min(pos + offsetChunk, end))
+        chunkEnd = end if chunkEnd < 0 else chunkEnd + 1
+        if buf.find(b'"', pos, chunkEnd) < 0:
+            lines = buf[pos:chunkEnd].split(b'\n')
+            starts = accumulate(map(add, map(len, lines), repeat(1)), initial=pos)
+            nonBlank = map(and_, map(ne, lines, repeat(b'')), map(ne, lines, repeat(b'\r')))
+            res.extend(compress(starts, nonBlank))
+            pos = chunkEnd
+            continue
+        while pos < chunkEnd:
+            nl = buf.find(b'\n', pos)
+            if nl < 0:
+                nl = end
+            quotes = countQuotes(buf, pos, nl)
+            while quotes % 2 and nl < end:
+                nxt = buf.find(b'\n', nl + 1)
+                if nxt < 0:
+                    nxt = end
+                quotes += countQuotes(buf, nl, nxt)
+                nl = nxt
+            if nl - pos > 1 or (nl - pos == 1 and buf[pos:nl] != b'\r'):
+                res.append(pos)
+            pos = nl + 1
+    res.append(end)
+    return res
+
+
+# the MmapStores open, so that a file can be released before it is replaced
+mappedStores = weakref.WeakSet()
+
+def releaseFile(path):
+    # Moves any store mapping path onto a copy of it. Windows will not
+    # replace a file that is open.
+    for store in list(mappedStores):
+        if store.path is not None and os.path.abspath(store.path) == os.path.abspath(path):
+            store.moveToCopy()
+
+
+class MmapStore(object):
+    # Rows are parsed from a memory mapped file only when asked for, a block at
+    # a time. self.order maps each row to its record in the file, or to
+    # -(i+1) for the ith added row. Edited records are kept in self.edits.
+    blockSize = 512
+
+    def __init__(self, fh, cacheSize=64):
+        self.fh = fh
+        self.path = getattr(fh, 'path', None) or getattr(fh, 'name', None)
+        if not isinstance(self.path, str):
+            self.path = None
+        self.copyname = None
+        self.mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        mappedStores.add(self)
+        start = 3 if self.mmap[:3] == codecs.BOM_UTF8 else 0
+        offsets = recordOffsets(self.mmap, start)
+        self.headerRange = (start, offsets[1] if len(offsets) > 1 else offsets[0])
+        # saving keeps the file's byte order mark and line endings
+        self.bom = self.mmap[:start]
+        hend = self.headerRange[1]
+        self.lineterminator = "\r\n" if self.mmap[hend-2:hend] == b"\r\n" else "\n"
+        header = self._parse(*self.headerRange)
+        self.fieldnames = header[0] if len(header) else []
+        self.origFieldnames = list(self.fieldnames)
+        self.offsets = offsets[1:]
+        numRecords = max(len(self.offsets) - 1, 0)
+        self.colmap = list(range(len(self.fieldnames)))
+        self.order = array('q', range(numRecords))
+        self.edits = {}
+        self.added = []
+        self.cache = LRUCache(cacheSize)
+
+    def __len__(self):
+        return len(self.order)
+
+    def _parse(self, start, end):
+        text = self.mmap[start:end].decode('utf-8')
+        return [r for r in csv.reader(io.StringIO(text, newline='')) if len(r)]
+
+    def _record(self, rec):
+        block = rec // self.blockSize
+        rows = self.cache.get(block)
+        if rows is None:
+            first = block * self.blockSize
+            last = min(first + self.blockSize, len(self.offsets) - 1)
+            rows = [[r[c] if 0 <= c < len(r) else "" for c in self.colmap]
+                        for r in self._parse(self.offsets[first], self.offsets[last])]
+            self.cache.put(block, rows)
+        return rows[rec - block * self.blockSize]
+
+    def row(self, row):
+        rec = self.order[row]
+        if rec < 0:
+            return self.added[-rec-1]
+        res = self.edits.get(rec, None)
+        if res is None:
+            res = self._record(rec)
+        return res
+
+    def get(self, row, col):
+        return self.row(row)[col]
+
+    def set(self, row, col, val):
+        rec = self.order[row]
+        if rec < 0:
+            self.added[-rec-1][col] = val
+            return
+        if rec not in self.edits:
+            self.edits[rec] = list(self._record(rec))
+        self.edits[rec][col] = val
+
+    def column(self, col):
+        return [r[col] for r in self.rows()]
+
+    def columnReader(self, col):
+        # A function giving column col as it is now, for another thread. It
+        # parses the file itself rather than sharing the block cache, and
+        # gives None if cancelled() turns true part way.
+        c = self.colmap[col]
+        order = array('q', self.order)
+        edits = {rec: r[col] for rec, r in self.edits.items()}
+        added = [r[col] for r in self.added]
+        mm, offsets, blockSize = self.mmap, self.offsets, self.blockSize
+        def read(cancelled=None):
+            num = max(len(offsets) - 1, 0)
+            if c < 0:
+                values = [""] * num
+            else:
+                values = []
+                for first in range(0, num, blockSize):
+                    if cancelled is not None and cancelled():
+                        return None
+                    last = min(first + blockSize, num)
+                    text = mm[offsets[first]:offsets[last]].decode('utf-8')
+                    values.extend(r[c] if c < len(r) else "" for r in csv.reader(io.StringIO(text, newline=''))
+                                    if len(r))
+            if not len(edits) and not len(added) and order == array('q', range(num)):
+                return values
+            return [added[-rec-1] if rec < 0 else edits.get(rec, values[rec]) for rec in order]
+        return read
+
+    def columnRange(self, first, last):
+        rows = [self.row(i) for i in range(first, last)]
+        if not len(rows):
+            return [[] for x in self.fieldnames]
+        return [list(c) for c in zip(*rows)]
+
+    def rows(self):
+        for i in range(len(self.order)):
+            yield self.row(i)
+
+    def append(self, rows):
+        self.insertRows(len(self.order), rows)
+
+    def doneLoading(self):
+        pass
+
+    def insertRows(self, row, rows):
+        num = len(self.fieldnames)
+        first = len(self.added)
+        self.added.extend([(list(r[:num]) + [""] * (num - len(r))) for r in rows])
+        self.order[row:row] = array('q', range(-first-1, -first-len(rows)-1, -1))
+
+    def removeRows(self, row, count):
+        for rec in self.order[row:row+count]:
+            self.edits.pop(rec, None)
+        del self.order[row:row+count]
+
+    def insertRowGroups(self, groups):
+        num = len(self.fieldnames)
+        ids = []
+        for pos, rows in groups:
+            first = len(self.added)
+            self.added.extend([(list(r[:num]) + [""] * (num - len(r))) for r in rows])
+            ids.append((pos, array('q', range(-first-1, -first-len(rows)-1, -1))))
+        self.order = spliceRows(self.order, ids)
+
+    def keepRows(self, mask):
+        self.order = array('q', compress(self.order, mask))
+
+    def _changedRows(self):
+        return list(self.edits.values()) + self.added
+
+    def insertColumns(self, col, count, names=None):
+        if names is None:
+            names = [""] * count
+        self.fieldnames[col:col] = names
+        self.colmap[col:col] = [-1] * count
+        for r in self._changedRows():
+            r[col:col] = [""] * count
+        self.cache.clear()
+
+    def removeColumns(self, col, count):
+        del self.fieldnames[col:col+count]
+        del self.colmap[col:col+count]
+        for r in self._changedRows():
+            del r[col:col+count]
+        self.cache.clear()
+
+    def _runLength(self, pos, rec, most):
+        # how many rows from pos hold the consecutive records rec, rec+1, ...,
+        # up to most. Compared a slice at a time, so an unmoved stretch of
+        # the file costs one comparison.
+        def consecutive(n):
+            return self.order[pos:pos+n] == array('q', range(rec, rec + n))
+        if consecutive(most):
+            return most
+        lo, hi = 1, 2
+        while hi < most and consecutive(hi):
+            lo, hi = hi, hi * 2
+        hi = min(hi, most)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if consecutive(mid):
+                lo = mid
+            else:
+                hi = mid
+        return lo
+
+    def writeCsv(self, f, writer, skip=()):
+        # Only added and edited rows are written through the csv writer.
+        # Runs of untouched records are copied as bytes straight from the
+        # file. skip is the sorted row numbers to leave out.
+        # writer should end rows with self.lineterminator
+        if self.colmap != list(range(len(self.colmap))) or self.origFieldnames != self.fieldnames:
+            self._copy(f, 0, len(self.bom), terminate=False)
+            writer.writerow(self.fieldnames)
+            copyable = False
+        else:
+            self._copy(f, 0, self.headerRange[1])
+            copyable = True
+        edited = sorted(self.edits)
+        num = len(self.order)
+        pos = 0
+        while pos < num:
+            k = bisect_right(skip, pos - 1)
+            nextSkip = skip[k] if k < len(skip) else num
+            if nextSkip == pos:
+                pos += 1
+                continue
+            rec = self.order[pos]
+            if copyable and rec >= 0 and rec not in self.edits:
+                k = bisect_right(edited, rec)
+                nextEdit = edited[k] if k < len(edited) else len(self.offsets) - 1
+                n = self._runLength(pos, rec, min(nextSkip - pos, nextEdit - rec))
+                self._copy(f, self.offsets[rec], self.offsets[rec + n])
+                pos += n
+                continue
+            writer.writerow(self.row(pos))
+            pos += 1
+
+    def _copy(self, f, start, end, terminate=True):
+        if start >= end:
+            return
+        # a last record with no line ending gets one
+        addEnd = terminate and self.mmap[end-1:end] != b"\n"
+        buf = getattr(f, 'buffer', None)
+        if buf is not None:
+            # straight from the mapping to the file, with no decoding
+            f.flush()
+            with memoryview(self.mmap) as mv:
+                with mv[start:end] as part:
+                    buf.write(part)
+            if addEnd:
+                buf.write(self.lineterminator.encode('ascii'))
+            return
+        f.write(self.mmap[start:end].decode('utf-8'))
+        if addEnd:
+            f.write(self.lineterminator)
+
+    def moveToCopy(self):
+        # maps a copy of the file instead, leaving the file itself closed.
+        # The copy has the same bytes, so the offsets all still hold.
+        fd, copyname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)),
+                                        prefix=".diffted", suffix=".tmp")
+        with os.fdopen(fd, 'wb') as fh:
+            with memoryview(self.mmap) as mv:
+                fh.write(mv)
+        self.mmap.close()
+        self.fh.close()
+        self.fh = open(copyname, 'rb')
+        self.mmap = mmap.mmap(self.fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.copyname is not None:
+            os.remove(self.copyname)
+        self.copyname = copyname
+        self.path = None
+
+    def close(self):
+        self.cache.clear()
+        self.mmap.close()
+        self.fh.close()
+        mappedStores.discard(self)
+        if self.copyname is not None:
+            os.remove(self.copyname)
+            self.copyname = None
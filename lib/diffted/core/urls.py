@@ -0,0 +1,123 @@
+
+import re, io, os, sys, shutil, tempfile
+from diffted.core.store import releaseFile
+
+# githubapi, and the http and ssl modules under it, is only imported once a
+# github file is opened
+
+def isGithub(fname):
+    return fname.startswith("https://github.com/")
+
+def flushCommits(timeout=None):
+    # waits for saves still queued for github, if there have been any
+    githubapi = sys.modules.get('diffted.core.githubapi', None)
+    if githubapi is None:
+        return True
+    return githubapi.commitQueue.flush(timeout)
+
+def openFile(fname, *a, **kw):
+    if isGithub(fname):
+        return GithubFile(fname, *a, **kw)
+    else:
+        return OSFile(fname, *a, **kw)
+
+
+class OSFile(io.TextIOWrapper):
+    def __init__(self, fname, mode='r', config={}, **kw):
+        tmpname = None
+        if 'w' in mode:
+            # Write next to the file and rename over it on close, so the old
+            # contents (which may be memory mapped) are never overwritten in place.
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),
+                                           prefix=".diffted", suffix=".tmp")
+            if os.path.exists(fname):
+                shutil.copymode(fname, tmpname)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmpname, 0o666 & ~umask)
+            raw = io.FileIO(fd, mode)
+        else:
+            raw = io.FileIO(fname, mode)
+        # written rows carry their own line endings, which must not be
+        # translated, as runs copied from a mapped file are not
+        super(OSFile, self).__init__(raw, encoding="utf-8", newline="" if 'w' in mode else None)
+        self.path = fname
+        self.tmpname = tmpname
+
+    def close(self):
+        closed = self.closed
+        super(OSFile, self).close()
+        if not closed and self.tmpname is not None:
+            try:
+                os.replace(self.tmpname, self.path)
+            except PermissionError:
+                # the file is held open by a store mapping it, as on Windows
+                releaseFile(self.path)
+                os.replace(self.tmpname, self.path)
+            self.tmpname = None
+
+    def __exit__(self, exctype, excval, tb):
+        if exctype is not None and self.tmpname is not None:
+            super(OSFile, self).close()
+            os.remove(self.tmpname)
+            self.tmpname = None
+        return super(OSFile, self).__exit__(exctype, excval, tb)
+
+
+class GithubFile(io.StringIO):
+    def __init__(self, fname, mode='r', **kw):
+        fname = fname.replace("\\", "/")
+        if 'encoding' in kw:
+            del kw['encoding']
+        for k, v in kw.items():
+            setattr(self, k, v)
+        self.parseGithubUrl(fname)
+        self.mode = mode
+        self.log = None
+        if mode == 'w':
+            super(GithubFile, self).__init__()
+            return
+        # no dialogs here, this may be running off the GUI thread
+        client = self.getClient(noui=True)
+        s = client.getFile(self.user, self.repo, self.branch, self.path).decode('utf-8')
+        super(GithubFile, self).__init__(s)
+
+    def getClient(self, noui=False):
+        from diffted.core.githubapi import GithubClient
+        self.getCredentials(noui)
+        cachedir = getattr(self, 'config', {}).get('cachedir', None)
+        return GithubClient(getattr(self, 'username', None), getattr(self, 'password', None),
+                            cachedir=os.path.expanduser(cachedir) if cachedir is not None else None)
+
+    def getCredentials(self, noui=False):
+        if hasattr(self, 'gui'):
+            cred = self.gui.getGithubCredentials(r'https://github.com/{}/{}'.format(self.user, self.repo), noui=noui)
+            if cred is not None:
+                self.username = cred['username']
+                self.password = cred['pwd']
+                self.log = cred.get('log', None)
+
+    def parseGithubUrl(self, s):
+        m = re.match(r'https://github.com/(?P<user>.*?)/(?P<repo>.*?)/blob/(?P<branch>.*?)/(?P<path>.*)$', s)
+        if not m:
+            raise IOError((0, "Can't parse github filename", s))
+        self.user = m.group('user')
+        self.repo = m.group('repo')
+        self.branch = m.group('branch')
+        self.path = m.group('path')
+
+    def close(self):
+        s = self.getvalue()
+        super(GithubFile, self).close()
+        if self.mode != 'w':
+            return
+        # the commit is pushed in the background, along with any other files
+        # saved to the same branch shortly after
+        from diffted.core.githubapi import commitQueue
+        client = self.getClient(noui=False)
+        if not getattr(self, 'username', None):
+            return
+        if hasattr(self, 'gui'):
+            commitQueue.status = self.gui.pushStatus.emit
+        commitQueue.add(client, self.user, self.repo, self.branch, self.path, s, self.log)
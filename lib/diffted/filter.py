@@ -1,5 +1,10 @@
 
 from PyQt5 import QtCore, QtGui, QtWidgets
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import compress, repeat
+from operator import contains
+from diffted.core.sortkeys import columnKeys
 import re
 
 class FlipFlop(QtWidgets.QWidget):
@@ -67,6 +72,17 @@ class FilterEdit(QtWidgets.QWidget):
     def isRegex(self):
         return self.regBox.isChecked()
 
+    def getSearch(self):
+        text = self.lineEdit.text()
+        return (text, self.isRegex()) if text != "" else None
+
+    def getFilter(self):
+        # (text, isRegex) when the filter is on and has something to match
+        text = self.lineEdit.text()
+        if not self.checkBox.isChecked() or text == "":
+            return None
+        return (text, self.isRegex())
+
     def getSettings(self):
         val = self.lineEdit.text()
         reg = self.isRegex()
@@ -83,40 +99,850 @@ class FilterEdit(QtWidgets.QWidget):
             self.checkBox.setChecked(vals[2])
 
 
-class FilterProxy(QtCore.QSortFilterProxyModel):
+class ColumnFilter(object):
+    # A filter compiled once, tested against whole columns at a time
+    def __init__(self, text, isRegex):
+        self.text = text
+        self.isRegex = isRegex
+        self.pattern = None
+        self.valid = True
+        if isRegex:
+            try:
+                self.pattern = re.compile(text)
+            except re.error:
+                # an unfinished regex filters nothing out
+                self.text = ""
+                self.valid = False
+
+    def key(self):
+        return (self.text, self.isRegex)
+
+    def narrows(self, other):
+        # True if every value this matches is matched by other
+        return other is not None and not self.isRegex and not other.isRegex and other.text in self.text
+
+    def test(self, val):
+        if self.pattern is not None:
+            return self.pattern.search(val) is not None
+        return self.text in val
+
+    def mask(self, values, rows=None):
+        # bytearray of which values match, testing only rows if given
+        if self.text == "":
+            return bytearray(b"\x01") * len(values)
+        if rows is None:
+            if self.pattern is not None:
+                return bytearray(map(bool, map(self.pattern.search, values)))
+            return bytearray(map(contains, values, repeat(self.text)))
+        res = bytearray(len(values))
+        test = self.test
+        for r in rows:
+            if test(values[r]):
+                res[r] = 1
+        return res
+
+
+class TrigramIndex(object):
+    # For each three character substring of a column, the rows containing it
+    def __init__(self, values, cancelled=None):
+        self.postings = {}
+        self.dirty = set()
+        for i, v in enumerate(values):
+            if cancelled is not None and not i & 0xFFFF and cancelled():
+                return
+            for t in set(v[j:j+3] for j in range(len(v) - 2)):
+                p = self.postings.get(t, None)
+                if p is None:
+                    p = self.postings[t] = array('l')
+                p.append(i)
+
+    def candidates(self, text):
+        # rows that may contain text, or None if the index cannot help
+        if len(text) < 3:
+            return None
+        lists = []
+        for t in set(text[j:j+3] for j in range(len(text) - 2)):
+            p = self.postings.get(t, None)
+            if p is None:
+                return sorted(self.dirty)
+            lists.append(p)
+        lists.sort(key=len)
+        res = set(lists[0])
+        for p in lists[1:]:
+            res.intersection_update(p)
+            if not len(res):
+                break
+        res.update(self.dirty)
+        return sorted(res)
+
+
+def filterColumn(values, filt, old=None, index=None, cancelled=None, chunkSize=65536):
+    # The mask of values matching filt, worked out a chunk at a time so that
+    # it can be given up part way, when it returns None.
+    rows = None
+    if filt.narrows(old[0] if old is not None else None):
+        rows = old[1]
+    elif index is not None and filt.pattern is None:
+        candidates = index.candidates(filt.text)
+        if candidates is not None:
+            return filt.mask(values, candidates)
+    res = bytearray()
+    for start in range(0, len(values), chunkSize):
+        if cancelled is not None and cancelled():
+            return None
+        part = values[start:start+chunkSize]
+        res += filt.mask(part, None if rows is None else
+                                    compress(range(len(part)), rows[start:start+chunkSize]))
+    return res
+
+def andMasks(masks):
+    res = None
+    for m in masks:
+        if res is None:
+            res = m
+        else:
+            res = (int.from_bytes(res, 'little') & int.from_bytes(m, 'little')).to_bytes(len(m), 'little')
+    return res
+
+def filteredRows(order, mask):
+    if mask is None:
+        return array('l', order)
+    if isinstance(order, range):
+        return array('l', compress(order, mask))
+    return array('l', compress(order, map(mask.__getitem__, order)))
+
+
+class SearchIndex(object):
+    # The sorted shown rows matching a search in one column, kept up to date
+    # as rows are edited, inserted and removed.
+    def __init__(self, filt, positions):
+        self.filt = filt
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def next(self, row):
+        # (row, k) of the first match after row, wrapping round, or None
+        if not len(self.positions):
+            return None
+        i = bisect_right(self.positions, row)
+        if i == len(self.positions):
+            i = 0
+        return (self.positions[i], i + 1)
+
+    def prev(self, row):
+        if not len(self.positions):
+            return None
+        i = bisect_left(self.positions, row) - 1
+        if i < 0:
+            i = len(self.positions) - 1
+        return (self.positions[i], i + 1)
+
+    def update(self, row, matched):
+        i = bisect_left(self.positions, row)
+        found = i < len(self.positions) and self.positions[i] == row
+        if matched and not found:
+            self.positions.insert(i, row)
+        elif found and not matched:
+            del self.positions[i]
+
+    def insertRows(self, first, matched):
+        # matched says which of the rows inserted at first match
+        count = len(matched)
+        i = bisect_left(self.positions, first)
+        tail = array('l', (p + count for p in self.positions[i:]))
+        del self.positions[i:]
+        self.positions.extend(compress(range(first, first + count), matched))
+        self.positions.extend(tail)
+
+    def removeRows(self, first, last):
+        count = last - first + 1
+        i = bisect_left(self.positions, first)
+        j = bisect_right(self.positions, last)
+        tail = array('l', (p - count for p in self.positions[j:]))
+        del self.positions[i:]
+        self.positions.extend(tail)
+
+
+class FilterWorker(QtCore.QThread):
+    # Works out the rows to show from a snapshot of the filtered columns,
+    # read here so that a large file is not parsed on the GUI thread
+    def __init__(self, specs, order, useIndex, generation, parent=None):
+        super(FilterWorker, self).__init__(parent)
+        self.specs = specs          # [(col, ColumnFilter, column reader, old, index)]
+        self.order = order
+        self.useIndex = useIndex
+        self.generation = generation
+        self.cancelled = False
+        self.masks = {}
+        self.indices = {}
+        self.rows = None
+        self.failed = False
+
+    def isCancelled(self):
+        return self.cancelled
+
+    def run(self):
+        for col, filt, reader, old, index in self.specs:
+            try:
+                values = reader(self.isCancelled)
+            except ValueError:
+                # the file was closed or remapped under the reader
+                self.failed = True
+                return
+            if values is None:
+                return
+            if self.useIndex and index is None and filt.pattern is None and not filt.narrows(
+                    old[0] if old is not None else None):
+                index = self.indices[col] = TrigramIndex(values, self.isCancelled)
+            mask = filterColumn(values, filt, old, index, self.isCancelled)
+            if mask is None:
+                return
+            self.masks[col] = (filt, mask)
+        if self.cancelled:
+            return
+        self.rows = filteredRows(self.order, andMasks(m[1] for m in self.masks.values()))
+
+
+class FilterProxy(QtCore.QAbstractProxyModel):
+    # Keeps the source rows shown, in the order shown, in self._rows. Each
+    # column filter's matches are cached as a bytearray over the source rows,
+    # so narrowing a filter only retests rows it matched before. Filtering as
+    # the user types runs on a FilterWorker, restarted at each keystroke.
+    filterDelay = 150
     def __init__(self, parent=None):
         super(FilterProxy, self).__init__(parent)
         self.filters = []
+        self.masks = {}         # column -> (ColumnFilter, bytearray)
+        self.indices = {}       # column -> TrigramIndex
+        self.useIndex = False
+        self.searches = {}      # column -> SearchIndex over shown rows
+        self.rowsInserted.connect(self._searchRowsInserted)
+        self.rowsRemoved.connect(self._searchRowsRemoved)
+        self.dataChanged.connect(self._searchDataChanged)
+        for sig in (self.rowsMoved, self.layoutChanged, self.modelReset,
+                    self.columnsInserted, self.columnsRemoved):
+            sig.connect(self._clearSearches)
+        self.worker = None
+        self._generation = 0
+        self.filterTimer = QtCore.QTimer(self)
+        self.filterTimer.setSingleShot(True)
+        self.filterTimer.setInterval(self.filterDelay)
+        self.filterTimer.timeout.connect(self.startFilter)
+        self.sortSpec = []      # [(column, order)], most significant first
+        self.sortKinds = {}     # column name -> sort key kind
+        self.collation = None
+        self.keys = {}          # column -> (key function, key of each source row)
+        self.orders = {}        # tuple(sortSpec) -> sorted source rows
+        self._rows = array('l')
+        self._pos = None
+        self._persistent = None
+
+    def setSourceModel(self, model):
+        old = self.sourceModel()
+        if old is not None:
+            for sig, slot in self._connections():
+                getattr(old, sig).disconnect(slot)
+        self.beginResetModel()
+        super(FilterProxy, self).setSourceModel(model)
+        for sig, slot in self._connections():
+            getattr(model, sig).connect(slot)
+        self._resetRows()
+        self.endResetModel()
+
+    def _connections(self):
+        return [('dataChanged', self._sourceDataChanged),
+                ('headerDataChanged', self._sourceHeaderDataChanged),
+                ('rowsInserted', self._sourceRowsInserted),
+                ('rowsAboutToBeRemoved', self._sourceRowsAboutToBeRemoved),
+                ('rowsRemoved', self._sourceRowsRemoved),
+                ('columnsAboutToBeInserted', self._sourceColumnsAboutToBeInserted),
+                ('columnsInserted', self._sourceColumnsInserted),
+                ('columnsAboutToBeRemoved', self._sourceColumnsAboutToBeRemoved),
+                ('columnsRemoved', self._sourceColumnsRemoved),
+                ('modelAboutToBeReset', self.beginResetModel),
+                ('modelReset', self._sourceModelReset),
+                ('layoutAboutToBeChanged', self._sourceLayoutAboutToBeChanged),
+                ('layoutChanged', self._sourceLayoutChanged)]
 
     def setFilters(self, filters):
         self.filters = filters
         for i, f in enumerate(filters):
             f.checkBox.stateChanged.connect(self.filterChanged)
+            f.lineEdit.textChanged.connect(self.scheduleFilter)
             f.lineEdit.returnPressed.connect(lambda f=f,y=i:self.filterReturn(f, y))
             f.arrow(True).clicked.connect(lambda e,x=f,y=i: x.parent().findNextInColumn(y, x))
             f.arrow(False).clicked.connect(lambda e,x=f,y=i: x.parent().findPrevInColumn(y, x))
+        self.invalidateFilter()
 
     @QtCore.pyqtSlot(int)
     def filterChanged(self, state):
-        self.invalidateFilter()
+        self.startFilter()
 
     def filterReturn(self, filt, col):
         if filt.checkBox.isChecked():
-            self.invalidateFilter()
+            self.startFilter()
         else:
             filt.parent().findNextInColumn(col, filt)
 
-    def filterAcceptsRow(self, row, parent):
+    # mapping
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        m = self.sourceModel()
+        return 0 if parent.isValid() or m is None else m.columnCount()
+
+    def index(self, row, col, parent=QtCore.QModelIndex()):
+        if parent.isValid() or row < 0 or row >= len(self._rows) or col < 0 or col >= self.columnCount():
+            return QtCore.QModelIndex()
+        return self.createIndex(row, col)
+
+    def parent(self, index=None):
+        return QtCore.QModelIndex()
+
+    def mapToSource(self, index):
+        if not index.isValid() or index.row() >= len(self._rows):
+            return QtCore.QModelIndex()
+        return self.sourceModel().index(self._rows[index.row()], index.column())
+
+    def mapFromSource(self, index):
+        if not index.isValid():
+            return QtCore.QModelIndex()
+        row = self.proxyRow(index.row())
+        if row < 0:
+            return QtCore.QModelIndex()
+        return self.createIndex(row, index.column())
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        # columns are the source's; rows go through the shown rows, as the
+        # base class's mapping fails when no rows are shown
+        m = self.sourceModel()
+        if m is None:
+            return None
+        if orientation == QtCore.Qt.Vertical:
+            if section < 0 or section >= len(self._rows):
+                return None
+            section = self._rows[section]
+        return m.headerData(section, orientation, role)
+
+    def setHeaderData(self, section, orientation, value, role=QtCore.Qt.EditRole):
+        m = self.sourceModel()
+        if m is None:
+            return False
+        if orientation == QtCore.Qt.Vertical:
+            if section < 0 or section >= len(self._rows):
+                return False
+            section = self._rows[section]
+        return m.setHeaderData(section, orientation, value, role)
+
+    def proxyRow(self, row):
+        # the shown row of a source row, or -1 if it is filtered out
+        if self._pos is not None:
+            return self._pos[row] if row < len(self._pos) else -1
+        p = self._sortedPos(self._rows, row)
+        return p if p < len(self._rows) and self._rows[p] == row else -1
+
+    def proxyRows(self, first, last):
+        # the shown rows of the source rows first to last
+        if len(self.sortSpec) and last - first > 1000:
+            if self._pos is None:
+                pos = array('l', [-1]) * self.sourceModel().rowCount()
+                for i, r in enumerate(self._rows):
+                    pos[r] = i
+                self._pos = pos
+            return [p for p in self._pos[first:last+1] if p >= 0]
+        return [p for p in map(self.proxyRow, range(first, last + 1)) if p >= 0]
+
+    def loadConfig(self, config):
+        self.useIndex = config.get('filterIndex', False)
+        self.sortKinds = config.get('sortKeys', None) or {}
+        self.collation = config.get('collation', None)
+        self.keys = {}
+        self.orders = {}
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        # shift+click sorts by another column within the current sort
+        spec = [s for s in self.sortSpec if s[0] != column]
+        if column < 0:
+            spec = []
+        elif QtWidgets.QApplication.keyboardModifiers() & QtCore.Qt.ShiftModifier:
+            spec.append((column, order))
+        else:
+            spec = [(column, order)]
+        self.sortSpec = spec
+        self._generation += 1
+        self.invalidateFilter()
+
+    def sortKeys(self, col):
+        res = self.keys.get(col, None)
+        if res is None:
+            m = self.sourceModel()
+            kind = self.sortKinds.get(m.headerData(col, QtCore.Qt.Horizontal), 'auto')
+            res = self.keys[col] = columnKeys(m.columnValues(col), kind, self.collation)
+        return res[1]
+
+    def sourceOrder(self):
+        # all the source rows in the order they are shown, cached per sort
+        num = self.sourceModel().rowCount()
+        if not len(self.sortSpec):
+            return range(num)
+        spec = tuple(self.sortSpec)
+        res = self.orders.get(spec, None)
+        if res is None:
+            rows = list(range(num))
+            # stable sorts from the least significant column
+            for col, order in reversed(spec):
+                rows.sort(key=self.sortKeys(col).__getitem__, reverse=order == QtCore.Qt.DescendingOrder)
+            res = self.orders[spec] = array('l', rows)
+        return res
+
+    def _compareRows(self, a, b):
+        # <0, 0 or >0 as source row a sorts before, with or after b
+        for col, order in self.sortSpec:
+            keys = self.sortKeys(col)
+            ka, kb = keys[a], keys[b]
+            if ka != kb:
+                res = -1 if ka < kb else 1
+                return res if order == QtCore.Qt.AscendingOrder else -res
+        return a - b
+
+    def _sortedPos(self, rows, row):
+        # where row goes in rows, which are in sort order
+        if not len(self.sortSpec):
+            return bisect_left(rows, row)
+        lo, hi = 0, len(rows)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._compareRows(rows[mid], row) < 0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # searching
+
+    def findInColumn(self, col, spec, row, backwards=False):
+        # (row, k, N) for the next or previous shown row from row matching
+        # spec in col, where it is the kth of N matches, or None.
+        search = self.searchIndex(col, spec)
+        if search is None:
+            return None
+        res = search.prev(row) if backwards else search.next(row)
+        if res is None:
+            return None
+        return (res[0], res[1], len(search))
+
+    def searchIndex(self, col, spec):
+        if spec is None:
+            return None
+        filt = ColumnFilter(*spec)
+        if not filt.valid:
+            return None
+        search = self.searches.get(col, None)
+        if search is None or search.filt.key() != filt.key():
+            mask = filterColumn(self.sourceModel().columnValues(col), filt)
+            search = SearchIndex(filt, array('l', compress(range(len(self._rows)),
+                                                         map(mask.__getitem__, self._rows))))
+            self.searches[col] = search
+        return search
+
+    def _clearSearches(self, *args):
+        self.searches = {}
+
+    def _searchRowsInserted(self, parent, first, last):
+        m = self.sourceModel()
+        for col, search in self.searches.items():
+            search.insertRows(first, [search.filt.test(m.data(m.index(self._rows[p], col)))
+                                        for p in range(first, last + 1)])
+
+    def _searchRowsRemoved(self, parent, first, last):
+        for search in self.searches.values():
+            search.removeRows(first, last)
+
+    def _searchDataChanged(self, topLeft, bottomRight, roles=[]):
+        if len(roles) and QtCore.Qt.DisplayRole not in roles and QtCore.Qt.EditRole not in roles:
+            return
+        first, last = topLeft.row(), bottomRight.row()
+        if last - first > 1000:
+            self.searches = {}
+            return
         m = self.sourceModel()
+        for col, search in self.searches.items():
+            if topLeft.column() <= col <= bottomRight.column():
+                for p in range(first, last + 1):
+                    search.update(p, search.filt.test(m.data(m.index(self._rows[p], col))))
+
+    # filtering
+
+    def invalidateFilter(self):
+        self.cancelFilter()
+        self.setRows(self.filterRows())
+
+    def filterRows(self):
+        return filteredRows(self.sourceOrder(), self.filterMask())
+
+    def filterSpecs(self):
+        # (column, ColumnFilter) for each active filter
+        res = []
         for i, f in enumerate(self.filters):
-            if f.checkBox.isChecked():
-                t = m.data(m.index(row, i, parent))
-                if t is None:
-                    return True
-                elif not f.isRegex():
-                    if not f.lineEdit.text() in t:
-                        return False
-                elif not re.search(f.lineEdit.text(), t):
-                    return False
+            if i >= self.columnCount():
+                break
+            spec = f.getFilter()
+            if spec is not None:
+                res.append((i, ColumnFilter(*spec)))
+        return res
+
+    def filterMask(self):
+        # the rows accepted by every active filter, or None for all of them
+        masks = {}
+        for i, filt in self.filterSpecs():
+            old = self.masks.get(i, None)
+            if old is None or old[0].key() != filt.key():
+                index = None
+                if self.useIndex and filt.pattern is None:
+                    index = self.indices.get(i, None)
+                    if index is None:
+                        index = self.indices[i] = TrigramIndex(self.sourceModel().columnValues(i))
+                old = (filt, filterColumn(self.sourceModel().columnValues(i), filt, old, index))
+            masks[i] = old
+        self.masks = masks
+        return andMasks(m[1] for m in masks.values())
+
+    def scheduleFilter(self):
+        self.cancelFilter()
+        self.filterTimer.start()
+
+    def startFilter(self):
+        # Hands the filters that changed to a worker, with a copy of their
+        # columns, unless nothing has changed
+        self.filterTimer.stop()
+        self.cancelFilter()
+        m = self.sourceModel()
+        specs = []
+        changed = False
+        for i, filt in self.filterSpecs():
+            old = self.masks.get(i, None)
+            if old is not None and old[0].key() == filt.key():
+                specs.append((i, filt, None, old, None))
+            else:
+                specs.append((i, filt, m.columnReader(i), old, self.indices.get(i, None)))
+                changed = True
+        if not changed and len(specs) == len(self.masks):
+            return
+        order = self.sourceOrder()
+        if not isinstance(order, range):
+            order = array('l', order)
+        worker = FilterWorker([s for s in specs if s[2] is not None], order,
+                              self.useIndex, self._generation, self)
+        # unchanged filters keep their masks
+        worker.masks.update((s[0], s[3]) for s in specs if s[2] is None)
+        worker.finished.connect(lambda w=worker: self._filterFinished(w))
+        self.worker = worker
+        worker.start()
+
+    def cancelFilter(self):
+        # a cancelled worker stops at its next chunk and is then deleted
+        if self.worker is not None:
+            self.worker.cancelled = True
+            self.worker = None
+
+    def _filterFinished(self, worker):
+        worker.deleteLater()
+        if worker is not self.worker or (worker.rows is None and not worker.failed):
+            return
+        self.worker = None
+        if worker.failed:
+            # filtered here instead, so that a failing read is not retried
+            self.invalidateFilter()
+            return
+        if worker.generation != self._generation:
+            # the data changed under the worker
+            self.startFilter()
+            return
+        m = self.sourceModel()
+        count = m.rowCount()
+        rows = worker.rows
+        if len(worker.order) < count:
+            # rows appended while the worker ran, as when loading, are tested
+            # here rather than filtering everything again
+            for col, (filt, mask) in worker.masks.items():
+                if len(mask) < count:
+                    mask.extend(filt.mask([m.data(m.index(r, col)) for r in range(len(mask), count)]))
+            rows = filteredRows(self.sourceOrder(), andMasks(v[1] for v in worker.masks.values()))
+        else:
+            self.indices.update(worker.indices)
+        self.masks = worker.masks
+        self.setRows(rows)
+
+    def setRows(self, rows):
+        # Swaps in a new mapping, moving persistent indices to follow their rows
+        self.layoutAboutToBeChanged.emit()
+        old = self.persistentIndexList()
+        sources = [(self._rows[i.row()], i.column()) for i in old]
+        self._rows = rows
+        self._pos = None
+        new = []
+        for r, c in sources:
+            p = self.proxyRow(r)
+            new.append(self.createIndex(p, c) if p >= 0 else QtCore.QModelIndex())
+        self.changePersistentIndexList(old, new)
+        self.layoutChanged.emit()
+
+    def _resetRows(self):
+        self._generation += 1
+        self.masks = {}
+        self.indices = {}
+        self.keys = {}
+        self.orders = {}
+        m = self.sourceModel()
+        self._rows = self.filterRows() if m is not None else array('l')
+        self._pos = None
+
+    def _accepts(self, row):
+        for col, (filt, mask) in self.masks.items():
+            if not mask[row]:
+                return False
         return True
 
+    # source changes
+
+    def _sourceDataChanged(self, topLeft, bottomRight, roles=[]):
+        first, last = topLeft.row(), bottomRight.row()
+        if not len(roles) or QtCore.Qt.DisplayRole in roles or QtCore.Qt.EditRole in roles:
+            self._refilterRows(first, last, topLeft.column(), bottomRight.column())
+            self._updateSortKeys(first, last, topLeft.column(), bottomRight.column())
+        if not len(self.sortSpec):
+            # shown rows are in source order
+            rows = [bisect_left(self._rows, first), bisect_right(self._rows, last) - 1]
+        elif last - first > 1000:
+            rows = [0, len(self._rows) - 1]
+        else:
+            rows = self.proxyRows(first, last)
+        if len(rows) and min(rows) <= max(rows):
+            self.dataChanged.emit(self.index(min(rows), topLeft.column()),
+                                  self.index(max(rows), bottomRight.column()), roles)
+
+    def _refilterRows(self, first, last, firstCol, lastCol):
+        # retest edited rows against the filters on their columns
+        m = self.sourceModel()
+        changed = False
+        for col, (filt, mask) in self.masks.items():
+            if firstCol <= col <= lastCol:
+                for r in range(first, last + 1):
+                    mask[r] = filt.test(m.data(m.index(r, col)))
+                changed = True
+        if firstCol <= lastCol and (self.worker is not None or self.filterTimer.isActive()):
+            self._generation += 1
+        for col in range(firstCol, lastCol + 1):
+            index = self.indices.get(col, None)
+            if index is not None:
+                index.dirty.update(range(first, last + 1))
+        if not changed:
+            return
+        if last - first > 1000:
+            self.setRows(filteredRows(self.sourceOrder(), andMasks(m[1] for m in self.masks.values())))
+            return
+        for r in range(first, last + 1):
+            p = self.proxyRow(r)
+            if p >= 0 and not self._accepts(r):
+                self.beginRemoveRows(QtCore.QModelIndex(), p, p)
+                del self._rows[p]
+                self._pos = None
+                self.endRemoveRows()
+            elif p < 0 and self._accepts(r):
+                self._insertSourceRows([r])
+
+    def _updateSortKeys(self, first, last, firstCol, lastCol):
+        # Edited rows get new keys and are moved to their new place in the
+        # cached order and among the shown rows, rather than resorting
+        m = self.sourceModel()
+        edited = [c for c in self.keys if firstCol <= c <= lastCol]
+        if not len(edited):
+            return
+        spec = tuple(self.sortSpec)
+        for s in [s for s in self.orders if s != spec and any(c in edited for c, o in s)]:
+            del self.orders[s]
+        sorting = any(c in edited for c, o in spec)
+        if sorting and last - first <= 1000:
+            order = self.orders.get(spec, None)
+            for r in range(first, last + 1):
+                # where the row is shown, found with its old keys
+                p = self.proxyRow(r)
+                try:
+                    for col in edited:
+                        fn, keys = self.keys[col]
+                        keys[r] = fn(m.data(m.index(r, col)))
+                except ValueError:
+                    break
+                if order is not None:
+                    del order[order.index(r)]
+                    order.insert(self._sortedPos(order, r), r)
+                if p >= 0:
+                    self._moveShownRow(p, r)
+            else:
+                return
+        else:
+            try:
+                for col in edited:
+                    fn, keys = self.keys[col]
+                    keys[first:last+1] = [fn(m.data(m.index(r, col))) for r in range(first, last + 1)]
+            except ValueError:
+                pass
+            else:
+                if not sorting:
+                    return
+        # a number column with text in it now, or too many rows to move one by one
+        for col in edited:
+            self.keys.pop(col, None)
+        self.orders.pop(spec, None)
+        self.setRows(filteredRows(self.sourceOrder(), andMasks(m[1] for m in self.masks.values())))
+
+    def _insertPos(self, row):
+        # where a source row not yet shown goes among the shown rows
+        return self._sortedPos(self._rows, row)
+
+    def _moveShownRow(self, p, row):
+        # puts the row shown at p, whose sort keys have changed, back in order
+        del self._rows[p]
+        q = self._insertPos(row)
+        self._rows.insert(p, row)
+        if q == p:
+            return
+        self.beginMoveRows(QtCore.QModelIndex(), p, p, QtCore.QModelIndex(), q if q < p else q + 1)
+        del self._rows[p]
+        self._rows.insert(q, row)
+        self._pos = None
+        self.endMoveRows()
+
+    def _insertSourceRows(self, rows):
+        # rows are in ascending source order
+        if len(self.sortSpec) and len(rows) > 64:
+            # quicker to redo the mapping than to place each row
+            self.setRows(filteredRows(self.sourceOrder(), andMasks(m[1] for m in self.masks.values())))
+            return
+        if not len(self.sortSpec) and len(rows):
+            # all go in one run when every new row follows the shown ones
+            pos = bisect_left(self._rows, rows[0])
+            if pos == len(self._rows):
+                self.beginInsertRows(QtCore.QModelIndex(), pos, pos + len(rows) - 1)
+                self._rows.extend(rows)
+                self._pos = None
+                self.endInsertRows()
+                return
+        for r in rows:
+            pos = self._insertPos(r)
+            self.beginInsertRows(QtCore.QModelIndex(), pos, pos)
+            self._rows.insert(pos, r)
+            self._pos = None
+            self.endInsertRows()
+
+    def _sourceRowsInserted(self, parent, first, last):
+        count = last - first + 1
+        m = self.sourceModel()
+        if first != m.rowCount() - count:
+            # a running worker catches up with appended rows when it finishes
+            self._generation += 1
+        if len(self._rows) and max(self._rows) >= first:
+            self._rows = array('l', (r + count if r >= first else r for r in self._rows))
+        self._pos = None
+        self.indices = {}
+        for col, (filt, mask) in self.masks.items():
+            mask[first:first] = filt.mask([m.data(m.index(r, col)) for r in range(first, last + 1)])
+        for col, (fn, keys) in list(self.keys.items()):
+            try:
+                keys[first:first] = [fn(m.data(m.index(r, col))) for r in range(first, last + 1)]
+            except ValueError:
+                del self.keys[col]
+        self.orders = {}
+        self._insertSourceRows([r for r in range(first, last + 1) if self._accepts(r)])
+
+    def _sourceRowsAboutToBeRemoved(self, parent, first, last):
+        rows = sorted(self.proxyRows(first, last))
+        # remove runs of shown rows, last first
+        while len(rows):
+            end = len(rows) - 1
+            start = end
+            while start > 0 and rows[start-1] == rows[start] - 1:
+                start -= 1
+            self.beginRemoveRows(QtCore.QModelIndex(), rows[start], rows[end])
+            del self._rows[rows[start]:rows[end]+1]
+            self._pos = None
+            self.endRemoveRows()
+            del rows[start:]
+
+    def _sourceRowsRemoved(self, parent, first, last):
+        self._generation += 1
+        count = last - first + 1
+        self._rows = array('l', (r - count if r > last else r for r in self._rows))
+        self._pos = None
+        self.indices = {}
+        for col, (filt, mask) in self.masks.items():
+            del mask[first:last+1]
+        for col, (fn, keys) in self.keys.items():
+            del keys[first:last+1]
+        self.orders = {}
+
+    def _sourceColumnsAboutToBeInserted(self, parent, first, last):
+        self.beginInsertColumns(QtCore.QModelIndex(), first, last)
+
+    def _sourceColumnsInserted(self, parent, first, last):
+        self._shiftColumns(first, last - first + 1)
+        self.endInsertColumns()
+
+    def _sourceColumnsAboutToBeRemoved(self, parent, first, last):
+        self.beginRemoveColumns(QtCore.QModelIndex(), first, last)
+
+    def _sourceColumnsRemoved(self, parent, first, last):
+        self._shiftColumns(first, -(last - first + 1))
+        self.endRemoveColumns()
+
+    def _shiftColumns(self, first, count):
+        self._generation += 1
+        # caches follow their columns; sorting by a removed column stops
+        def shifted(d):
+            return {(c + count if c >= first else c): v for c, v in d.items()
+                        if count > 0 or c < first or c >= first - count}
+        self.masks = shifted(self.masks)
+        self.indices = shifted(self.indices)
+        self.keys = shifted(self.keys)
+        self.orders = {}
+        self.sortSpec = [((c + count if c >= first else c), o) for c, o in self.sortSpec
+                            if count > 0 or c < first or c >= first - count]
+
+    def _sourceHeaderDataChanged(self, orientation, first, last):
+        if orientation == QtCore.Qt.Horizontal:
+            self.headerDataChanged.emit(orientation, first, last)
+        elif len(self._rows):
+            self.headerDataChanged.emit(orientation, 0, len(self._rows) - 1)
+
+    def _sourceModelReset(self):
+        self._resetRows()
+        self.endResetModel()
+
+    def _sourceLayoutAboutToBeChanged(self):
+        # source rows may move anywhere, so hold on to them by source index
+        self.layoutAboutToBeChanged.emit()
+        m = self.sourceModel()
+        old = self.persistentIndexList()
+        self._persistent = (old, [QtCore.QPersistentModelIndex(m.index(self._rows[i.row()], i.column()))
+                                    for i in old])
+
+    def _sourceLayoutChanged(self):
+        old, sources = self._persistent
+        self._persistent = None
+        self._generation += 1
+        self.masks = {}
+        self.indices = {}
+        self.keys = {}
+        self.orders = {}
+        self._rows = self.filterRows()
+        self._pos = None
+        new = []
+        for s in sources:
+            p = self.proxyRow(s.row()) if s.isValid() else -1
+            new.append(self.createIndex(p, s.column()) if p >= 0 else QtCore.QModelIndex())
+        self.changePersistentIndexList(old, new)
+        self.layoutChanged.emit()
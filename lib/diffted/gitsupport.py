@@ -1,59 +1,34 @@
+from PyQt5 import QtWidgets, QtGui, QtCore
+from diffted.core.gitrepo import GitSupport, gitTestFile
+from diffted.core.history import CellHistory
+from diffted.core.snapshots import SnapshotCache
+import os
 
-from PyQt5 import QtWidgets, QtGui
-import subprocess
-from subprocess import call, check_output, CalledProcessError, DEVNULL, PIPE
-from io import StringIO
-import os, re
+class HistoryWorker(QtCore.QThread):
+    # Brings the history of which commit last changed each cell up to date,
+    # with its own GitSupport so nothing is shared with the GUI thread
+    def __init__(self, fname, branch, keys, cachedir, history=None, parent=None):
+        super(HistoryWorker, self).__init__(parent)
+        self.fname = fname
+        self.branch = branch
+        self.keys = keys
+        self.cachedir = cachedir
+        self.history = history
+        self.cancelled = False
+        self.done = False
 
-def check_output(cmd, **kw):
-    kw['stdin'] = PIPE
-    kw['stderr'] = DEVNULL
-    if hasattr(subprocess, 'STARTUPINFO'):
-        si = subprocess.STARTUPINFO()
-        si.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-        kw['startupinfo'] = si
-        kw['env'] = os.environ
-    else:
-        kw['shell'] = True
-    return subprocess.check_output(cmd, **kw)
+    def run(self):
+        gs = GitSupport(self.fname)
+        if self.history is None:
+            name = "{}:{}".format(self.branch, os.path.join(gs.top, gs.relname))
+            self.history = CellHistory.load(self.cachedir, name, self.keys)
+        # only this revision and the one before are needed at a time
+        snapshots = SnapshotCache(size=2)
+        self.done = self.history.update(lambda stop: gs.walk(self.branch, stop=stop),
+                                        lambda sha: snapshots.load(sha, gs.blobText),
+                                        lambda: self.cancelled)
+        self.history.save(self.cachedir)
 
-def reldir(fname):
-    dirname = os.path.dirname(fname) or '.'
-    return os.path.relpath(dirname, os.getcwd())
-
-def gitTestFile(fname):
-    path = reldir(fname)
-    if re.match(r"^http[s]?://", fname):
-        return False
-    try:
-        res = check_output("git -C {} ls-files --error-unmatch {}".format(path, os.path.basename(fname)))
-    except FileNotFoundError:
-        res = False
-    except CalledProcessError:
-        res = False
-    else:
-        res = True
-    return res
-
-class GitSupport():
-    def __init__(self, fname):
-        self.path = reldir(fname)
-        self.fname = os.path.basename(fname)
-        res = check_output("git -C {} branch -a".format(self.path)).decode('utf-8')
-        self.branches = []
-        for x in res.splitlines():
-            b = x[2:].strip()
-            if x[0] == "*":
-                self.currbranch = b
-            self.branches.append(b)
-
-    def getfileat(self, branch, modifier):
-        if modifier is None or modifier == "":
-            rev = branch
-        else:
-            rev = branch + "@{" + modifier + "}"
-        res = check_output('git -C {} show "{}:./{}"'.format(self.path, rev, self.fname)).decode('utf-8')
-        return res
 
 class GitToolBar(QtWidgets.QToolBar):
     def __init__(self, parent=None):
@@ -65,6 +40,18 @@ class GitToolBar(QtWidgets.QToolBar):
         self.downAction.triggered.connect(parent.nextDiff)
         self.upAction = QtWidgets.QAction(QtGui.QIcon.fromTheme("up"), "&Previous")
         self.upAction.triggered.connect(parent.lastDiff)
+        self.hunkAction = QtWidgets.QAction("&Hunks")
+        self.hunkAction.setCheckable(True)
+        self.hunkAction.setToolTip("Next and Previous jump between runs of changed rows")
+        self.blameAction = QtWidgets.QAction("&Blame")
+        self.blameAction.setCheckable(True)
+        self.blameAction.setToolTip("Show which commit last changed each cell")
+        self.blameAction.triggered.connect(self.blameActionChanged)
+        self.histories = {}
+        self.historyWorker = None
+        self.mergeAction = QtWidgets.QAction("&Merge")
+        self.mergeAction.setToolTip("Merge the chosen branch into the table, marking conflicts")
+        self.mergeAction.triggered.connect(self.mergeActionTriggered)
         self.branch = QtWidgets.QComboBox(self)
         self.branchLabel = QtWidgets.QLabel("Branch", self)
         self.version = QtWidgets.QLineEdit(self)
@@ -79,15 +66,24 @@ class GitToolBar(QtWidgets.QToolBar):
         self.addAction(self.diffAction)
         self.addAction(self.downAction)
         self.addAction(self.upAction)
+        self.addAction(self.hunkAction)
+        self.addAction(self.blameAction)
+        self.addAction(self.mergeAction)
         self.hide()
 
     def changeFileName(self, fname, model, view):
+        self.cancelHistory()
+        self.histories = {}
+        if self.blameAction.isChecked():
+            self.blameAction.setChecked(False)
+            model.setHistory(None)
         if not gitTestFile(fname):
             self.hide()
             self.model = None
             return
         self.model = model
         self.view = view
+        self.fname = fname
         self.gs = GitSupport(fname)
         self.branch.clear()
         self.branch.addItems(self.gs.branches)
@@ -101,11 +97,64 @@ class GitToolBar(QtWidgets.QToolBar):
             return
         v = self.diffAction.isChecked()
         if v:
-            s = self.gs.getfileat(self.branch.currentText(), self.version.text())
-            if s:
-                fh = StringIO(s)
-                self.model.loadDiffCsv(fh)
-                fh.close()
+            sha = self.gs.blobat(self.branch.currentText(), self.version.text())
+            if sha is not None:
+                self.model.loadDiffBlob(sha, self.gs.blobText)
         else:
             self.model.dumpDiff()
         self.view.update()
+
+    def mergeActionTriggered(self):
+        if self.model is None:
+            return
+        branch = self.branch.currentText()
+        theirs = self.gs.revision(branch, self.version.text())
+        theirsSha = self.gs.blobat(branch, self.version.text())
+        status = self.parent().statusBar()
+        if theirsSha is None:
+            status.showMessage("{} has no {}".format(theirs, self.gs.fname))
+            return
+        base = self.gs.mergeBase("HEAD", theirs)
+        baseSha = self.gs.blobat(base, None) if base is not None else None
+        self.diffAction.setChecked(True)
+        conflicts = self.model.loadMergeBlobs(baseSha, theirsSha, self.gs.blobText)
+        if conflicts is None:
+            status.showMessage("Could not read {}".format(theirs))
+        else:
+            status.showMessage("Merged {}, {} conflicts".format(theirs, conflicts))
+        self.view.update()
+
+    def blameActionChanged(self):
+        if self.model is None:
+            self.blameAction.setChecked(False)
+            return
+        self.cancelHistory()
+        if not self.blameAction.isChecked():
+            self.model.setHistory(None)
+            return
+        branch = self.branch.currentText()
+        key = (branch, repr(self.model.keys))
+        worker = HistoryWorker(self.fname, branch, self.model.keys, self.model.snapshots.cachedir,
+                               self.histories.pop(key, None), self)
+        worker.finished.connect(lambda w=worker, k=key: self._historyFinished(w, k))
+        self.historyWorker = worker
+        self.parent().statusBar().showMessage("Reading history of {}...".format(branch))
+        worker.start()
+
+    def _historyFinished(self, worker, key):
+        if worker is not self.historyWorker:
+            return
+        self.historyWorker = None
+        worker.deleteLater()
+        if not worker.done:
+            return
+        self.histories[key] = worker.history
+        self.model.setHistory(worker.history)
+        self.parent().statusBar().showMessage("History read, {} commits changed the file".format(len(worker.history.commits)))
+
+    def cancelHistory(self):
+        if self.historyWorker is not None:
+            self.historyWorker.cancelled = True
+            self.historyWorker.wait()
+            self.historyWorker.deleteLater()
+            self.historyWorker = None
@@ -5,11 +5,31 @@ from diffted.tablemodel import DitTableModel
 from diffted.tableview import DitTableView
 from diffted.filter import FilterProxy
 from diffted.dialogs import GithubCredentialsDialog
-from diffted import gitsupport, urls
+from diffted import gitsupport
+from diffted.core import urls
 from collections import namedtuple
-import yaml, os
+import os
+
+class FetchWorker(QtCore.QThread):
+    # Opens a remote file off the GUI thread
+    def __init__(self, fname, config, parent=None):
+        super(FetchWorker, self).__init__(parent)
+        self.fname = fname
+        self.config = config
+        self.gui = parent
+        self.fh = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.fh = urls.openFile(self.fname, 'r', config=self.config, gui=self.gui)
+        except IOError as e:
+            self.error = e
+
 
 class Main(QtWidgets.QMainWindow):
+    pushStatus = QtCore.pyqtSignal(str)
+
     def __init__(self, app):
         super(Main, self).__init__()
         self.app = app
@@ -18,6 +38,7 @@ class Main(QtWidgets.QMainWindow):
         self.recents = []
         self.credentials = {}
         self.fileSettings = {}
+        self.fetcher = None
         self.readSettings()
         self.actions = {}
         self.tableView = DitTableView()
@@ -26,6 +47,15 @@ class Main(QtWidgets.QMainWindow):
         self.proxy.setSourceModel(self.model)
         self.tableView.setModel(self.proxy)
         self.model.modelReset.connect(self.tableView.resetModel)
+        self.progress = QtWidgets.QProgressBar()
+        self.progress.setMaximumWidth(200)
+        self.progress.hide()
+        self.statusBar().addPermanentWidget(self.progress)
+        self.model.loadProgress.connect(self.progress.setValue)
+        self.model.loadFinished.connect(self.progress.hide)
+        self.tableView.searchStatus.connect(self.statusBar().showMessage)
+        # pushes to github report from their own thread
+        self.pushStatus.connect(self.statusBar().showMessage)
         self.setCentralWidget(self.tableView)
         self.mainActions()
         self.createMenu()
@@ -107,8 +137,44 @@ class Main(QtWidgets.QMainWindow):
         fname = self.config['datafile']
         if self.config_file is not None:
             fname = os.path.join(os.path.dirname(self.config_file), fname)
-        with urls.openFile(fname, 'r', gui=self) as fh:
-            self.model.loadFromCsv(fh, self.config)
+        if urls.isGithub(fname):
+            # fetched in the background, the window stays live meanwhile
+            self.cancelFetch()
+            self.fetcher = FetchWorker(fname, self.config, self)
+            self.fetcher.finished.connect(lambda w=self.fetcher: self._fetchFinished(w))
+            self.progress.setRange(0, 0)
+            self.progress.show()
+            self.statusBar().showMessage("Fetching {}...".format(fname))
+            self.fetcher.start()
+            return
+        # the model closes fh once it has finished loading in the background
+        self.loadFile(fname, urls.openFile(fname, 'r', gui=self))
+
+    def _fetchFinished(self, worker):
+        if worker is not self.fetcher:
+            return
+        self.fetcher = None
+        worker.deleteLater()
+        self.progress.hide()
+        if worker.error is not None:
+            self.statusBar().showMessage("Could not fetch {}: {}".format(worker.fname, worker.error))
+            return
+        self.statusBar().clearMessage()
+        self.loadFile(worker.fname, worker.fh)
+
+    def cancelFetch(self):
+        if self.fetcher is not None:
+            # the request cannot be interrupted, so its result is just dropped
+            self.fetcher.finished.disconnect()
+            self.fetcher.finished.connect(self.fetcher.deleteLater)
+            self.fetcher = None
+
+    def loadFile(self, fname, fh):
+        self.model.loadFromCsv(fh, self.config)
+        if self.model.isLoading():
+            self.progress.setRange(0, 0 if self.model.loader.readProgress is None else 100)
+            self.progress.setValue(0)
+            self.progress.show()
         self.toolbars['Git'].changeFileName(fname, self.model, self.tableView)
         fs = self.fileSettings.get(self.config['datafile'], None)
         if fs is not None:
@@ -117,15 +183,17 @@ class Main(QtWidgets.QMainWindow):
 
     def loadconfig(self, fname):
         self.config_file = fname
+        import yaml
         with urls.openFile(fname, 'r', gui=self) as f:
             self.config = yaml.load(f)
         if 'css' in self.config:
             self.app.setStyleSheet(self.app.styleSheet() + self.config['css'])      # bad code for reloading
         self.model.loadConfig(self.config)
+        self.proxy.loadConfig(self.config)
 
     def savefile(self):
         fname = self.config['datafile']
-        if fname is None or fname == "" or not self.model.dataChanged:
+        if fname is None or fname == "" or not self.model.modified:
             return
         if self.config_file is not None:
             fname = os.path.join(os.path.dirname(self.config_file), fname)
@@ -136,6 +204,7 @@ class Main(QtWidgets.QMainWindow):
         fname, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Save CSV File", self.config['datafile'], 
                         "CSV files (*.csv *.tsv);;YAML files (*.yaml)")
         if fname.lower().endswith(".yaml"):
+            import yaml
             self.config_file = fname
             with open(fname, "w") as fh:
                 yaml.dump(self.config, fh)
@@ -186,22 +255,21 @@ class Main(QtWidgets.QMainWindow):
         self.tableView.update()
 
     def nextDiff(self):
-        ci = self.tableView.currentIndex()
-        newi = self.model.nextDiffFrom(ci)
-        if newi is not None:
-            pi = self.proxy.mapFromSource(newi)
-            self.tableView.setCurrentIndex(pi)
-            self.tableView.setFocus()
-            self.tableView.scrollTo(pi)
+        self._gotoDiff(self.model.nextDiffFrom)
 
     def lastDiff(self):
-        ci = self.tableView.currentIndex()
-        newi = self.model.lastDiffFrom(ci)
+        self._gotoDiff(self.model.lastDiffFrom)
+
+    def _gotoDiff(self, fn):
+        hunks = self.toolbars['Git'].hunkAction.isChecked()
+        ci = self.proxy.mapToSource(self.tableView.currentIndex())
+        newi = fn(ci, hunks)
         if newi is not None:
             pi = self.proxy.mapFromSource(newi)
             self.tableView.setCurrentIndex(pi)
-            self.tableView.scrollTo(pi)
             self.tableView.setFocus()
+            self.tableView.scrollTo(pi)
+            self.statusBar().showMessage(self.model.diffStatus(newi, hunks))
 
     def addRecent(self, fname):
         if fname in self.recents:
@@ -212,6 +280,10 @@ class Main(QtWidgets.QMainWindow):
 
     def closeEvent(self, e):
         self.writeSettings()
+        # don't lose saves still waiting to go to github
+        self.busyStart()
+        urls.flushCommits(timeout=60)
+        self.busyStop()
         e.accept()
 
     def readSettings(self):
@@ -1,7 +1,14 @@
 
 from PyQt5 import QtCore, QtGui, QtWidgets
-import csv, os, re, ast
-from difflib import SequenceMatcher
+from diffted.core.store import ColumnStore, MmapStore, LRUCache, fileSize, spliceRows, readCsvRows, readProgress
+from diffted.core.diff import DiffRow, diffRows, cellDiffs, keyIndices, rowKeys, remapRows, alignedKeys, mergeRows
+from diffted.core.rules import RuleSet
+from diffted.core.snapshots import SnapshotCache, parseCsv
+import csv, os
+from itertools import islice, compress, accumulate
+from bisect import bisect_left, bisect_right
+from collections import deque
+from array import array
 
 class EvalStyle(object):
     def __init__(self, rule=None):
@@ -37,7 +44,7 @@ class EvalStyle(object):
 
     def merge(self, p):
         if p.font is not None:
-            self.font = p.resolve(self.font) if self.font is not None else p.font
+            self.font = p.font.resolve(self.font) if self.font is not None else p.font
         if p.backgroundColor is not None:
             self.backgroundColor = p.backgroundColor
         if p.foregroundColor is not None:
@@ -46,7 +53,7 @@ class EvalStyle(object):
     def copy(self):
         res = EvalStyle()
         res.font = self.font
-        res.backgrounColor = self.backgroundColor
+        res.backgroundColor = self.backgroundColor
         res.foregroundColor = self.foregroundColor
         return res
 
@@ -55,279 +62,797 @@ class EvalStyle(object):
             return False
         return True
 
-class Evaluator(object):
-    def __init__(self):
-        self.locals = {}
-        self.fns = {
-            '__builtins__': None,
-            're' : re,
-        }
-        for x in ('True', 'False', 'None', 'int', 'float', 'str', 'abs', 'bool',
-                  'dict', 'enumerate', 'filter', 'hex', 'len', 'list', 'map',
-                  'max', 'min', 'ord', 'range', 'set', 'sorted', 'sum', 'tuple', 'zip'):
-            self.fns[x] = __builtins__[x]
-
-    def is_safe(self, exp):
-        # no dunders in attribute names
-        for n in ast.walk(ast.parse(exp)):
-            if "__" in getattr(n, 'id', ""):
-                return False
-        return True
+DIFFMODES = (None, 'replace', 'insert', 'delete', 'conflict')
+DIFFCODES = {m: i for i, m in enumerate(DIFFMODES)}
+DELETED = DIFFCODES['delete']
+CONFLICT = DIFFCODES['conflict']
 
-    def eval(self, exp, **kw):
-        if exp is None:
-            return True
-        return eval(exp, self.fns, {**self.locals, **kw})
-
-evaluator = Evaluator()
-
-class DiffRow(list):
-    def __hash__(self):
-        return hash(u"\uFDD0".join(self))
-
-class DitItem(QtGui.QStandardItem, QtCore.QObject):
-
-    def __init__(self, *v, model=None):
-        super(QtGui.QStandardItem, self).__init__(*v)
-        self.model = model
-        self.diffStyle = None 
-        self._updateTypes = {'foregroundColor': (self.setForeground, QtGui.QBrush(QtCore.Qt.NoBrush)),
-                             'backgroundColor': (self.setBackground, QtGui.QBrush(QtCore.Qt.NoBrush)),
-                             'font': (self.setFont, QtGui.QFont())}
-        self.evalStyle = None
-        self.diffMode = None
-
-    def setDiffMode(self, mode, styles):
-        self.diffStyle = styles.get(mode, None)
-        if mode != self.diffMode:
-            self.update()
-        self.diffMode = mode
-
-    def mergeEvalStyle(self, p):
-        if self.evalStyle is None:
-            self.evalStyle = EvalStyle()
-        self.evalStyle.mergeStyle(p)
-
-    def setData(self, value, role):
-        super(DitItem, self).setData(value, role)
-        self.model.runRules(row=self.model.indexFromItem(self).row())
-
-    def update(self, changed=True):
-        if self.evalStyle is None and self.diffStyle is None:
-            if not changed:
-                return
-            p = None
-        if self.evalStyle is None:
-            p = self.diffStyle
-        elif self.diffStyle is None:
-            p = self.evalStyle
-        else:
-            p = self.evalStyle.copy()
-            p.merge(self.diffStyle)
-            
-        for ck, cf in self._updateTypes.items():
-            v = getattr(p, ck, None)
-            if v is None:
-#                if not changed:
-#                    continue
-                cf[0](cf[1])
-            else:
-                cf[0](v)
+# a rule id for rows whose rules have yet to be run, in a lazily loaded table
+STALE = 0xFFFFFFFF
+# and how many rows are run at a time when one of them is shown
+RULEBLOCK = 512
+
+def noStyles(num):
+    # per cell ids of the set of rules matching the cell, 0 for none
+    return array('I', [0]) * num
+# files bigger than this are mapped rather than read in, unless lazyLoad says otherwise
+LAZYSIZE = 256 * 1024 * 1024
+
+class CsvLoader(QtCore.QThread):
+
+    rowsReady = QtCore.pyqtSignal()
+    progress = QtCore.pyqtSignal(int)
+
+    def __init__(self, rows, fh, parent=None):
+        super(CsvLoader, self).__init__(parent)
+        self.rows = rows
+        self.fh = fh
+        self.chunks = deque()
+        self.cancelled = False
+        self.readProgress = readProgress(fh)
 
+    def run(self):
+        # start small so the first rows show quickly
+        size = 1000
+        while not self.cancelled:
+            rows = list(islice(self.rows, size))
+            if not len(rows):
+                break
+            self.chunks.append(rows)
+            self.rowsReady.emit()
+            if self.readProgress is not None:
+                self.progress.emit(self.readProgress())
+            size = min(size * 4, 50000)
+        self.fh.close()
+
+class DitTableModel(QtCore.QAbstractTableModel):
+
+    loadProgress = QtCore.pyqtSignal(int)
+    loadFinished = QtCore.pyqtSignal()
+
+    keepTable = bytes(0 if i == DELETED else 1 for i in range(256))
+
+    styleRoles = {QtCore.Qt.ForegroundRole: 'foregroundColor',
+                  QtCore.Qt.BackgroundRole: 'backgroundColor',
+                  QtCore.Qt.FontRole: 'font'}
 
-class DitTableModel(QtGui.QStandardItemModel):
     def __init__(self, parent=None):
         super(DitTableModel, self).__init__(parent)
         self.styles = {}
         self.hasDiff = False
-        self.rules = {}
-        self.itemChanged.connect(self.hasChanged)
+        self.rules = RuleSet()
+        self.ruleStyles = []
+        self.resetStyles()
         self.runningRules = False
+        self.modified = False
+        self.loader = None
+        self.diffEngine = 'sequence'
+        self.keys = None
+        # parsed revisions by blob id, and diffs by (blob id, dataVersion, ...)
+        self.snapshots = SnapshotCache()
+        self.diffs = LRUCache(8)
+        self.dataVersion = 0
+        # which commit last changed each cell, shown as a tooltip
+        self.history = None
+        # (base, theirs) values of conflicting cells from a merge, by row and column name
+        self.conflicts = {}
+        self.ruleTimer = QtCore.QTimer(self)
+        self.ruleTimer.setSingleShot(True)
+        self.ruleTimer.setInterval(0)
+        self.ruleTimer.timeout.connect(self.runPendingRules)
+        self.setStore(ColumnStore())
+
+    def setStore(self, store):
+        if getattr(self, 'store', None) is not None:
+            self.store.close()
+        self.store = store
+        self.dataVersion += 1
+        self.pendingRules = {}
+        self._diffIndex = None
+        num = len(store)
+        # per column side arrays of diff mode codes and rule match ids
+        self.diffModes = [bytearray(num) for x in store.fieldnames]
+        self.ruleIds = [noStyles(num) for x in store.fieldnames]
+
+    @property
+    def fieldnames(self):
+        return self.store.fieldnames
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.store)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.store.fieldnames)
+
+    def resetStyles(self):
+        # Each distinct set of matching rules gets an id, and each pair of id
+        # and diff mode gets one shared style, built when first shown.
+        self.matchIds = {(): 0}
+        self.matchRules = [()]
+        self.styleTable = {}
+
+    def matchId(self, matches):
+        res = self.matchIds.get(matches, None)
+        if res is None:
+            res = self.matchIds[matches] = len(self.matchRules)
+            self.matchRules.append(matches)
+        return res
+
+    def cellStyle(self, row, col):
+        if self.ruleIds[col][row] == STALE:
+            first = row - row % RULEBLOCK
+            self._evalRules(first, min(first + RULEBLOCK, self.rowCount()) - 1)
+        key = self.ruleIds[col][row] * len(DIFFMODES) + self.diffModes[col][row]
+        res = self.styleTable.get(key, self.styleTable)
+        if res is self.styleTable:
+            res = self.styleTable[key] = self.buildStyle(*divmod(key, len(DIFFMODES)))
+        return res
+
+    def buildStyle(self, matchId, mode):
+        evalStyle = self.mergedStyle(self.matchRules[matchId])
+        diffStyle = self.styles.get(DIFFMODES[mode], None)
+        if evalStyle is None:
+            return diffStyle
+        elif diffStyle is not None:
+            evalStyle.merge(diffStyle)
+        return evalStyle
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole or role == QtCore.Qt.EditRole:
+            return self.store.get(index.row(), index.column())
+        attr = self.styleRoles.get(role, None)
+        if attr is not None:
+            return getattr(self.cellStyle(index.row(), index.column()), attr, None)
+        if role == QtCore.Qt.ToolTipRole:
+            if self.diffModes[index.column()][index.row()] == CONFLICT:
+                return self.conflictTip(index.row(), index.column())
+            if self.history is not None and not self.isDeletedRow(index.row()):
+                return self.history.tooltip(self.store.row(index.row()), self.fieldnames, index.column())
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        if not index.isValid() or role != QtCore.Qt.EditRole:
+            return False
+        self.store.set(index.row(), index.column(), value)
+        self.modified = True
+        self.dataVersion += 1
+        self.dataChanged.emit(index, index, [role])
+        self.scheduleRules(index.row(), index.column())
+        return True
+
+    def flags(self, index):
+        res = super(DitTableModel, self).flags(index)
+        if index.isValid() and self.diffModes[index.column()][index.row()] != DELETED:
+            res |= QtCore.Qt.ItemIsEditable
+        return res
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        if orientation == QtCore.Qt.Vertical:
+            return section + 1
+        if section < len(self.fieldnames):
+            return self.fieldnames[section]
+        return None
+
+    def setHeaderData(self, section, orientation, value, role=QtCore.Qt.EditRole):
+        if orientation != QtCore.Qt.Horizontal or section >= len(self.fieldnames):
+            return False
+        self.fieldnames[section] = value
+        self.modified = True
+        self.dataVersion += 1
+        self.headerDataChanged.emit(orientation, section, section)
+        return True
+
+    def _insertRows(self, row, rows, mode=None, schedule=True):
+        self.runPendingRules()
+        num = len(rows)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row + num - 1)
+        self.store.insertRows(row, rows)
+        codes = bytes([DIFFCODES[mode]]) * num
+        for m in self.diffModes:
+            m[row:row] = codes
+        self._diffIndex = None
+        for s in self.ruleIds:
+            s[row:row] = noStyles(num)
+        self.endInsertRows()
+        if schedule:
+            for i in range(row - 1, row + num + 1):
+                self.scheduleRules(i)
 
-    def hasChanged(self, item):
-        self.dataChanged = True
+    def insertRows(self, row, count, parent=QtCore.QModelIndex()):
+        self._insertRows(row, [[]] * count)
+        self.modified = True
+        self.dataVersion += 1
+        return True
+
+    def _removeRows(self, row, count):
+        self.runPendingRules()
+        self.beginRemoveRows(QtCore.QModelIndex(), row, row + count - 1)
+        self.store.removeRows(row, count)
+        for m in self.diffModes:
+            del m[row:row+count]
+        self._diffIndex = None
+        for s in self.ruleIds:
+            del s[row:row+count]
+        self.endRemoveRows()
+        self.scheduleRules(row - 1)
+        self.scheduleRules(row)
+
+    def removeRows(self, row, count, parent=QtCore.QModelIndex()):
+        self._removeRows(row, count)
+        self.modified = True
+        self.dataVersion += 1
+        return True
+
+    def insertColumns(self, col, count, parent=QtCore.QModelIndex()):
+        num = len(self.store)
+        self.beginInsertColumns(QtCore.QModelIndex(), col, col + count - 1)
+        self.store.insertColumns(col, count)
+        self.diffModes[col:col] = [bytearray(num) for i in range(count)]
+        self._diffIndex = None
+        self.ruleIds[col:col] = [noStyles(num) for i in range(count)]
+        self.endInsertColumns()
+        self.modified = True
+        self.dataVersion += 1
+        return True
+
+    def removeColumns(self, col, count, parent=QtCore.QModelIndex()):
+        self.beginRemoveColumns(QtCore.QModelIndex(), col, col + count - 1)
+        self.store.removeColumns(col, count)
+        del self.diffModes[col:col+count]
+        self._diffIndex = None
+        del self.ruleIds[col:col+count]
+        self.endRemoveColumns()
+        self.modified = True
+        self.dataVersion += 1
+        return True
+
+    def isDeletedRow(self, row):
+        return len(self.diffModes) > 0 and self.diffModes[0][row] == DELETED
+
+    def deletedRows(self):
+        # the rows marked deleted, in order, found by scanning the diff modes
+        res = []
+        if not len(self.diffModes):
+            return res
+        modes = self.diffModes[0]
+        i = modes.find(DELETED)
+        while i >= 0:
+            res.append(i)
+            i = modes.find(DELETED, i + 1)
+        return res
 
     def loadConfig(self, config):
         for k, d in {'replace': {'backgroundColor': "#FFC0C0"},
                      'insert': {'backgroundColor': "#C0C0FF"},
-                     'delete': {'backgroundColor': "#E0E0E0"}}.items():
+                     'delete': {'backgroundColor': "#E0E0E0"},
+                     'conflict': {'backgroundColor': "#FFA040"}}.items():
             self.styles[k] = EvalStyle(config.get(k+"Style", d))
-        if 'rules' not in config:
-            return
-        for r in config['rules']:
-            e = r.get('eval', None)
-            if e is not None and not evaluator.is_safe(e):
-                continue
-            self.rules.setdefault(r.get('col', None), []).append({'style': EvalStyle(r),
-                                                                  'eval': r.get('eval', None)})
+        self.keys = config.get('keys', None)
+        self.diffEngine = config.get('diffEngine', 'sequence' if self.keys is None else 'key')
+        cachedir = config.get('cachedir', None)
+        if cachedir is not None:
+            cachedir = os.path.expanduser(cachedir)
+        if cachedir != self.snapshots.cachedir:
+            self.snapshots = SnapshotCache(cachedir=cachedir)
+        self.rules = RuleSet(config.get('rules', None), columnwise=config.get('columnRules', True))
+        self.ruleStyles = [EvalStyle(r.config) for r in self.rules.rules]
+        self.resetStyles()
+        self.ruleIds = [noStyles(len(self.store)) for x in self.fieldnames]
 
     def loadFromCsv(self, f, config):
+        self.cancelLoading()
         self.beginResetModel()
-        self.clear()
         self.fname = f.path
+        self.hasDiff = False
+        self.modified = False
+        size = fileSize(f)
+        if size and config.get('lazyLoad', size > LAZYSIZE):
+            # keeps f open and mapped, parsing rows only as they are needed
+            self.setStore(MmapStore(f))
+            self.endResetModel()
+            if len(self.rules):
+                self.runRules()
+            self.loadFinished.emit()
+            return
 #       self.dialect = csv.Sniffer().sniff(f.read(1024))
 #       f.seek(0)
 #       rdr = csv.DictReader(f, dialect=self.dialect)
-        rdr = csv.DictReader(f)
-        self.fieldnames = rdr.fieldnames[:]
-        self.setHorizontalHeaderLabels(self.fieldnames)
-        for r in rdr:
-            items = [DitItem(r[x], model=self) for x in rdr.fieldnames]
-            self.appendRow(items)
+        fieldnames, rows = readCsvRows(f)
+        self.setStore(ColumnStore(fieldnames))
         self.endResetModel()
-        self.dataChanged = False
+        # the rest of the file is parsed in the background and appended as it comes
+        loader = CsvLoader(rows, f, self)
+        loader.rowsReady.connect(lambda l=loader: self._fetchRows(l))
+        loader.progress.connect(self.loadProgress)
+        loader.finished.connect(lambda l=loader: self._loaderFinished(l))
+        self.loader = loader
+        loader.start()
+
+    def isLoading(self):
+        return self.loader is not None
+
+    def _fetchRows(self, loader):
+        if loader is not self.loader:
+            return
+        while len(loader.chunks):
+            self._appendRows(loader.chunks.popleft())
+
+    def _appendRows(self, rows):
+        start = len(self.store)
+        num = len(rows)
+        self.beginInsertRows(QtCore.QModelIndex(), start, start + num - 1)
+        self.store.append(rows)
+        for m in self.diffModes:
+            m.extend(bytes(num))
+        for s in self.ruleIds:
+            s.extend(noStyles(num))
+        self.endInsertRows()
         if len(self.rules):
-            self.runRules()
+            # the previous last row now has a nextRow
+            self.runRules(first=max(start - 1, 0), last=start + num - 1)
+
+    def _loaderFinished(self, loader):
+        if loader is not self.loader:
+            return
+        self._fetchRows(loader)
+        self.store.doneLoading()
+        self.loader = None
+        loader.deleteLater()
+        self.loadFinished.emit()
+
+    def finishLoading(self):
+        if self.loader is not None:
+            self.loader.wait()
+            self._loaderFinished(self.loader)
+
+    def cancelLoading(self):
+        if self.loader is not None:
+            self.loader.cancelled = True
+            self.loader.wait()
+            self.loader.deleteLater()
+            self.loader = None
 
     def saveCsv(self, f):
-        writer = csv.DictWriter(f, fieldnames=self.fieldnames, # dialect=self.dialect,
-                    lineterminator = "\n", quoting=csv.QUOTE_MINIMAL,
+        self.finishLoading()
+        # a mapped file keeps its own line endings
+        writer = csv.writer(f, # dialect=self.dialect,
+                    lineterminator = getattr(self.store, 'lineterminator', "\n"), quoting=csv.QUOTE_MINIMAL,
                     quotechar = '"', escapechar = '\\')
-        writer.writeheader()
-        for i in range(self.rowCount()):
-            writer.writerow({self.fieldnames[j]: self.data(self.index(i, j))
-                             for j in range(self.columnCount())})
-
-    def colDiff_(self, orig, new):
-        res = [None] * len(new)
-        m = SequenceMatcher(a=orig, b=new)
-        for t, astart, aend, bstart, bend in m.get_opcodes():
-            for i in range(bstart, bend):
-                res[i] = t
-        return res
+        # rows only shown by a diff are not part of the data
+        self.store.writeCsv(f, writer, skip=self.deletedRows())
 
     def loadDiffCsv(self, fh):
-        if self.hasDiff:
-            self.dumpDiff()
         #dialect = csv.Sniffer().sniff(fh.read(1024))
         #fh.seek(0)
-        rdr = csv.DictReader(fh)
-        diffdata = [DiffRow(r[x] for x in rdr.fieldnames) for r in rdr]
-        maindata = [DiffRow(self.itemFromIndex(self.index(x, y)).text()
-                        for y in range(self.columnCount()))
-                            for x in range(self.rowCount())]
-        m = SequenceMatcher(a=diffdata, b=maindata)
-        inserted = 0    # Yes deleted items are inserted!
-        for t, astart, aend, bstart, bend in m.get_opcodes():
+        self.diffSnapshot(parseCsv(fh))
+
+    def loadDiffBlob(self, sha, fetch):
+        # diff against the blob sha, only calling fetch(sha) for its text if
+        # it is not already cached
+        snapshot = self.snapshots.load(sha, fetch)
+        if snapshot is None:
+            return False
+        self.diffSnapshot(snapshot, sha)
+        return True
+
+    def diffSnapshot(self, snapshot, sha=None):
+        self.finishLoading()
+        if self.hasDiff:
+            self.dumpDiff()
+        fieldnames, diffdata = snapshot
+        # the table is known by its dataVersion, which every edit moves on
+        key = (sha, self.dataVersion, self.diffEngine, repr(self.keys)) if sha is not None else None
+        opcodes = self.diffs.get(key) if key is not None else None
+        if opcodes is not None:
+            self.applyDiff(opcodes, diffdata, None)
+            return
+        maindata = [DiffRow(r) for r in self.store.rows()]
+        engine = self.diffEngine
+        akeys = bkeys = None
+        if engine == 'key':
+            aindices = keyIndices(fieldnames, self.keys)
+            bindices = keyIndices(self.fieldnames, self.keys)
+            if aindices is None or bindices is None:
+                engine = 'patience'
+            else:
+                akeys = rowKeys(diffdata, aindices)
+                bkeys = rowKeys(maindata, bindices)
+        opcodes = diffRows(diffdata, maindata, engine, akeys, bkeys)
+        if key is not None:
+            self.diffs.put(key, opcodes)
+        self.applyDiff(opcodes, diffdata, maindata)
+
+    def applyDiff(self, opcodes, diffdata, maindata):
+        # Modes are written straight into the side arrays and deleted rows are
+        # inserted a group at a time, with one dataChanged at the end. Without
+        # maindata, the rows needed are read from the store.
+        groups = []     # Yes deleted items are inserted!
+        changed = []
+        insertRows = bytes([DIFFCODES['insert']])
+        for t, astart, aend, bstart, bend in opcodes:
             alen = aend - astart
             blen = bend - bstart
-            bstart += inserted
+            if t == 'equal':
+                continue
+            changed.append(bstart)
+            changed.append(bend)
             if t == 'replace':
-                for i in range(min(alen, blen)):
-                    coldiff = self.colDiff_(diffdata[astart+i], maindata[bstart+i])
-                    for j, c in enumerate(coldiff):
-                        if c is None:
-                            continue
-                        item = self.itemFromIndex(self.index(bstart+i, j))
-                        if c in ('replace', 'insert', 'delete'):
-                            item.setDiffMode(c, self.styles)
-                for i in range(blen - alen):
-                    for j in range(self.columnCount()):
-                        self.itemFromIndex(self.index(bstart+i+alen, j)).setDiffMode('insert', self.styles)
-                for i in range(alen - blen):
-                    row = [DitItem(x) for x in diffdata[astart+blen+i]]
-                    self.insertRow(bstart+blen+i, row)
-                    for r in row:
-                        r.setDiffMode('delete', self.styles)
-                        r.setEditable(False)
-                    inserted += 1
+                num = min(alen, blen)
+                if maindata is not None:
+                    brows = maindata[bstart:bstart+num]
+                else:
+                    brows = [self.store.row(i) for i in range(bstart, bstart+num)]
+                changes = cellDiffs(diffdata[astart:astart+num], brows)
+                for i, cells in enumerate(changes):
+                    for j, c in cells:
+                        self.diffModes[j][bstart+i] = DIFFCODES[c]
+                if blen > alen:
+                    for m in self.diffModes:
+                        m[bstart+alen:bend] = insertRows * (blen - alen)
+                elif alen > blen:
+                    groups.append((bend, diffdata[astart+blen:aend]))
             elif t == 'insert':
-                for i in range(blen):
-                    for j in range(self.columnCount()):
-                        self.itemFromIndex(self.index(bstart+i, j)).setDiffMode('insert', self.styles)
+                for m in self.diffModes:
+                    m[bstart:bend] = insertRows * blen
             elif t == 'delete':
-                for i in range(alen):
-                    row = [DitItem(x) for x in diffdata[astart+i]]
-                    self.insertRow(bstart+i, row)
-                    for r in row:
-                        r.setDiffMode('delete', self.styles)
-                        r.setEditable(False)
-                inserted += alen
+                groups.append((bstart, diffdata[astart:aend]))
+        newRow = self._insertRowGroups(groups)
+        self.hasDiff = True
+        self._diffIndex = None
+        if len(changed):
+            first = newRow(min(changed), False)
+            last = min(newRow(max(changed), True), self.rowCount()) - 1
+            if last >= first:
+                self.dataChanged.emit(self.index(first, 0), self.index(last, self.columnCount()-1),
+                                      list(self.styleRoles))
+
+    def _insertRowGroups(self, groups, modes=None):
+        # Inserts each (pos, rows) of groups with the diff mode of the same
+        # entry in modes, default delete. Returns a function mapping old row
+        # numbers to new ones
+        if modes is None:
+            modes = ['delete'] * len(groups)
+        positions = []
+        totals = []
+        for pos, rows in groups:
+            positions.append(pos)
+            totals.append(len(rows) + (totals[-1] if len(totals) else 0))
+        def newRow(row, after=True):
+            i = (bisect_right if after else bisect_left)(positions, row)
+            return row + (totals[i-1] if i > 0 else 0)
+        if len(groups) <= 16:
+            for (pos, rows), mode in reversed(list(zip(groups, modes))):
+                self._insertRows(pos, rows, mode, schedule=False)
+            self._groupRules(groups)
+            return newRow
+        # too many groups to splice in one by one
+        self.runPendingRules()
+        self.layoutAboutToBeChanged.emit()
+        self.store.insertRowGroups(groups)
+        codes = [bytes([DIFFCODES[mode]]) for mode in modes]
+        self.diffModes = [spliceRows(m, [(pos, c * len(rows)) for (pos, rows), c in zip(groups, codes)])
+                            for m in self.diffModes]
+        self.ruleIds = [spliceRows(s, [(pos, noStyles(len(rows))) for pos, rows in groups])
+                            for s in self.ruleIds]
+        self._movePersistentRows(newRow)
+        self.layoutChanged.emit()
+        self._groupRules(groups)
+        return newRow
+
+    def _groupRules(self, groups):
+        # runs the rules once over each run of rows _insertRowGroups inserted,
+        # and the rows either side of it
+        if not len(self.rules):
+            return
+        ranges = []
+        total = 0
+        for pos, rows in groups:
+            first = max(pos + total - 1, 0)
+            total += len(rows)
+            last = min(pos + total, self.rowCount() - 1)
+            if len(ranges) and first <= ranges[-1][1] + 1:
+                ranges[-1][1] = last
+            else:
+                ranges.append([first, last])
+        for first, last in ranges:
+            self.runRules(first, last)
+
+    def mergeSnapshots(self, base, theirs):
+        # Three way merge of the (fieldnames, rows) theirs into the table,
+        # with base as their common ancestor. Changes only theirs made are
+        # made to the table, rows only theirs has are added, and rows theirs
+        # deleted are marked deleted, so that saving drops them. Cells both
+        # sides changed keep our value and are marked as conflicts.
+        self.finishLoading()
+        if self.hasDiff:
+            self.dumpDiff()
+        fieldnames = self.fieldnames
+        brows = remapRows(base[0], base[1], fieldnames)
+        trows = remapRows(theirs[0], theirs[1], fieldnames)
+        ours = [DiffRow(r) for r in self.store.rows()]
+        indices = keyIndices(fieldnames, self.keys)
+        if indices is not None:
+            bkeys = rowKeys(brows, indices)
+            okeys = rowKeys(ours, indices)
+            tkeys = rowKeys(trows, indices)
+        else:
+            # without keys, rows are paired by diffing each side with base
+            bkeys = list(range(len(brows)))
+            okeys = alignedKeys(brows, ours, 'ours')
+            tkeys = alignedKeys(brows, trows, 'theirs')
+        cells, deleted, inserts = mergeRows(brows, ours, trows, bkeys, okeys, tkeys)
+        bmap = dict(zip(bkeys, brows))
+        self.conflicts = {}
+        for i, j, tag, value in cells:
+            if tag == 'replace':
+                self.store.set(i, j, value)
+            else:
+                b = bmap.get(okeys[i], None)
+                self.conflicts[(self._conflictKey(ours[i], indices), fieldnames[j])] = \
+                        (b[j] if b is not None else None, value)
+            self.diffModes[j][i] = DIFFCODES[tag]
+        for i in deleted:
+            for m in self.diffModes:
+                m[i] = DELETED
+        groups = []
+        modes = []
+        for pos, row, tag in inserts:
+            if len(groups) and groups[-1][0] == pos and modes[-1] == tag:
+                groups[-1][1].append(row)
+            else:
+                groups.append((pos, [row]))
+                modes.append(tag)
+            if tag == 'conflict':
+                # a row we deleted and they changed
+                for n in fieldnames:
+                    self.conflicts[(self._conflictKey(row, indices), n)] = (None, None)
+        self._insertRowGroups(groups, modes)
         self.hasDiff = True
+        self._diffIndex = None
+        if len(cells) or len(deleted) or len(inserts):
+            self.modified = True
+            self.dataVersion += 1
+        if self.rowCount() > 0:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount()-1, self.columnCount()-1))
+        if len(self.rules):
+            self.runRules()
+        return len([c for c in cells if c[2] == 'conflict']) + modes.count('conflict')
+
+    def loadMergeBlobs(self, baseSha, theirsSha, fetch):
+        # mergeSnapshots for blob ids, with no base if baseSha is None
+        theirs = self.snapshots.load(theirsSha, fetch)
+        if theirs is None:
+            return None
+        base = self.snapshots.load(baseSha, fetch) if baseSha is not None else None
+        return self.mergeSnapshots(base or ([], []), theirs)
+
+    def _conflictKey(self, row, indices):
+        if indices is not None:
+            return tuple(row[i] for i in indices)
+        return tuple(row)
+
+    def conflictTip(self, row, col):
+        vals = self.conflicts.get((self._conflictKey(self.store.row(row), keyIndices(self.fieldnames, self.keys)),
+                                   self.fieldnames[col]), None)
+        if vals is None:
+            return None
+        if vals[1] is None:
+            return "Deleted by one side, changed by the other"
+        return "Base: {}\nTheirs: {}".format(vals[0] if vals[0] is not None else "(none)", vals[1])
+
+    def _movePersistentRows(self, newRow):
+        old = self.persistentIndexList()
+        new = []
+        for i in old:
+            r = newRow(i.row())
+            new.append(self.index(r, i.column()) if r >= 0 else QtCore.QModelIndex())
+        self.changePersistentIndexList(old, new)
 
-    def runRules(self, row=None):
-        if self.runningRules:
+    def setHistory(self, history):
+        self.history = history
+        if self.rowCount() > 0:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount()-1, self.columnCount()-1),
+                                  [QtCore.Qt.ToolTipRole])
+
+    def columnValues(self, col):
+        return self.store.column(col)
+
+    def columnReader(self, col):
+        # a function giving the column's values, safe to call off this thread
+        return self.store.columnReader(col)
+
+    def rowData(self, row):
+        return dict(zip(self.fieldnames, self.store.row(row)))
+
+    def mergedStyle(self, matches):
+        if not len(matches):
+            return None
+        res = EvalStyle()
+        for i in matches:
+            res.merge(self.ruleStyles[i])
+        return None if res.isEmpty() else res
+
+    def scheduleRules(self, row, col=None):
+        # Queues the cells whose rules may have changed after an edit to a cell,
+        # or to any of the row if col is None. A burst of edits is evaluated
+        # together once control returns to the event loop.
+        if not len(self.rules):
             return
+        if col is None:
+            targets = [(0, None)]
         else:
-            self.runningRules = True
-        lastRow = None
-        rowData = None
-        nextRow = None
-        rowRange = range(self.rowCount()-1, -1, -1) if row is None else [row]
-        for i in rowRange:
-            if nextRow is None:
-                rowData = {self.fieldnames[j]: self.item(i,j).text() for j in range(self.columnCount())}
+            targets = self.rules.dependents(self.fieldnames[col])
+        for offset, names in targets:
+            i = row + offset
+            if i < 0 or i >= self.rowCount():
+                continue
+            curr = self.pendingRules.get(i, ())
+            if names is None or curr is None:
+                self.pendingRules[i] = None
             else:
-                lastRow = rowData
-                rowData = nextRow
-            if lastRow is None and i < self.rowCount() - 1:
-                lastRow = {self.fieldnames[j]: self.item(i+1,j).text() for j in range(self.columnCount())}
-            if i > 0:
-                nextRow = {self.fieldnames[j]: self.item(i-1,j).text() for j in range(self.columnCount())}
+                self.pendingRules[i] = set(curr) | names
+        if len(self.pendingRules) and not self.ruleTimer.isActive():
+            self.ruleTimer.start()
+
+    def runPendingRules(self):
+        pending, self.pendingRules = self.pendingRules, {}
+        self.ruleTimer.stop()
+        if not len(pending) or not len(self.rules):
+            return
+        numRows = self.rowCount()
+        rows = {}
+        def rowData(i):
+            if i < 0 or i >= numRows:
+                return None
+            res = rows.get(i, None)
+            if res is None:
+                res = rows[i] = self.rowData(i)
+            return res
+        cols = set()
+        for i, names in pending.items():
+            if i >= numRows:
+                continue
+            if names is None:
+                indices = range(self.columnCount())
             else:
-                nextRow = None
-            rowStyle = EvalStyle()
-            for rule in self.rules.get(None, []):
-                if evaluator.eval(rule['eval'], r=rowData, lastRow=nextRow, nextRow=lastRow):
-                    rowStyle.merge(rule['style'])
-            for j in range(self.columnCount()):
-                cellStyle = rowStyle.copy()
-                for rule in self.rules.get(self.fieldnames[j], []):
-                    if evaluator.eval(rule['eval'], r=rowData, lastRow=nextRow, nextRow=lastRow):
-                        cellStyle.merge(rule['style'])
-                if not cellStyle.isEmpty() or row is not None:
-                    item = self.item(i,j)
-                    item.evalStyle = cellStyle
-                    item.update(changed=False)
+                indices = [j for j, n in enumerate(self.fieldnames) if n in names]
+            matches = self.rules.evalRow(rowData(i), rowData(i-1), rowData(i+1),
+                                         [self.fieldnames[j] for j in indices])
+            for j, m in zip(indices, matches):
+                self.ruleIds[j][i] = self.matchId(m)
+            cols.update(indices)
+        if len(cols):
+            self.dataChanged.emit(self.index(min(pending), min(cols)),
+                                  self.index(min(max(pending), numRows-1), max(cols)),
+                                  list(self.styleRoles))
+
+    def runRules(self, first=0, last=None):
+        if self.runningRules or not len(self.rules):
+            return
+        if last is None:
+            last = self.rowCount() - 1
+        if last >= first:
+            if isinstance(self.store, MmapStore) and last - first >= RULEBLOCK:
+                # parsing every row would undo the point of mapping the file,
+                # so the rules are left to be run a block at a time as shown
+                stale = array('I', [STALE]) * (last - first + 1)
+                for s in self.ruleIds:
+                    s[first:last+1] = stale
+            else:
+                self._evalRules(first, last)
+            self.dataChanged.emit(self.index(first, 0), self.index(last, self.columnCount()-1),
+                                  list(self.styleRoles))
+
+    def _evalRules(self, first, last):
+        self.runningRules = True
+        numRows = self.rowCount()
+        # whole columns at a time, so simple rules are mapped down a column
+        columns = self.store.columnRange(first, last + 1)
+        above = self.rowData(first - 1) if first > 0 else None
+        below = self.rowData(last + 1) if last + 1 < numRows else None
+        matches = self.rules.evalColumns(columns, self.fieldnames, above, below)
+        # columns with the same rules share their list of matches
+        ids = {}
+        for j, m in enumerate(matches):
+            col = ids.get(id(m), None)
+            if col is None:
+                col = ids[id(m)] = array('I', map(self.matchId, m))
+            self.ruleIds[j][first:last+1] = col
         self.runningRules = False
 
     def dumpDiff(self):
-        for i in range(self.rowCount()-1, -1, -1):
-            first = self.item(i, 0)
-            if first.diffMode == 'delete':
-                self.removeRow(i)
-                continue
-            for j in range(self.columnCount()):
-                c = self.item(i, j)
-                c.setDiffMode(None, self.styles)
+        if len(self.diffModes):
+            deleted = self.diffModes[0]
+            runs = []
+            start = deleted.find(DELETED)
+            while start >= 0:
+                end = start + 1
+                while end < len(deleted) and deleted[end] == DELETED:
+                    end += 1
+                runs.append((start, end))
+                start = deleted.find(DELETED, end)
+            if len(runs) <= 16:
+                for start, end in reversed(runs):
+                    self._removeRows(start, end - start)
+            else:
+                self.runPendingRules()
+                self.layoutAboutToBeChanged.emit()
+                keep = deleted.translate(self.keepTable)
+                self.store.keepRows(keep)
+                self.ruleIds = [array('I', compress(s, keep)) for s in self.ruleIds]
+                self.diffModes = [bytearray(len(self.store)) for m in self.diffModes]
+                starts = [r[0] for r in runs]
+                totals = list(accumulate(r[1] - r[0] for r in runs))
+                def newRow(row):
+                    i = bisect_right(starts, row)
+                    if i > 0 and row < runs[i-1][1]:
+                        return -1
+                    return row - (totals[i-1] if i > 0 else 0)
+                self._movePersistentRows(newRow)
+                self.layoutChanged.emit()
+        self.diffModes = [bytearray(len(self.store)) for m in self.diffModes]
+        self._diffIndex = None
+        self.conflicts = {}
+        if self.rowCount() > 0:
+            self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount()-1, self.columnCount()-1),
+                                  list(self.styleRoles))
         self.hasDiff = False
 
-    def findDiffInRow(self, backwards, row, startCol):
-        if backwards:
-            end = -1
-            counter = -1
-        else:
-            end = self.columnCount()
-            counter = 1
-        for i in range(startCol, end, counter):
-            item = self.item(row, i)
-            if item.diffMode is not None:
-                return self.index(row, i)
-        return None
+    def diffIndex(self):
+        # The changed cells as sorted row * columnCount + column positions,
+        # and the first and last rows of each run of changed rows
+        if self._diffIndex is None:
+            num = self.columnCount()
+            cells = []
+            if self.hasDiff:
+                rows = range(self.rowCount())
+                for j, m in enumerate(self.diffModes):
+                    cells.extend(r * num + j for r in compress(rows, m))
+                cells.sort()
+            starts = []
+            ends = []
+            for p in cells:
+                r = p // num
+                if len(ends) and ends[-1] >= r - 1:
+                    ends[-1] = r
+                else:
+                    starts.append(r)
+                    ends.append(r)
+            self._diffIndex = (array('q', cells), starts, ends)
+        return self._diffIndex
 
-    def nextDiffFrom(self, curri):
-        row = curri.row()
-        col = curri.column()
-        resi = self.findDiffInRow(False, row, col+1)
-        if resi is not None: return resi
-        for r in range(row + 1, self.rowCount()):
-            resi = self.findDiffInRow(False, r, 0)
-            if resi is not None: return resi
-        for r in range(0, row + 1):
-            resi = self.findDiffInRow(False, r, 0)
-            if resi is not None: return resi
-        return None
+    def nextDiffFrom(self, curri, hunks=False):
+        cells, starts, ends = self.diffIndex()
+        if not len(cells):
+            return None
+        num = self.columnCount()
+        if hunks:
+            i = bisect_right(starts, curri.row())
+            row = starts[i if i < len(starts) else 0]
+            return self.index(row, cells[bisect_left(cells, row * num)] - row * num)
+        i = bisect_right(cells, curri.row() * num + curri.column())
+        p = cells[i if i < len(cells) else 0]
+        return self.index(p // num, p % num)
 
-    def lastDiffFrom(self, curri):
-        row = curri.row()
-        col = curri.column()
-        resi = self.findDiffInRow(True, row, col-1)
-        if resi is not None: return resi
-        for r in range(row-1, -1, -1):
-            resi = self.findDiffInRow(True, r, self.columnCount()-1)
-            if resi is not None: return resi
-        for r in range(self.rowCount()-1, row-1, -1):
-            resi = self.findDiffInRow(True, r, self.columnCount()-1)
-            if resi is not None: return resi
-        return None
+    def lastDiffFrom(self, curri, hunks=False):
+        cells, starts, ends = self.diffIndex()
+        if not len(cells):
+            return None
+        num = self.columnCount()
+        if hunks:
+            row = starts[bisect_left(starts, curri.row()) - 1]
+            return self.index(row, cells[bisect_left(cells, row * num)] - row * num)
+        p = cells[bisect_left(cells, curri.row() * num + curri.column()) - 1]
+        return self.index(p // num, p % num)
 
+    def diffStatus(self, index, hunks=False):
+        # "Change k/N" for the changed cell at index, or the hunk it is in
+        cells, starts, ends = self.diffIndex()
+        if hunks:
+            return "Hunk {}/{}".format(bisect_right(starts, index.row()), len(starts))
+        k = bisect_left(cells, index.row() * self.columnCount() + index.column()) + 1
+        return "Change {}/{}".format(k, len(cells))
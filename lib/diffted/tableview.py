@@ -60,6 +60,9 @@ class DitHeaderView(QtWidgets.QHeaderView):
             self.setSortIndicator(index, 0)
 
 class DitTableView(QtWidgets.QTableView):
+
+    searchStatus = QtCore.pyqtSignal(str)
+
     def __init__(self, parent=None):
         super(DitTableView, self).__init__(parent)
         self.rowContextMenu = QtWidgets.QMenu()
@@ -188,53 +191,26 @@ class DitTableView(QtWidgets.QTableView):
             self.model().sourceModel().removeColumns(i, 1)
 
     def renameColumn(self):
-        # this doesn't work, sigh
-        hdr = self.horizontalHeader()
-        index = hdr.model().index(0, self.currPos)
-        item = self.model().sourceModel().horizontalHeaderItem(self.currPos)
-        item.setEditable(True)
-        hdr.setCurrentIndex(index)
-        hdr.edit(index)
-        item.setEditable(False)
-
-    def gotoMatch(self, row, col, filt):
-        pi = self.model().index(row, col)
-        val = self.model().data(pi)
-        if filt.match(val):
-            self.setCurrentIndex(pi)
-            # self.setFocus()
-            self.scrollTo(pi)
-            return True
-        else:
-            return False
+        m = self.model()
+        name = m.headerData(self.currPos, QtCore.Qt.Horizontal) or ""
+        name, ok = QtWidgets.QInputDialog.getText(self, "Rename column", "Column name:", text=name)
+        if ok:
+            m.setHeaderData(self.currPos, QtCore.Qt.Horizontal, name)
 
     def findNextInColumn(self, col, filt):
-        pos = self.currentIndex()
-        start = pos.row() + 1
-        curr = start
-        curm = self.model().rowCount()
-        while curr < curm:
-            if self.gotoMatch(curr, col, filt):
-                return
-            curr += 1
-        curr = 0
-        while curr < start:
-            if self.gotoMatch(curr, col, filt):
-                return 
-            curr += 1
+        self.findInColumn(col, filt, False)
 
     def findPrevInColumn(self, col, filt):
-        pos = self.currentIndex()
-        start = pos.row() - 1
-        curr = start
-        curm = self.model().rowCount()
-        while curr >= 0:
-            if self.gotoMatch(curr, col, filt):
-                return
-            curr -= 1
-        curr = curm - 1
-        while curr > start:
-            if self.gotoMatch(curr, col, filt):
-                return 
-            curr -= 1
+        self.findInColumn(col, filt, True)
 
+    def findInColumn(self, col, filt, backwards):
+        res = self.model().findInColumn(col, filt.getSearch(), self.currentIndex().row(), backwards)
+        if res is None:
+            self.searchStatus.emit("No matches")
+            return
+        row, k, num = res
+        pi = self.model().index(row, col)
+        self.setCurrentIndex(pi)
+        # self.setFocus()
+        self.scrollTo(pi)
+        self.searchStatus.emit("Match {} of {}".format(k, num))
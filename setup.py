@@ -15,11 +15,11 @@ setup(
     description = 'Utility to edit csv files with differencing and git',
     maintainer = 'SIL International',
     url = 'http://github.com/silnrsi/diffted',
-    packages = ["diffted",
+    packages = ["diffted", "diffted.core",
         ],
     package_dir = {'':'lib'},
     install_requires=[
-        'PyQt5', 'PyQt5-sip', 'PyGithub', 'PyYAML'
+        'PyQt5', 'PyQt5-sip', 'PyYAML'
     ],
 #    package_data={
 #        'oxttools': [
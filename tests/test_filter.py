@@ -0,0 +1,53 @@
+import io, os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PyQt5 import QtCore, QtWidgets
+from diffted.tablemodel import DitTableModel
+from diffted.filter import FilterProxy, ColumnFilter
+
+app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+class FixedFilters(FilterProxy):
+    # filters given as specs rather than by filter widgets
+    specs = []
+    def filterSpecs(self):
+        return self.specs
+
+
+def loadModel(text):
+    fh = io.StringIO(text)
+    fh.path = "t.csv"
+    model = DitTableModel()
+    model.loadFromCsv(fh, {})
+    model.finishLoading()
+    return model
+
+
+class FilterTest(unittest.TestCase):
+    def setUp(self):
+        self.model = loadModel("id,word,status\n1,apple,ok\n2,pear,bad\n")
+        self.proxy = FixedFilters()
+        self.proxy.setSourceModel(self.model)
+        self.proxy.loadConfig({})
+
+    def headers(self):
+        return [self.proxy.headerData(i, QtCore.Qt.Horizontal) for i in range(self.proxy.columnCount())]
+
+    def test_emptyResultHeaders(self):
+        self.proxy.specs = [(1, ColumnFilter("zzz", False))]
+        self.proxy.invalidateFilter()
+        self.assertEqual(self.proxy.rowCount(), 0)
+        self.assertEqual(self.headers(), ['id', 'word', 'status'])
+        self.assertTrue(self.proxy.setHeaderData(0, QtCore.Qt.Horizontal, "NEW"))
+        self.assertEqual(self.model.fieldnames, ['NEW', 'word', 'status'])
+
+    def test_rowHeaders(self):
+        self.proxy.specs = [(1, ColumnFilter("pear", False))]
+        self.proxy.invalidateFilter()
+        self.assertEqual(self.proxy.headerData(0, QtCore.Qt.Vertical), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os, shutil, sys, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "lib"))
+from diffted.core.report import Table, Reporter
+
+
+class ReportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def changes(self, old, new, config={}):
+        names = []
+        for i, text in enumerate((old, new)):
+            fname = os.path.join(self.dir, "{}.csv".format(i))
+            with open(fname, "w", encoding="utf-8", newline="") as fh:
+                fh.write(text)
+            names.append(fname)
+        a, b = Table(names[0]), Table(names[1])
+        try:
+            return list(Reporter("t.csv", a, b, config).changes())
+        finally:
+            a.close()
+            b.close()
+
+    def test_insert(self):
+        res = self.changes("id,a\n1,x\n2,y\n3,z\n4,w\n", "id,a\n0,v\n1,x\n2,y\n3,z\n4,w\n")
+        self.assertEqual([(e['change'], e['row']) for e in res], [('insert', 1)])
+
+    def test_addedColumn(self):
+        res = self.changes("id,a\n1,x\n2,y\n3,z\n4,w\n", "id,a,b\n0,v,q\n1,x,q\n2,y,q\n3,z,q\n4,w,q\n")
+        self.assertEqual([(e['change'], e['row'], e['column']) for e in res],
+                         [('insertcolumn', "", 'b'), ('insert', 1, "")])
+
+    def test_droppedColumn(self):
+        res = self.changes("id,a,b\n1,x,q\n2,y,q\n3,z,q\n", "id,b\n1,q\n2,r\n3,q\n")
+        self.assertEqual([(e['change'], e['row'], e['column'], e['old'], e['new']) for e in res],
+                         [('deletecolumn', "", 'a', "", ""), ('replace', 2, 'b', 'q', 'r')])
+
+
+if __name__ == "__main__":
+    unittest.main()